@@ -0,0 +1,132 @@
+# Runs many (primary, secondary, filter, params) jobs across worker processes
+# Every input image is decoded once by the main process (with all of its bits, see image_io.py) and
+# handed to the workers through shared memory, so no worker re-opens or re-decodes an input. Outputs
+# are saved by the workers.
+#
+# Run `python batch.py manifest.json [workers]`, or without a manifest to run every filter on the
+# image pairs listed in main.py. A manifest is a JSON list of jobs such as
+#   [{"primary": "dragon_normals.png", "secondary": "dragon_albedo.png",
+#     "filter": "layered_paint", "params": {"brush_sizes": [6, 40, 80]}}]
+# where "secondary" and "params" are optional and "filter" is a key of main.FILTERS.
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+from typing import NamedTuple
+import numpy as np
+import json
+import sys
+import time
+from image_io import read_image
+from main import FILTERS, albedo_images, normal_images, input_path, run_filter, save_outputs
+
+class Job(NamedTuple):
+    primary: str
+    secondary: str
+    filter: str
+    params: dict
+
+class SharedImage(NamedTuple):
+    # Where a decoded image lives in shared memory
+    name: str
+    shape: tuple
+    dtype: str
+
+class JobResult(NamedTuple):
+    job: Job
+    seconds: float
+    num_pixels: int
+    outputs: list
+
+def load_manifest(path):
+    with open(path) as file:
+        entries = json.load(file)
+    jobs = []
+    for entry in entries:
+        if entry["filter"] not in FILTERS:
+            raise ValueError(f"Unknown filter {entry['filter']!r}, expected one of {list(FILTERS)}")
+        jobs.append(Job(entry["primary"], entry.get("secondary"), entry["filter"], entry.get("params", {})))
+    return jobs
+
+def default_jobs():
+    # The same work as running main.py
+    jobs = []
+    for primary, secondary in zip(normal_images, albedo_images):
+        jobs.append(Job(primary, secondary, "slic", {}))
+        jobs.append(Job(primary, secondary, "layered_paint", {"brush_sizes": [6, 40, 80]}))
+        jobs.append(Job(primary, secondary, "kuwahara", {}))
+        jobs.append(Job(primary, None, "flow_normals", {}))
+    return jobs
+
+def share_image(path):
+    # Decodes an image into a new shared memory block, which the caller has to unlink
+    array = read_image(path)
+    block = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+    return block, SharedImage(block.name, array.shape, array.dtype.str)
+
+# Shared memory blocks a worker has attached to. They stay open for as long as the worker runs, so
+# the views handed to its jobs stay valid whatever the filters keep of them, and a worker attaches to
+# an image that several of its jobs use only once.
+attached_blocks = {}
+
+def attach_image(shared: SharedImage):
+    # A read only view of a shared image, without copying it. The main process unlinks the block
+    # after the pool and its workers are shut down.
+    block = attached_blocks.get(shared.name)
+    if block is None:
+        block = attached_blocks[shared.name] = shared_memory.SharedMemory(name=shared.name)
+    array = np.ndarray(shared.shape, dtype=shared.dtype, buffer=block.buf)
+    array.flags.writeable = False
+    return array
+
+def run_job(job: Job, primary: SharedImage, secondary: SharedImage):
+    primary_image = attach_image(primary)
+    secondary_image = attach_image(secondary) if secondary is not None else None
+
+    start = time.perf_counter()
+    outputs = run_filter(job.filter, primary_image, secondary_image, **job.params)
+    seconds = time.perf_counter() - start
+    paths = save_outputs(outputs, job.primary, job.secondary)
+    return JobResult(job, seconds, primary_image.shape[0] * primary_image.shape[1], paths)
+
+def run_batch(jobs, max_workers=None):
+    # Returns the JobResults in completion order, printing each one as it finishes
+    blocks = []
+    shared = {}
+    start = time.perf_counter()
+    try:
+        for job in jobs:
+            for filename in (job.primary, job.secondary):
+                if filename is not None and filename not in shared:
+                    block, shared[filename] = share_image(input_path(filename))
+                    blocks.append(block)
+        decode_time = time.perf_counter() - start
+
+        results = []
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(run_job, job, shared[job.primary],
+                                       shared[job.secondary] if job.secondary is not None else None)
+                       for job in jobs]
+            for future in as_completed(futures):
+                result = future.result()
+                results.append(result)
+                print(f"{result.job.filter:>14} {result.job.primary:<24} {result.seconds:>7.2f} s "
+                      f"{result.num_pixels / result.seconds / 1e6:>7.2f} Mpx/s")
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    wall_time = time.perf_counter() - start
+    busy_time = sum(result.seconds for result in results)
+    num_pixels = sum(result.num_pixels for result in results)
+    print(f"{len(results)} jobs in {wall_time:.2f} s ({decode_time:.2f} s decoding): "
+          f"{len(results) / wall_time:.2f} jobs/s, {num_pixels / wall_time / 1e6:.2f} Mpx/s, "
+          f"{busy_time / wall_time:.1f} workers busy on average")
+    return results
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    jobs = load_manifest(args[0]) if args else default_jobs()
+    max_workers = int(args[1]) if len(args) > 1 else None
+    run_batch(jobs, max_workers)
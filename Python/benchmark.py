@@ -0,0 +1,627 @@
+# Timing comparisons between filter implementations on synthetic inputs
+# Run `python benchmark.py <name> [sizes...]` with the name of one benchmark, e.g.
+# `python benchmark.py slic 1024 2048`, to time it on those image sizes (1024, 2048 and 4096 px by
+# default). Without a known name it prints the names and exits with status 2.
+# `python benchmark.py suite` times every filter over a sweep of sizes and parameters, 512 to 4096 px
+# unless sizes are given (8192 px has to be asked for explicitly), and compares the results with the
+# baseline saved by `python benchmark.py suite --save-baseline`, see benchmark_suite
+
+from PIL import Image, ImageDraw, ImageFilter
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple
+import json
+import numpy as np
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from slic import SLICImage
+from color import rgb2lab, clear_lab_cache, content_key
+from kuwahara import Kuwahara
+from flow_direction import FlowDirection, structure_tensor, symmetric_eigen_2x2, eigh_2x2, eigen_errors, save_flow, load_flow
+from layered_paint import LayeredPaintImage, BLUR_FACTOR
+from blur_pyramid import BlurPyramid, clear_pyramid_cache
+from image_io import read_image, decoded_image, write_png
+from result_cache import ResultCache
+import cv2
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+BASELINE_PATH = os.path.join(script_dir, "benchmark_baseline.json")
+# 8192 px works too but takes hours on a few cores, pass it explicitly
+SUITE_SIZES = [512, 1024, 2048, 4096]
+
+def synthetic_normal_map(size, seed=0):
+    # Object space normals of a few overlapping spheres, with some noise so SLIC has edges to find
+    rng = np.random.default_rng(seed)
+    ys, xs = np.mgrid[0:size, 0:size].astype(np.float32) / size
+    normals = np.zeros((size, size, 3), dtype=np.float32)
+    normals[..., 2] = 1.0
+    for _ in range(6):
+        cx, cy, r = rng.uniform(0.2, 0.8), rng.uniform(0.2, 0.8), rng.uniform(0.1, 0.3)
+        dx, dy = (xs - cx) / r, (ys - cy) / r
+        inside = dx * dx + dy * dy < 1
+        normals[inside, 0] = dx[inside]
+        normals[inside, 1] = dy[inside]
+        normals[inside, 2] = np.sqrt(1 - dx[inside] ** 2 - dy[inside] ** 2)
+    normals += rng.normal(0, 0.02, normals.shape).astype(np.float32)
+    rgb = np.clip((normals + 1.0) / 2.0 * 255, 0, 255).astype(np.uint8)
+    return Image.fromarray(rgb)
+
+def synthetic_albedo_map(size, seed=0):
+    # Flat patches of color with a little noise, standing in for a painted albedo texture
+    rng = np.random.default_rng(seed)
+    patches = rng.integers(0, 256, (8, 8, 3), dtype=np.uint8)
+    rgb = cv2.resize(patches, (size, size), interpolation=cv2.INTER_NEAREST).astype(np.int16)
+    rgb += rng.integers(-4, 5, rgb.shape, dtype=np.int16)
+    return Image.fromarray(np.clip(rgb, 0, 255).astype(np.uint8))
+
+def input_normal_maps(sizes):
+    # The normal maps in Inputs/, or synthetic ones of the given sizes when they can't be read
+    # (e.g. a checkout without the Git LFS files)
+    inputs_dir = os.path.join(script_dir, "Inputs")
+    images = {}
+    for filename in sorted(os.listdir(inputs_dir)):
+        if filename.endswith("_normals.png"):
+            try:
+                images[filename] = Image.open(os.path.join(inputs_dir, filename)).convert("RGB")
+            except OSError:
+                pass
+    return images or {f"synthetic {size}": synthetic_normal_map(size) for size in sizes}
+
+def legacy_slic(image, superpixel_size=100, num_iterations=10, compactness=10):
+    # The original per-center SLIC loop, kept here as the baseline to compare against
+    w, h = image.size
+    lab = rgb2lab(np.array(image).astype(np.float32))
+    S = int(superpixel_size)
+
+    centers = []
+    for y in range(S//2, h, S):
+        for x in range(S//2, w, S):
+            centers.append((lab[y,x], x, y))
+
+    labels = -np.ones((h, w), dtype=np.int32)
+    distances = np.full((h, w), np.inf, dtype=np.float32)
+
+    for iteration in range(num_iterations):
+        for k, ((l, a, b), cx, cy) in enumerate(centers):
+            y0, y1 = max(0, int(cy - S)), min(h, int(cy + S))
+            x0, x1 = max(0, int(cx - S)), min(w, int(cx + S))
+            region = lab[y0:y1, x0:x1]
+            yy, xx = np.mgrid[y0:y1, x0:x1]
+            color_dist = np.sqrt((region[...,0]-l)**2 + (region[...,1]-a)**2 + (region[...,2]-b)**2)
+            spatial_dist = np.sqrt((yy-cy)**2 + (xx-cx)**2)
+            D = np.sqrt((color_dist/compactness)**2 + (spatial_dist/S)**2)
+            mask = D < distances[y0:y1, x0:x1]
+            distances[y0:y1, x0:x1][mask] = D[mask]
+            labels[y0:y1, x0:x1][mask] = k
+        for cluster_index in range(len(centers)):
+            ys, xs = np.where(labels == k)
+            if len(ys)==0:
+                continue
+            centers[cluster_index] = (lab[ys, xs].mean(axis=0), xs.mean(), ys.mean())
+
+    return labels, centers
+
+def time_per_iteration(run, num_iterations):
+    start = time.perf_counter()
+    run(num_iterations)
+    return (time.perf_counter() - start) / num_iterations
+
+def benchmark_slic(sizes, superpixel_size=32, compactness=13, num_iterations=10, legacy_iterations=1):
+    # The legacy loop is quadratic in the number of clusters, so it only runs `legacy_iterations`
+    # iterations and the comparison is made per iteration
+    print(f"SLIC, superpixel_size={superpixel_size}, compactness={compactness}")
+    print(f"{'size':>6} {'legacy s/iter':>14} {'vectorized s/iter':>18} {'speedup':>8}")
+    for size in sizes:
+        image = synthetic_normal_map(size)
+        slic_image = SLICImage(image, ImageDraw.Draw(image))
+        vectorized = time_per_iteration(
+            lambda n: slic_image.slic(superpixel_size=superpixel_size, num_iterations=n, compactness=compactness),
+            num_iterations)
+        legacy = time_per_iteration(
+            lambda n: legacy_slic(image, superpixel_size=superpixel_size, num_iterations=n, compactness=compactness),
+            legacy_iterations)
+        print(f"{size:>6} {legacy:>14.3f} {vectorized:>18.3f} {legacy / vectorized:>7.1f}x")
+
+def boundaries(labels):
+    # Pixels whose label differs from their right or bottom neighbour
+    edges = np.zeros(labels.shape, dtype=bool)
+    edges[:, :-1] |= labels[:, :-1] != labels[:, 1:]
+    edges[:-1, :] |= labels[:-1, :] != labels[1:, :]
+    return edges
+
+def boundary_recall(reference, labels, tolerance=2):
+    # Fraction of the reference boundary pixels with a boundary of `labels` within `tolerance` pixels
+    reference_edges = boundaries(reference)
+    kernel = np.ones((2 * tolerance + 1, 2 * tolerance + 1), dtype=np.uint8)
+    near = cv2.dilate(boundaries(labels).astype(np.uint8), kernel) > 0
+    return np.count_nonzero(near & reference_edges) / max(1, np.count_nonzero(reference_edges))
+
+def benchmark_slic_pyramid(sizes, superpixel_size=32, compactness=13, pyramid_levels=2, convergence_threshold=0.25):
+    # Full resolution SLIC against the coarse to fine mode, with the boundary recall of the pyramid
+    # labels measured against the full resolution labels
+    print(f"SLIC pyramid, superpixel_size={superpixel_size}, pyramid_levels={pyramid_levels}, "
+          f"convergence_threshold={convergence_threshold}")
+    print(f"{'size':>6} {'full s':>8} {'pyramid s':>10} {'speedup':>8} {'boundary recall':>16}")
+    for size in sizes:
+        slic_image = SLICImage(synthetic_normal_map(size), None)
+        start = time.perf_counter()
+        reference, _ = slic_image.slic(superpixel_size=superpixel_size, compactness=compactness)
+        full_time = time.perf_counter() - start
+        start = time.perf_counter()
+        labels, _ = slic_image.slic(superpixel_size=superpixel_size, compactness=compactness,
+                                    pyramid_levels=pyramid_levels, convergence_threshold=convergence_threshold)
+        pyramid_time = time.perf_counter() - start
+        print(f"{size:>6} {full_time:>8.2f} {pyramid_time:>10.2f} {full_time / pyramid_time:>7.1f}x "
+              f"{boundary_recall(reference, labels):>16.3f}")
+
+def benchmark_slic_seeds(sizes, superpixel_size=32, compactness=13, convergence_threshold=0.5, max_iterations=30):
+    # Iterations until no center moves more than convergence_threshold pixels, seeding on the plain
+    # grid against seeding at the lowest gradient of each seed's 3x3 neighbourhood
+    print(f"SLIC seeds, superpixel_size={superpixel_size}, convergence_threshold={convergence_threshold}")
+    print(f"{'image':>24} {'grid iterations':>16} {'perturbed iterations':>21}")
+    for name, image in input_normal_maps(sizes).items():
+        slic_image = SLICImage(image, None)
+        iterations = []
+        for perturb_seeds in (False, True):
+            slic_image.slic(superpixel_size=superpixel_size, num_iterations=max_iterations, compactness=compactness,
+                            convergence_threshold=convergence_threshold, perturb_seeds=perturb_seeds)
+            iterations.append(slic_image.iterations)
+        print(f"{name:>24} {iterations[0]:>16} {iterations[1]:>21}")
+
+def peak_memory(run):
+    # Peak of numpy allocations during run(), memory mapped files are not counted
+    tracemalloc.start()
+    try:
+        result = run()
+        return result, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def benchmark_kuwahara_tiled(sizes, method='gaussian', radius=15, strip_height=256):
+    # test_kuwahara.py checks that the tiles give the same image in bounded memory
+    print(f"Kuwahara {method}, radius={radius}, strip_height={strip_height}")
+    print(f"{'size':>6} {'whole s':>8} {'tiled s':>8}")
+    with tempfile.TemporaryDirectory() as directory:
+        input_path = os.path.join(directory, "input.npy")
+        output_path = os.path.join(directory, "output.npy")
+        for size in sizes:
+            image = np.array(synthetic_normal_map(size))
+            np.save(input_path, image)
+            del image
+
+            kuwahara_filter = Kuwahara(method=method, radius=radius)
+            whole_time = time_per_iteration(lambda n: kuwahara_filter.kuwahara(
+                np.load(input_path), method=method, radius=radius), 1)
+            tiled_time = time_per_iteration(lambda n: kuwahara_filter.apply_tiled(
+                input_path, output_path, strip_height=strip_height), 1)
+            print(f"{size:>6} {whole_time:>8.2f} {tiled_time:>8.2f}")
+
+def benchmark_kuwahara_anisotropic(sizes, radius=15):
+    # The flow field is computed up front, as it is shared with other filters
+    print(f"Kuwahara primary + secondary, radius={radius}")
+    print(f"{'size':>6} {'gaussian s':>11} {'anisotropic s':>14} {'ratio':>6}")
+    for size in sizes:
+        primary, secondary = synthetic_normal_map(size), synthetic_normal_map(size, seed=1)
+        flow = FlowDirection(primary)
+        flow.compute_flow()
+        gaussian = Kuwahara('gaussian', radius, primary, secondary)
+        anisotropic = Kuwahara('anisotropic', radius, primary, secondary, flow=flow)
+        gaussian_time = time_per_iteration(lambda n: gaussian.apply(), 1)
+        anisotropic_time = time_per_iteration(lambda n: anisotropic.apply(), 1)
+        print(f"{size:>6} {gaussian_time:>11.2f} {anisotropic_time:>14.2f} {anisotropic_time / gaussian_time:>5.1f}x")
+
+def box_filter_quadrants(image, image_2d, radius, avgs, stddevs):
+    # How the mean method computed its quadrants before the summed area tables
+    kxy = np.ones(radius + 1, dtype=np.float32) / (radius + 1)
+    squared = image_2d ** 2
+    avgs_2d = np.empty_like(stddevs)
+    for k, shift in enumerate([(0, 0), (0, radius), (radius, 0), (radius, radius)]):
+        cv2.sepFilter2D(image, -1, kxy, kxy, avgs[k], shift)
+        cv2.sepFilter2D(image_2d, -1, kxy, kxy, avgs_2d[k], shift)
+        cv2.sepFilter2D(squared, -1, kxy, kxy, stddevs[k], shift)
+        stddevs[k] -= avgs_2d[k] ** 2
+
+def benchmark_kuwahara_mean(sizes, radii=(3, 8, 15, 25, 40)):
+    # Quadrant means and variances of the mean method, which is where its time goes
+    print("Kuwahara mean quadrants, box filters vs summed area tables")
+    print(f"{'size':>6} {'radius':>7} {'box s':>7} {'table s':>8} {'speedup':>8}")
+    for size in sizes:
+        image = np.array(synthetic_normal_map(size)).astype(np.float32)
+        image_2d = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+        avgs = np.empty((4, *image.shape), dtype=np.float32)
+        stddevs = np.empty((4, *image.shape[:2]), dtype=np.float32)
+        for radius in radii:
+            box = time_per_iteration(lambda n: box_filter_quadrants(image, image_2d, radius, avgs, stddevs), 1)
+            table = time_per_iteration(lambda n: Kuwahara.integral_quadrants(image, image_2d, radius, avgs, stddevs), 1)
+            print(f"{size:>6} {radius:>7} {box:>7.3f} {table:>8.3f} {box / table:>7.1f}x")
+
+def benchmark_kuwahara_fused(sizes, methods=(('gaussian', 15), ('mean', 5), ('mean', 15)), num_secondaries=3):
+    # A primary and its secondaries filtered one image at a time, against all of them in one fused
+    # pass, with the 4 quadrant means or only the winning one
+    print(f"Kuwahara primary + {num_secondaries} secondaries, per image vs fused")
+    print(f"{'size':>6} {'method':>9} {'radius':>7} {'pass':>12} {'seconds':>8} {'peak MB':>8} {'identical':>9}")
+    for size in sizes:
+        primary = np.array(synthetic_normal_map(size))
+        secondaries = [np.array(synthetic_albedo_map(size, seed)) for seed in range(num_secondaries)]
+        for method, radius in methods:
+            kuwahara_filter = Kuwahara(method, radius)
+
+            def per_image():
+                outputs = [kuwahara_filter.kuwahara(primary, method=method, radius=radius)]
+                return outputs + [kuwahara_filter.kuwahara(secondary, method=method, radius=radius, primary=False)
+                                  for secondary in secondaries]
+
+            runs = [("per image", per_image)] + [
+                ("winner only" if winner_only else "fused", lambda winner_only=winner_only: kuwahara_filter.kuwahara_fused(
+                    [primary] + secondaries, method=method, radius=radius, winner_only=winner_only))
+                for winner_only in (False, True)]
+            reference = None
+            for name, run in runs:
+                seconds = time_per_iteration(lambda n: run(), 1)
+                outputs, peak = peak_memory(run)
+                reference = reference or outputs
+                identical = all(np.array_equal(a, b) for a, b in zip(reference, outputs))
+                print(f"{size:>6} {method:>9} {radius:>7} {name:>12} {seconds:>8.2f} {peak / 2**20:>8.1f} {str(identical):>9}")
+
+def benchmark_paint_placement(sizes, brush_sizes=(6, 40, 80), fractions=(0.1, 0.25, 0.5, 1.0)):
+    # Grid placement against the error placement with stroke budgets of `fractions` of the smallest
+    # brush's cells. The error is the mean Lab distance between the painting and the image.
+    print(f"LayeredPaint stroke placement, brush_sizes={brush_sizes}")
+    print(f"{'size':>6} {'placement':>10} {'budget':>8} {'strokes':>8} {'plan s':>7} {'draw s':>7} {'error':>7}")
+    for size in sizes:
+        image = synthetic_normal_map(size)
+        flow = FlowDirection(image)
+        flow.compute_flow()
+        reference = rgb2lab(np.array(image))
+        num_cells = (-(-size // min(brush_sizes))) ** 2
+        for placement, budget in [("grid", None)] + [("error", int(fraction * num_cells)) for fraction in fractions]:
+            layered_paint = LayeredPaintImage(image, None)
+            layered_paint.set_flow_map(flow)
+            layered_paint.set_brush_sizes(*brush_sizes)
+            layered_paint.set_placement(placement, budget)
+            start = time.perf_counter()
+            layers = layered_paint.plan()
+            plan_time = time.perf_counter() - start
+            start = time.perf_counter()
+            painted, _ = layered_paint.paint(layers)
+            draw_time = time.perf_counter() - start
+            strokes = sum(np.count_nonzero(layer.dabs.step == 0) for layer in layers)
+            error = np.linalg.norm(rgb2lab(np.array(painted)) - reference, axis=2).mean()
+            print(f"{size:>6} {placement:>10} {str(budget or ''):>8} {strokes:>8} {plan_time:>7.2f} {draw_time:>7.2f} {error:>7.2f}")
+
+def benchmark_paint_tiles(sizes, brush_sizes=(6, 40, 80), tile_height=256):
+    # LayeredPaint planned and drawn in tiles on process pools of increasing size, against the
+    # serial paint, also checking that the painting doesn't change with the number of workers
+    print(f"LayeredPaint tiles, brush_sizes={brush_sizes}, tile_height={tile_height}, {os.cpu_count()} cpus")
+    print(f"{'size':>6} {'workers':>8} {'s':>7} {'speedup':>8} {'identical':>10}")
+    worker_counts = sorted({1, 2, 4, 8, 16, os.cpu_count() or 1})
+    for size in sizes:
+        primary, secondary = synthetic_normal_map(size), synthetic_albedo_map(size)
+        flow = FlowDirection(primary)
+        flow.compute_flow()
+        def paint(executor):
+            layered_paint = LayeredPaintImage(primary, secondary)
+            layered_paint.set_flow_map(flow)
+            layered_paint.set_brush_sizes(*brush_sizes)
+            start = time.perf_counter()
+            painted = layered_paint.paint(executor=executor, tile_height=tile_height)
+            return [np.asarray(image) for image in painted], time.perf_counter() - start
+        reference, serial_time = paint(None)
+        print(f"{size:>6} {'serial':>8} {serial_time:>7.2f}")
+        for workers in worker_counts:
+            with ProcessPoolExecutor(workers) as executor:
+                # The first task starts the workers, which isn't part of the painting
+                executor.submit(int).result()
+                painted, seconds = paint(executor)
+            identical = all(np.array_equal(a, b) for a, b in zip(reference, painted))
+            print(f"{size:>6} {workers:>8} {seconds:>7.2f} {serial_time / seconds:>7.1f}x {str(identical):>10}")
+
+def benchmark_structure_tensor(sizes):
+    # Also prints eigen_errors, test_flow_direction.py checks them
+    print("Structure tensor eigen decomposition")
+    print(f"{'size':>6} {'eigh s':>8} {'closed s':>9} {'speedup':>8} {'eigenvalue err':>15} {'tangent err':>12}")
+    for size in sizes:
+        Jxx, Jxy, Jyy = structure_tensor(FlowDirection(synthetic_normal_map(size)).lab_image[..., 0])
+        start = time.perf_counter()
+        eigenvalues, eigenvectors = eigh_2x2(Jxx, Jxy, Jyy)
+        eigh_time = time.perf_counter() - start
+        start = time.perf_counter()
+        symmetric_eigen_2x2(Jxx, Jxy, Jyy)
+        closed_time = time.perf_counter() - start
+
+        eigenvalue_error, tangent_error = eigen_errors(Jxx, Jxy, Jyy, eigenvalues, eigenvectors)
+        print(f"{size:>6} {eigh_time:>8.3f} {closed_time:>9.3f} {eigh_time / closed_time:>7.1f}x "
+              f"{eigenvalue_error:>15.2e} {tangent_error:>12.2e}")
+
+def benchmark_blur_pyramid(sizes, brush_sizes=(6, 40, 80)):
+    # The blurs LayeredPaint needs, in RGB and Lab: a PIL gaussian blur and rgb2lab per brush size
+    # like it used to, against a BlurPyramid. Errors are the mean and largest differences of the Lab
+    # images to an exact gaussian blur (cv2 at full size, float32).
+    print(f"Blur pyramid, brush_sizes={brush_sizes}")
+    print(f"{'size':>6} {'PIL s':>7} {'pyramid s':>10} {'speedup':>8} {'PIL err':>15} {'pyramid err':>15}")
+    for size in sizes:
+        image = synthetic_normal_map(size)
+        sigmas = [brush_size * BLUR_FACTOR for brush_size in brush_sizes]
+        start = time.perf_counter()
+        pil_labs = [rgb2lab(np.array(image.filter(ImageFilter.GaussianBlur(sigma)))) for sigma in sigmas]
+        pil_time = time.perf_counter() - start
+        start = time.perf_counter()
+        pyramid = BlurPyramid(np.asarray(image))
+        pyramid_labs = []
+        for sigma in sigmas:
+            pyramid.rgb(sigma)
+            pyramid_labs.append(pyramid.lab(sigma))
+        pyramid_time = time.perf_counter() - start
+
+        exact_labs = [rgb2lab(cv2.GaussianBlur(np.asarray(image, dtype=np.float32), (0, 0), sigma)) for sigma in sigmas]
+        def error(labs):
+            differences = [np.linalg.norm(lab - exact, axis=2) for lab, exact in zip(labs, exact_labs)]
+            return f"{np.mean([d.mean() for d in differences]):.3f} / {max(d.max() for d in differences):.1f}"
+        print(f"{size:>6} {pil_time:>7.3f} {pyramid_time:>10.3f} {pil_time / pyramid_time:>7.1f}x "
+              f"{error(pil_labs):>15} {error(pyramid_labs):>15}")
+
+def benchmark_image_io(sizes):
+    # Loading a PNG with Pillow against image_io (decoding it, then mapping it from the cache as later
+    # loads do), and saving it with Pillow against streaming it with write_png, 8-bit and 16-bit
+    print("Image I/O")
+    print(f"{'size':>6} {'bits':>5} {'PIL load s':>11} {'decode s':>9} {'mapped s':>9} {'PIL save s':>11} "
+          f"{'write_png s':>12} {'PIL MB':>7} {'png MB':>7}")
+    for size in sizes:
+        albedo = np.asarray(synthetic_albedo_map(size))
+        for bits, array in ((8, albedo), (16, albedo.astype(np.uint16) * 257)):
+            with tempfile.TemporaryDirectory() as directory:
+                path, pil_path = os.path.join(directory, "image.png"), os.path.join(directory, "pil.png")
+                start = time.perf_counter()
+                write_png(path, array)
+                write_time = time.perf_counter() - start
+                # Pillow can only hold 16-bit gray images, so it saves the 8-bit image either way
+                start = time.perf_counter()
+                Image.fromarray(albedo).save(pil_path)
+                pil_save_time = time.perf_counter() - start
+
+                start = time.perf_counter()
+                image = Image.open(path)
+                image.load()
+                pil_load_time = time.perf_counter() - start
+                start = time.perf_counter()
+                decoded = read_image(path)
+                decode_time = time.perf_counter() - start
+                assert np.array_equal(decoded, array)
+                cache = ResultCache(os.path.join(directory, "cache"))
+                decoded_image(path, cache)
+                start = time.perf_counter()
+                mapped = decoded_image(path, cache)
+                mapped_time = time.perf_counter() - start
+                del mapped
+                print(f"{size:>6} {bits:>5} {pil_load_time:>11.3f} {decode_time:>9.3f} {mapped_time:>9.4f} "
+                      f"{pil_save_time:>11.3f} {write_time:>12.3f} {os.path.getsize(pil_path) / 2**20:>7.1f} "
+                      f"{os.path.getsize(path) / 2**20:>7.1f}")
+
+def benchmark_compact_flow(sizes):
+    # Memory of the full flow against the compact one LayeredPaint keeps, the time to save it and to
+    # memory map it back, and how far its tangents are from the full ones
+    print("Compact flow field")
+    print(f"{'size':>6} {'full MB':>8} {'compact MB':>11} {'compact s':>10} {'save s':>7} {'map s':>7} {'tangent err':>12}")
+    for size in sizes:
+        flow = FlowDirection(synthetic_normal_map(size))
+        flow.compute_flow()
+        full_bytes = flow.eigenvalues.nbytes + flow.tangents.nbytes + flow.angles.nbytes
+        start = time.perf_counter()
+        compact = flow.compact_flow()
+        compact_time = time.perf_counter() - start
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "flow.npy")
+            start = time.perf_counter()
+            save_flow(compact, path)
+            save_time = time.perf_counter() - start
+            start = time.perf_counter()
+            mapped = load_flow(path)
+            map_time = time.perf_counter() - start
+            ys, xs = np.indices(mapped.shape)
+            dx, dy = mapped.tangents(ys, xs)
+            tangent_error = max(np.abs(dx - flow.tangents[..., 0]).max(), np.abs(dy - flow.tangents[..., 1]).max())
+            del mapped
+        compact_bytes = compact.angles.nbytes + compact.log_intensities.nbytes
+        print(f"{size:>6} {full_bytes / 2**20:>8.1f} {compact_bytes / 2**20:>11.1f} {compact_time:>10.3f} "
+              f"{save_time:>7.3f} {map_time:>7.4f} {tangent_error:>12.2e}")
+
+# Suite cases: each takes the primary (normal) and secondary (albedo) images plus its parameters,
+# does the setup that shouldn't be timed and returns the function to time, whose result is hashed
+# so that a change of output shows up in the comparison too
+
+def suite_slic(primary, secondary, superpixel_size=32, pyramid_levels=0):
+    slic_image = SLICImage(primary, None)
+    return lambda: slic_image.slic(superpixel_size=superpixel_size, compactness=13, enforce_connectivity=True,
+                                   pyramid_levels=pyramid_levels)[0]
+
+def suite_draw_splots(primary, secondary, superpixel_size=32):
+    labels, _ = SLICImage(primary, None).slic(superpixel_size=superpixel_size, compactness=13, enforce_connectivity=True)
+    def run():
+        slic_image = SLICImage(secondary.copy(), None)
+        slic_image.draw_splots(labels)
+        return np.asarray(slic_image.image)
+    return run
+
+def suite_layered_paint(primary, secondary, brush_sizes=(6, 40, 80), brush="rough2", placement="grid"):
+    flow = FlowDirection(primary)
+    flow.compute_flow()
+    def run():
+        layered_paint = LayeredPaintImage(primary, secondary, brush=brush)
+        layered_paint.set_flow_map(flow)
+        layered_paint.set_brush_sizes(*brush_sizes)
+        layered_paint.set_placement(placement)
+        return [np.asarray(image) for image in layered_paint.paint()]
+    return run
+
+def suite_kuwahara(primary, secondary, method='gaussian', radius=15):
+    def run():
+        kuwahara = Kuwahara(method, radius, primary, secondary)
+        kuwahara.apply()
+        return [kuwahara.output_primary, kuwahara.output_secondary]
+    return run
+
+def suite_compute_flow(primary, secondary):
+    def run():
+        flow = FlowDirection(primary)
+        flow.compute_flow()
+        return [flow.eigenvalues, flow.tangents]
+    return run
+
+class SuiteCase(NamedTuple):
+    name: str
+    setup: object
+    params: dict
+
+SUITE_CASES = [
+    SuiteCase("slic", suite_slic, {"superpixel_size": 16}),
+    SuiteCase("slic", suite_slic, {"superpixel_size": 32}),
+    SuiteCase("slic", suite_slic, {"superpixel_size": 64}),
+    SuiteCase("slic", suite_slic, {"superpixel_size": 32, "pyramid_levels": 2}),
+    SuiteCase("draw_splots", suite_draw_splots, {"superpixel_size": 32}),
+    SuiteCase("layered_paint", suite_layered_paint, {"brush_sizes": (6, 40, 80)}),
+    SuiteCase("layered_paint", suite_layered_paint, {"brush_sizes": (4, 16)}),
+    SuiteCase("layered_paint", suite_layered_paint, {"brush_sizes": (6, 40, 80), "placement": "error"}),
+    SuiteCase("kuwahara", suite_kuwahara, {"method": "mean", "radius": 8}),
+    SuiteCase("kuwahara", suite_kuwahara, {"method": "mean", "radius": 25}),
+    SuiteCase("kuwahara", suite_kuwahara, {"method": "gaussian", "radius": 15}),
+    SuiteCase("kuwahara", suite_kuwahara, {"method": "anisotropic", "radius": 15}),
+    SuiteCase("compute_flow", suite_compute_flow, {}),
+]
+
+class SuiteResult(NamedTuple):
+    seconds: float # fastest of the timed runs
+    peak_mb: float # peak of numpy allocations, from a separate traced run
+    mpx_per_s: float
+    output_key: str
+
+def case_id(case, size):
+    params = " ".join(f"{name}={value}" for name, value in case.params.items())
+    return f"{case.name} {params} {size}".replace("  ", " ")
+
+def run_case(case, primary, secondary, repeats, min_seconds=1.0):
+    # Fast cases are repeated until they took min_seconds in total, so their best time is stable too
+    run = case.setup(primary, secondary, **case.params)
+    # Lab conversions and blurs are cached between calls, every run starts without them to do the same work
+    clear_lab_cache()
+    clear_pyramid_cache()
+    output, peak = peak_memory(run)
+    seconds = []
+    while len(seconds) < repeats or (sum(seconds) < min_seconds and len(seconds) < 100):
+        clear_lab_cache()
+        clear_pyramid_cache()
+        start = time.perf_counter()
+        run()
+        seconds.append(time.perf_counter() - start)
+    outputs = output if isinstance(output, list) else [output]
+    output_key = content_key(np.concatenate([np.asarray(o).ravel().view(np.uint8) for o in outputs if o is not None]))
+    num_pixels = primary.size[0] * primary.size[1]
+    return SuiteResult(min(seconds), peak / 2**20, num_pixels / min(seconds) / 1e6, output_key)
+
+def machine_description():
+    return {"platform": platform.platform(), "processor": platform.processor(), "cpus": os.cpu_count(),
+            "python": platform.python_version(), "numpy": np.__version__, "opencv": cv2.__version__}
+
+# Timing differences below this many seconds are noise, whatever the ratio
+MIN_TIME_DIFFERENCE = 0.005
+
+def compare_to_baseline(results, baseline, time_tolerance, memory_tolerance):
+    # Returns the ids of the cases that got slower, used more memory or changed their output
+    if baseline["machine"] != machine_description():
+        print("The baseline was saved on a different machine or library versions, timings may not compare")
+    regressions = []
+    print(f"{'case':<52} {'baseline s':>11} {'s':>8} {'ratio':>6} {'baseline MB':>12} {'MB':>8}")
+    for name, result in results.items():
+        base = baseline["results"].get(name)
+        if base is None:
+            print(f"{name:<52} {'':>11} {result.seconds:>8.3f} {'new':>6}")
+            continue
+        problems = []
+        if result.seconds > base["seconds"] * (1 + time_tolerance) + MIN_TIME_DIFFERENCE:
+            problems.append("slower")
+        if result.peak_mb > base["peak_mb"] * (1 + memory_tolerance):
+            problems.append("more memory")
+        if result.output_key != base["output_key"]:
+            problems.append("output changed")
+        if problems:
+            regressions.append(name)
+        print(f"{name:<52} {base['seconds']:>11.3f} {result.seconds:>8.3f} {result.seconds / base['seconds']:>5.2f}x "
+              f"{base['peak_mb']:>12.1f} {result.peak_mb:>8.1f} {', '.join(problems)}")
+    return regressions
+
+def benchmark_suite(sizes, repeats=3, baseline_path=BASELINE_PATH, save_baseline=False,
+                    time_tolerance=0.15, memory_tolerance=0.10):
+    # Every SUITE_CASES case at every size on the same seeded synthetic maps, so runs are comparable.
+    # Times are the fastest of `repeats` runs. With save_baseline the results are written to
+    # baseline_path, otherwise they are compared with it and the regressions are returned:
+    # cases more than time_tolerance slower, using memory_tolerance more memory, or with a
+    # different output.
+    print(f"Benchmark suite, best of {repeats}")
+    print(f"{'case':<52} {'s':>8} {'Mpx/s':>7} {'peak MB':>8}")
+    results = {}
+    for size in sizes:
+        primary, secondary = synthetic_normal_map(size), synthetic_albedo_map(size)
+        for case in SUITE_CASES:
+            name = case_id(case, size)
+            result = run_case(case, primary, secondary, repeats)
+            results[name] = result
+            print(f"{name:<52} {result.seconds:>8.3f} {result.mpx_per_s:>7.2f} {result.peak_mb:>8.1f}")
+
+    if save_baseline:
+        baseline = {"machine": machine_description(), "results": {}}
+        if os.path.exists(baseline_path):
+            with open(baseline_path) as file:
+                baseline["results"] = json.load(file)["results"]
+        # Sizes that weren't run keep their previous baseline
+        baseline["results"].update({name: result._asdict() for name, result in results.items()})
+        with open(baseline_path, "w") as file:
+            json.dump(baseline, file, indent=1)
+        print(f"Saved baseline to {baseline_path}")
+        return []
+    if not os.path.exists(baseline_path):
+        print(f"No baseline at {baseline_path}, save one with --save-baseline")
+        return []
+    with open(baseline_path) as file:
+        baseline = json.load(file)
+    print()
+    regressions = compare_to_baseline(results, baseline, time_tolerance, memory_tolerance)
+    print(f"{len(regressions)} regressions" + (": " + ", ".join(regressions) if regressions else ""))
+    return regressions
+
+BENCHMARKS = {
+    "slic": benchmark_slic,
+    "slic_pyramid": benchmark_slic_pyramid,
+    "slic_seeds": benchmark_slic_seeds,
+    "kuwahara_tiled": benchmark_kuwahara_tiled,
+    "kuwahara_anisotropic": benchmark_kuwahara_anisotropic,
+    "kuwahara_mean": benchmark_kuwahara_mean,
+    "kuwahara_fused": benchmark_kuwahara_fused,
+    "paint_placement": benchmark_paint_placement,
+    "paint_tiles": benchmark_paint_tiles,
+    "structure_tensor": benchmark_structure_tensor,
+    "compact_flow": benchmark_compact_flow,
+    "blur_pyramid": benchmark_blur_pyramid,
+    "image_io": benchmark_image_io,
+    "suite": benchmark_suite,
+}
+
+if __name__ == "__main__":
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    options = [arg for arg in sys.argv[1:] if arg.startswith("--")]
+    if not args or args[0] not in BENCHMARKS:
+        print(f"usage: python benchmark.py <{'|'.join(BENCHMARKS)}> [sizes...] [options]")
+        sys.exit(2)
+    name = args.pop(0)
+    sizes = [int(arg) for arg in args]
+    regressions = []
+    if name == "suite":
+        # --save-baseline, --baseline=path, --tolerance=fraction of the baseline time
+        values = dict(option[2:].split("=", 1) for option in options if "=" in option)
+        regressions = benchmark_suite(sizes or SUITE_SIZES, baseline_path=values.get("baseline", BASELINE_PATH),
+                                      save_baseline="--save-baseline" in options,
+                                      time_tolerance=float(values.get("tolerance", 0.15)))
+    else:
+        BENCHMARKS[name](sizes or [1024, 2048, 4096])
+    sys.exit(1 if regressions else 0)
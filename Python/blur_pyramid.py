@@ -0,0 +1,99 @@
+# Gaussian blurs of an image at several sigmas, in RGB and Lab float32
+# LayeredPaint takes its stroke colors and reference Lab images from a blur of the primary per brush
+# size. Here every blur is derived from work already done for another one:
+#   small sigmas are blurred at full resolution, each from the largest smaller one already computed,
+#   by sqrt(sigma^2 - previous^2)
+#   larger ones are blurred on the level of a 2x image pyramid (cv2.pyrDown) where they are still at
+#   least MIN_REDUCED_SIGMA pixels wide, converted to Lab there, and only scaled back up when asked
+#   for, so their cost barely depends on the sigma
+# Pyramids are kept for the last few images by content, so painting the same primary again, with
+# other brush sizes or placements, reuses its levels.
+
+from collections import OrderedDict
+import math
+import numpy as np
+import cv2
+from color import rgb2lab, content_key
+
+MIN_REDUCED_SIGMA = 4.0
+PYRAMID_CACHE_SIZE = 2
+pyramid_cache = OrderedDict()
+
+class BlurPyramid:
+
+    def __init__(self, array):
+        # (H, W, C) image, any dtype in the 0-255 range
+        self.array = array
+        self.shape = array.shape
+        # Halvings 1, 2, ... of the image, the full size float copy isn't kept
+        self.reductions = []
+        # sigma: (reduction, variance in reduced pixels, RGB, Lab), RGB and Lab at the reduction's size
+        self.levels = {}
+
+    def reduction(self, k):
+        # The image halved k times as float32, halving i blurs by a variance of 4^i original pixels
+        if k == 0:
+            return self.array.astype(np.float32)
+        while len(self.reductions) < k:
+            self.reductions.append(cv2.pyrDown(self.reductions[-1] if self.reductions else self.reduction(0)))
+        return self.reductions[k - 1]
+
+    def level(self, sigma):
+        if sigma in self.levels:
+            return self.levels[sigma]
+        k = max(0, math.floor(math.log2(sigma / MIN_REDUCED_SIGMA))) if sigma > 0 else 0
+        scale = 2 ** k
+        # What is left to blur once the halvings and the bilinear scaling back up (a triangle
+        # filter of variance scale^2 / 6) are taken into account, in reduced pixels
+        variance = sigma ** 2 - (4 ** k - 1) / 3 - (scale ** 2 / 6 if k else 0)
+        variance = max(0.0, variance) / scale ** 2
+
+        # Start from the most blurred level already computed on the same reduction
+        previous = [level for level in self.levels.values() if level[0] == k and level[1] <= variance]
+        source, source_variance = self.reduction(k), 0.0
+        if previous:
+            _, source_variance, source, _ = max(previous, key=lambda level: level[1])
+        rgb = source
+        if variance > source_variance:
+            rgb = cv2.GaussianBlur(source, (0, 0), math.sqrt(variance - source_variance))
+        lab = rgb2lab(rgb)
+        for array in (rgb, lab):
+            array.flags.writeable = False
+        self.levels[sigma] = (k, variance, rgb, lab)
+        return self.levels[sigma]
+
+    def rgb(self, sigma):
+        # (H, W, C) float32, shared and read only
+        k, _, rgb, _ = self.level(sigma)
+        return self.upscale(rgb, k)
+
+    def lab(self, sigma):
+        # (H, W, 3) float32, shared and read only
+        k, _, _, lab = self.level(sigma)
+        return self.upscale(lab, k)
+
+    def upscale(self, array, k):
+        if k == 0:
+            return array
+        # Pixel i of reduction k sits on original pixel i * 2^k, which cv2.resize doesn't align to
+        scale = 2 ** k
+        matrix = np.array([[1 / scale, 0, 0], [0, 1 / scale, 0]], dtype=np.float64)
+        upscaled = cv2.warpAffine(array, matrix, (self.shape[1], self.shape[0]),
+                                  flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP, borderMode=cv2.BORDER_REPLICATE)
+        return upscaled.reshape(*self.shape[:2], -1)
+
+def blur_pyramid(array):
+    # The BlurPyramid of an image, shared with earlier calls on identical pixels
+    key = content_key(array)
+    pyramid = pyramid_cache.get(key)
+    if pyramid is None:
+        pyramid = BlurPyramid(array)
+        pyramid_cache[key] = pyramid
+        while len(pyramid_cache) > PYRAMID_CACHE_SIZE:
+            pyramid_cache.popitem(last=False)
+    else:
+        pyramid_cache.move_to_end(key)
+    return pyramid
+
+def clear_pyramid_cache():
+    pyramid_cache.clear()
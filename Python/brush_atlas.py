@@ -0,0 +1,134 @@
+# Pre-scaled, pre-rotated brush masks
+# Rescaling and rotating a brush for every size and direction is the same work on every paint() call,
+# so the masks are kept as one contiguous (num_directions, size, size) uint8 array per
+# brush / size / num_directions, in memory and optionally in .npz files on disk.
+
+from collections import OrderedDict
+from PIL import Image
+import numpy as np
+import os
+import tempfile
+from color import content_key
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+BRUSHES_DIR = os.path.join(script_dir, "Brushes")
+BRUSH_NAMES = ["normal", "paint1", "rough1", "rough2"]
+
+ATLAS_CACHE_SIZE = 32
+
+class Brush:
+
+    def __init__(self, image: Image.Image, name: str = None):
+        self.image = image.convert("L")
+        self.name = name
+        # Identifies the brush pixels, so cached masks of an edited brush file are not reused
+        self.key = content_key(np.array(self.image))
+
+    def get_bitmap_for_size(self, size: int):
+        scaled_image = self.image.resize((size, size))
+        return scaled_image
+
+    def get_rotated_bitmaps(self, size: int, angle: float, num_directions: int = 8):
+        scaled_image = self.get_bitmap_for_size(size)
+        bitmaps = []
+        for i in range(num_directions):
+            rotated = scaled_image.rotate(angle + i * (360 / num_directions), resample=Image.BILINEAR)
+            bitmaps.append(rotated)
+        return bitmaps
+
+    def get_rotated_masks(self, size: int, num_directions: int = 8):
+        # The rotated bitmaps as one (num_directions, size, size) uint8 array
+        bitmaps = self.get_rotated_bitmaps(size, 0, num_directions=num_directions)
+        return np.ascontiguousarray(np.stack([np.array(bitmap) for bitmap in bitmaps]))
+
+class BrushAtlas:
+    # Loads brushes from the Brushes folder once and hands out their rotated masks.
+    # Masks are kept in an LRU of `max_entries` arrays; with a `cache_dir` they are also
+    # written to and read from .npz files there, so separate runs share them too.
+    # Returned masks are shared between callers and read only.
+
+    def __init__(self, cache_dir: str = None, brushes_dir: str = BRUSHES_DIR, max_entries: int = ATLAS_CACHE_SIZE):
+        self.cache_dir = cache_dir
+        self.brushes_dir = brushes_dir
+        self.max_entries = max_entries
+        self.brushes = {}
+        self.masks = OrderedDict()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def get_brush(self, name: str):
+        brush = self.brushes.get(name)
+        if brush is None:
+            brush_path = os.path.join(self.brushes_dir, f"{name}.png")
+            if not os.path.exists(brush_path):
+                raise FileNotFoundError(f"Brush not found: {brush_path}")
+            brush = Brush(Image.open(brush_path), name)
+            self.brushes[name] = brush
+        return brush
+
+    def get_rotated_masks(self, brush, size: int, num_directions: int = 8):
+        # `brush` is a Brush or the name of one in the Brushes folder
+        if isinstance(brush, str):
+            brush = self.get_brush(brush)
+        key = (brush.key, size, num_directions)
+        masks = self.masks.get(key)
+        if masks is not None:
+            self.masks.move_to_end(key)
+            return masks
+
+        masks = self.load(brush, size, num_directions)
+        if masks is None:
+            masks = brush.get_rotated_masks(size, num_directions)
+            self.save(brush, size, num_directions, masks)
+        masks.flags.writeable = False
+        self.masks[key] = masks
+        while len(self.masks) > self.max_entries:
+            self.masks.popitem(last=False)
+        return masks
+
+    def preload(self, sizes, num_directions: int = 8, names=BRUSH_NAMES):
+        # Builds the masks of every brush in `names` for every size, e.g. before a batch run
+        for name in names:
+            for size in sizes:
+                self.get_rotated_masks(name, size, num_directions)
+
+    def clear(self):
+        # Only the in-memory cache, files in cache_dir are kept
+        self.masks.clear()
+        self.brushes.clear()
+
+    def cache_path(self, brush, size, num_directions):
+        name = brush.name or "brush"
+        return os.path.join(self.cache_dir, f"{name}_{size}_{num_directions}_{brush.key[:16]}.npz")
+
+    def load(self, brush, size, num_directions):
+        if self.cache_dir is None:
+            return None
+        path = self.cache_path(brush, size, num_directions)
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as data:
+                masks = data["masks"]
+        except (OSError, ValueError, KeyError):
+            # Unreadable or truncated file, it is rebuilt and overwritten
+            return None
+        if masks.shape != (num_directions, size, size) or masks.dtype != np.uint8:
+            return None
+        return np.ascontiguousarray(masks)
+
+    def save(self, brush, size, num_directions, masks):
+        if self.cache_dir is None:
+            return
+        # Written next to the final file and renamed, so a concurrent reader never sees half of it
+        handle, temp_path = tempfile.mkstemp(suffix=".npz", dir=self.cache_dir)
+        try:
+            with os.fdopen(handle, "wb") as file:
+                np.savez(file, masks=masks)
+            os.replace(temp_path, self.cache_path(brush, size, num_directions))
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+# Shared by every LayeredPaintImage that isn't given its own atlas
+default_atlas = BrushAtlas()
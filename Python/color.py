@@ -0,0 +1,95 @@
+# Color space conversions shared by the filters
+
+from collections import OrderedDict
+import hashlib
+import numpy as np
+from profiling import span, count
+
+# sRGB -> linear for every 8 bit value, so uint8 images skip the power function entirely
+SRGB_TO_LINEAR = np.arange(256, dtype=np.float64) / 255.0
+SRGB_TO_LINEAR = np.where(
+    SRGB_TO_LINEAR > 0.04045,
+    ((SRGB_TO_LINEAR + 0.055) / 1.055) ** 2.4,
+    SRGB_TO_LINEAR / 12.92,
+).astype(np.float32)
+
+# sRGB D65 linear -> XYZ, with each row already divided by the reference white
+LINEAR_TO_XYZ = (np.array([
+    [0.4124, 0.3576, 0.1805],
+    [0.2126, 0.7152, 0.0722],
+    [0.0193, 0.1192, 0.9505],
+]) * 100 / np.array([[95.047], [100.0], [108.883]])).astype(np.float32)
+
+LAB_CACHE_SIZE = 8
+lab_cache = OrderedDict()
+
+def srgb_to_linear(rgb, out=None):
+    # Only the first 3 channels are converted, so RGBA input is fine
+    rgb = rgb[..., 0:3]
+    if rgb.dtype == np.uint8:
+        return np.take(SRGB_TO_LINEAR, rgb, out=out)
+    if out is None:
+        out = np.empty(rgb.shape, dtype=np.float32)
+    np.divide(rgb, 255.0, out=out)
+    low = out <= 0.04045
+    linear_low = out / 12.92
+    out += 0.055
+    out /= 1.055
+    np.power(out, 2.4, out=out)
+    np.copyto(out, linear_low, where=low)
+    return out
+
+def rgb2lab(rgb, out=None, cache=False):
+    # Converts from rgb color space to CIELAB (lightness, color a, color b) color space
+    # Accepts uint8 (fast path) or float images in the 0-255 range and returns float32.
+    # `out` can be a preallocated (H, W, 3) float32 array to write into.
+    # With `cache`, conversions of identical pixel data are looked up instead of recomputed;
+    # the returned array is then shared and read only.
+    rgb = np.asarray(rgb)
+    if cache:
+        key = content_key(rgb)
+        lab = lab_cache.get(key)
+        if lab is None:
+            lab = rgb2lab(rgb)
+            lab.flags.writeable = False
+            lab_cache[key] = lab
+            while len(lab_cache) > LAB_CACHE_SIZE:
+                lab_cache.popitem(last=False)
+        else:
+            lab_cache.move_to_end(key)
+            count("rgb2lab cache hits")
+        if out is None:
+            return lab
+        np.copyto(out, lab)
+        return out
+
+    with span("rgb2lab"):
+        count("rgb2lab pixels", rgb.size // rgb.shape[-1])
+        if out is None:
+            out = np.empty((*rgb.shape[:-1], 3), dtype=np.float32)
+        linear = srgb_to_linear(rgb)
+        xyz = np.matmul(linear, LINEAR_TO_XYZ.T, out=linear)
+
+        # f(t) = cbrt(t), linear near black
+        f = np.cbrt(xyz)
+        low = xyz <= 0.008856
+        xyz *= 7.787
+        xyz += 16 / 116
+        np.copyto(f, xyz, where=low)
+
+        fx, fy, fz = f[..., 0], f[..., 1], f[..., 2]
+        np.multiply(fy, 116, out=out[..., 0])
+        out[..., 0] -= 16
+        np.subtract(fx, fy, out=out[..., 1])
+        out[..., 1] *= 500
+        np.subtract(fy, fz, out=out[..., 2])
+        out[..., 2] *= 200
+        return out
+
+def clear_lab_cache():
+    lab_cache.clear()
+
+def content_key(array):
+    digest = hashlib.blake2b(np.ascontiguousarray(array).data, digest_size=16)
+    digest.update(repr((array.shape, array.dtype.str)).encode())
+    return digest.hexdigest()
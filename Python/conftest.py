@@ -0,0 +1,48 @@
+# Shared pytest fixtures: small synthetic maps of odd sizes, and a brush atlas that doesn't need the
+# Git LFS brushes
+
+from PIL import Image
+import numpy as np
+import pytest
+from brush_atlas import BrushAtlas
+
+def normal_map(height, width, seed=0):
+    # Object space normals of a few overlapping spheres, with some noise
+    rng = np.random.default_rng(seed)
+    ys, xs = np.mgrid[0:height, 0:width].astype(np.float32)
+    normals = np.zeros((height, width, 3), dtype=np.float32)
+    normals[..., 2] = 1.0
+    for _ in range(4):
+        cx, cy, r = rng.uniform(0, width), rng.uniform(0, height), rng.uniform(0.2, 0.4) * min(height, width)
+        dx, dy = (xs - cx) / r, (ys - cy) / r
+        inside = dx * dx + dy * dy < 1
+        normals[inside, 0] = dx[inside]
+        normals[inside, 1] = dy[inside]
+        normals[inside, 2] = np.sqrt(1 - dx[inside] ** 2 - dy[inside] ** 2)
+    normals += rng.normal(0, 0.02, normals.shape).astype(np.float32)
+    return np.clip((normals + 1.0) / 2.0 * 255, 0, 255).astype(np.uint8)
+
+def albedo_map(height, width, seed=0):
+    # Flat patches of color with a little noise
+    rng = np.random.default_rng(seed)
+    patches = rng.integers(0, 256, (5, 5, 3), dtype=np.uint8)
+    rgb = patches[np.arange(height) * 5 // height][:, np.arange(width) * 5 // width].astype(np.int16)
+    rgb += rng.integers(-4, 5, rgb.shape, dtype=np.int16)
+    return np.clip(rgb, 0, 255).astype(np.uint8)
+
+@pytest.fixture
+def primary():
+    return Image.fromarray(normal_map(101, 83))
+
+@pytest.fixture
+def secondary():
+    return Image.fromarray(albedo_map(101, 83, seed=1))
+
+@pytest.fixture(scope="session")
+def atlas(tmp_path_factory):
+    # An atlas whose "rough2" brush is a soft, slightly lopsided blob, so rotations differ
+    brushes_dir = tmp_path_factory.mktemp("Brushes")
+    ys, xs = np.mgrid[-1:1:64j, -1:1:64j]
+    blob = np.clip(1.2 - np.hypot(xs * 1.4, ys + 0.2 * xs), 0, 1)
+    Image.fromarray((blob * 255).astype(np.uint8)).save(brushes_dir / "rough2.png")
+    return BrushAtlas(brushes_dir=str(brushes_dir))
@@ -3,15 +3,43 @@
 from PIL import Image, ImageDraw, ImageFilter
 import math
 import numpy as np
-from typing import List, Tuple, NamedTuple
-from functools import lru_cache
+from color import rgb2lab
+from profiling import span, count
+from typing import NamedTuple
 import cv2
 
+# Steps of the compact flow's angles over a full turn. A multiple of the 16 brush directions, so the
+# brush direction of an angle is exact.
+ANGLE_STEPS = 2**16
+COMPACT_FLOW_DTYPE = np.dtype([("angle", "<u2"), ("log_intensity", "<f2")])
+
+class CompactFlow(NamedTuple):
+    # What LayeredPaint strokes follow, 4 bytes per pixel instead of the 20 of the full decomposition
+    angles: np.ndarray # uint16, direction of the tangent in steps of 360 / ANGLE_STEPS degrees, rounded down
+    log_intensities: np.ndarray # float16, log of the smallest eigenvalue (at least 1e-6)
+
+    @property
+    def shape(self):
+        return self.angles.shape
+
+    def rows(self, top, bottom):
+        return CompactFlow(self.angles[top:bottom], self.log_intensities[top:bottom])
+
+    def tangents(self, ys, xs):
+        # Unit (x, y) vectors at the middle of the angle steps of the given pixels
+        angles = (self.angles[ys, xs] + 0.5) * (2 * np.pi / ANGLE_STEPS)
+        return np.cos(angles).astype(np.float32), np.sin(angles).astype(np.float32)
+
+    def direction_indices(self, ys, xs, num_directions):
+        return self.angles[ys, xs] // (ANGLE_STEPS // num_directions)
+
 class FlowDirection:
 
-    def __init__(self, image: Image.Image) -> None:
+    def __init__(self, image: Image.Image, cache_lab=True) -> None:
+        # Without cache_lab the Lab conversion isn't kept in rgb2lab's shared cache, e.g. for strips
+        # of an image that won't be converted again
         self.image = image
-        self.lab_image = rgb2lab(np.array(self.image).astype(np.float32))
+        self.lab_image = rgb2lab(np.array(self.image), cache=cache_lab)
         self.angles = None
     
     def compute_flow(self):
@@ -19,77 +47,54 @@ class FlowDirection:
         lab_image = self.lab_image
         l_channel = lab_image[...,0]
 
-        dI_x = cv2.Sobel(l_channel, cv2.CV_64F, 1, 0, ksize=5)
-        dI_y = cv2.Sobel(l_channel, cv2.CV_64F, 0, 1, ksize=5)
-
-        # J = structure tensor
-
-        Jxx = cv2.GaussianBlur(dI_x * dI_x, (0,0), sigmaX=2)
-        Jxy = cv2.GaussianBlur(dI_x * dI_y, (0,0), sigmaX=2)
-        Jyy = cv2.GaussianBlur(dI_y * dI_y, (0,0), sigmaX=2)
+        with span("flow structure tensor"):
+            # J = structure tensor
+            Jxx, Jxy, Jyy = structure_tensor(l_channel)
 
         # Compute the eigenvectors and eigenvalues of J
-        
-        H, W = Jxx.shape
-        J = np.empty((H, W, 2, 2), dtype=Jxx.dtype)
-        J[..., 0, 0] = Jxx
-        J[..., 0, 1] = Jxy
-        J[..., 1, 0] = Jxy
-        J[..., 1, 1] = Jyy
-
-        self.eigenvalues, self.eigenvectors = np.linalg.eigh(J)
+        with span("flow eigen decomposition"):
+            self.eigenvalues, self.tangents, self.angles = symmetric_eigen_2x2(Jxx, Jxy, Jyy)
 
         # Preview flow direction as image 
-        # edge_weight = self.eigenvectors[:, :, 0, 1]
+        # edge_weight = self.tangents[:, :, 1]
         # flow_directions_image = (edge_weight / np.max(edge_weight) * 255).astype(np.uint8)
         # flow_directions_image = Image.fromarray(flow_directions_image)
         # flow_directions_image.show()
 
-    def blur_along_flow(self):
-        image = self.lab_image
-        H, W = image.shape[:2]
+    def compact_flow(self):
+        angles = np.mod(self.angles, np.float32(2 * np.pi)) * np.float32(ANGLE_STEPS / (2 * np.pi))
+        log_intensities = np.log(np.maximum(np.float32(1e-6), self.eigenvalues[..., 0]))
+        return CompactFlow(np.minimum(angles, ANGLE_STEPS - 1).astype(np.uint16), log_intensities.astype(np.float16))
 
-        tx = self.eigenvectors[..., 0, 0] # Tangent x
-        ty = self.eigenvectors[..., 1, 0]
+    def blur_along_flow(self, sigma_t=4.0, sigma_n=1.0):
+        # Line integral convolution of the lightness: a gaussian blur that follows the flow
+        # streamlines (sigma_t), followed by a short one across them (sigma_n).
+        # The result is kept as the height field for compute_normals.
+        l_channel = np.ascontiguousarray(self.lab_image[..., 0])
+        tx = np.ascontiguousarray(self.tangents[..., 0]) # Tangent x
+        ty = np.ascontiguousarray(self.tangents[..., 1])
 
         nx = -ty  # Normal x
         ny = tx
 
-        sigma_t = 4.0 # along stroke
-        sigma_n = 1.0 # across stroke
-        radius_t = int(3 * sigma_t)
-        radius_n = int(3 * sigma_n)
-
-        out = np.zeros((H, W), dtype=np.float32)
-        for j in range(-radius_n, radius_n + 1):
-            for i in range(-radius_t, radius_t + 1):
-                # This section I barely understand what this section is doing, 
-                # but I believe the end result is the same as the convolution with a per-pixel gaussian
-                w = math.exp(-0.5 * ((i*i)/(sigma_t*sigma_t) + (j*j)/(sigma_n*sigma_n)))
-                
-                dx = i * tx + j * nx
-                dy = i * ty + j * ny
-
-                x = np.arange(W)[None, :] + dx
-                y = np.arange(H)[:, None] + dy
-
-                x0 = np.clip(np.floor(x).astype(np.int32), 0, W - 1)
-                y0 = np.clip(np.floor(y).astype(np.int32), 0, H - 1)
-
-                out += w * image[y0, x0, 0]
-        out /= np.max(out)
+        with span("flow line integral convolution"):
+            out = convolve_along_field(l_channel, tx, ty, sigma_t) # along stroke
+            out = convolve_along_field(out, nx, ny, sigma_n) # across stroke
+        out -= out.min()
+        out /= max(out.max(), 1e-6)
 
-        #self.height_field = out
-        #height_image = (out * 255).astype(np.uint8)
-        return Image.fromarray(image)
+        self.height_field = out
+        height_image = (out * 255).astype(np.uint8)
+        return Image.fromarray(height_image)
 
     def compute_normals(self):
         # Compute normals from height field
         if not hasattr(self, 'height_field'):
-            raise ValueError("Height field not computed yet. Call compute_height_field() first.")
+            raise ValueError("Height field not computed yet. Call blur_along_flow() first.")
         H, W = self.height_field.shape
-        dzdx = cv2.Sobel(self.height_field, cv2.CV_64F, 1, 0, ksize=5)
-        dzdy = cv2.Sobel(self.height_field, cv2.CV_64F, 0, 1, ksize=5)
+        count("flow normals pixels", H * W)
+        dzdx = cv2.Sobel(self.height_field, cv2.CV_32F, 1, 0, ksize=5)
+        dzdy = cv2.Sobel(self.height_field, cv2.CV_32F, 0, 1, ksize=5)
 
         normals = np.zeros((H, W, 3), dtype=np.float32)
         normals[..., 0] = -dzdx
@@ -115,29 +120,123 @@ class FlowDirection:
         Image.fromarray(phong_image).show()
 
 
-def rgb2lab(rgb):
-    # Function written by chatGPT
-    # Converts from rgb color space to CIELAB (lightness, color a, color b) color space
-
-    # Very rough conversion, enough for SLIC demo
-    rgb = rgb / 255.0
-    mask = rgb > 0.04045
-    rgb[mask] = np.power((rgb[mask] + 0.055) / 1.055, 2.4)
-    rgb[~mask] /= 12.92
-    rgb *= 100
-
-    # sRGB D65 conversion
-    X = rgb[...,0]*0.4124 + rgb[...,1]*0.3576 + rgb[...,2]*0.1805
-    Y = rgb[...,0]*0.2126 + rgb[...,1]*0.7152 + rgb[...,2]*0.0722
-    Z = rgb[...,0]*0.0193 + rgb[...,1]*0.1192 + rgb[...,2]*0.9505
-
-    X /= 95.047; Y /= 100.0; Z /= 108.883
-    XYZ = np.stack([X,Y,Z], axis=-1)
-    mask = XYZ > 0.008856
-    XYZ[mask] = np.cbrt(XYZ[mask])
-    XYZ[~mask] = (7.787 * XYZ[~mask]) + (16/116)
-
-    L = (116 * XYZ[...,1]) - 16
-    a = 500 * (XYZ[...,0] - XYZ[...,1])
-    b = 200 * (XYZ[...,1] - XYZ[...,2])
-    return np.stack([L,a,b], axis=-1)
\ No newline at end of file
+def pack_flow(flow: CompactFlow):
+    # A single (H, W) array of COMPACT_FLOW_DTYPE records, for save_flow and ResultCache.mapped
+    packed = np.empty(flow.shape, dtype=COMPACT_FLOW_DTYPE)
+    packed["angle"] = flow.angles
+    packed["log_intensity"] = flow.log_intensities
+    return packed
+
+def unpack_flow(packed):
+    # Views into the packed array, so a memory mapped one stays mapped
+    return CompactFlow(packed["angle"], packed["log_intensity"])
+
+def save_flow(flow: CompactFlow, path):
+    np.save(path, pack_flow(flow))
+
+def load_flow(path, mmap_mode="r"):
+    # Memory mapped by default: only the rows the strokes reach are read, and processes loading the
+    # same file share its pages
+    return unpack_flow(np.load(path, mmap_mode=mmap_mode))
+
+
+def convolve_along_field(image, vx, vy, sigma):
+    # Gaussian weighted average of `image` along the streamlines of the unit vector field (vx, vy),
+    # traced one pixel per tap in both directions with bilinear sampling.
+    # Every buffer is allocated once up front, the taps only run remaps and in-place math.
+    H, W = image.shape
+    radius = int(3 * sigma)
+    weights = [math.exp(-0.5 * (i * i) / (sigma * sigma)) for i in range(radius + 1)]
+
+    base_x = np.broadcast_to(np.arange(W, dtype=np.float32)[None, :], (H, W))
+    base_y = np.broadcast_to(np.arange(H, dtype=np.float32)[:, None], (H, W))
+    px, py = np.empty((H, W), dtype=np.float32), np.empty((H, W), dtype=np.float32)
+    dx, dy = np.empty_like(px), np.empty_like(px)
+    sample_x, sample_y = np.empty_like(px), np.empty_like(px)
+    sample, dot = np.empty_like(px), np.empty_like(px)
+
+    out = image * np.float32(weights[0])
+    for direction in (1, -1):
+        np.copyto(px, base_x)
+        np.copyto(py, base_y)
+        np.multiply(vx, direction, out=dx)
+        np.multiply(vy, direction, out=dy)
+        for i in range(1, radius + 1):
+            px += dx
+            py += dy
+            cv2.remap(image, px, py, cv2.INTER_LINEAR, dst=sample, borderMode=cv2.BORDER_REPLICATE)
+            cv2.scaleAdd(sample, weights[i], out, dst=out)
+
+            # Step along the field at the new position. The field has no sign, so keep the
+            # direction we came from (nearest sampling, so opposite vectors are never averaged).
+            cv2.remap(vx, px, py, cv2.INTER_NEAREST, dst=sample_x, borderMode=cv2.BORDER_REPLICATE)
+            cv2.remap(vy, px, py, cv2.INTER_NEAREST, dst=sample_y, borderMode=cv2.BORDER_REPLICATE)
+            np.multiply(sample_x, dx, out=dot)
+            np.multiply(sample_y, dy, out=sample)
+            dot += sample
+            np.copysign(1, dot, out=dot)
+            np.multiply(sample_x, dot, out=dx)
+            np.multiply(sample_y, dot, out=dy)
+
+    out /= np.float32(weights[0] + 2 * sum(weights[1:]))
+    return out
+
+
+def structure_tensor(l_channel):
+    # The (Jxx, Jxy, Jyy) components of the structure tensor of a lightness image, per pixel
+    dI_x = cv2.Sobel(l_channel, cv2.CV_32F, 1, 0, ksize=5)
+    dI_y = cv2.Sobel(l_channel, cv2.CV_32F, 0, 1, ksize=5)
+    Jxx = cv2.GaussianBlur(dI_x * dI_x, (0,0), sigmaX=2)
+    Jxy = cv2.GaussianBlur(dI_x * dI_y, (0,0), sigmaX=2)
+    Jyy = cv2.GaussianBlur(dI_y * dI_y, (0,0), sigmaX=2)
+    return Jxx, Jxy, Jyy
+
+def symmetric_eigen_2x2(a, b, c):
+    # Closed form eigen decomposition of the symmetric matrices [[a, b], [b, c]], per pixel.
+    # Returns float32 arrays:
+    #   eigenvalues (H, W, 2), ascending like np.linalg.eigh
+    #   tangents (H, W, 2), the unit (x, y) eigenvector of the smallest eigenvalue, i.e. along edges
+    #   angles (H, W), the direction of the tangents in radians
+    a = np.asarray(a, dtype=np.float32)
+    b = np.asarray(b, dtype=np.float32)
+    c = np.asarray(c, dtype=np.float32)
+    mean = (a + c) * 0.5
+    half_diff = (a - c) * 0.5
+    radius = np.sqrt(half_diff * half_diff + b * b)
+
+    eigenvalues = np.empty((*a.shape, 2), dtype=np.float32)
+    np.subtract(mean, radius, out=eigenvalues[..., 0])
+    np.add(mean, radius, out=eigenvalues[..., 1])
+
+    # The largest eigenvalue's eigenvector is at 0.5 * atan2(2b, a - c), the tangent is perpendicular
+    angles = np.arctan2(b, half_diff)
+    angles *= 0.5
+    angles += np.float32(np.pi / 2)
+
+    tangents = np.empty((*a.shape, 2), dtype=np.float32)
+    np.cos(angles, out=tangents[..., 0])
+    np.sin(angles, out=tangents[..., 1])
+    return eigenvalues, tangents, angles
+
+def eigh_2x2(Jxx, Jxy, Jyy):
+    # np.linalg.eigh of the structure tensors in float64, how compute_flow used to do it
+    J = np.empty((*Jxx.shape, 2, 2), dtype=np.float64)
+    J[..., 0, 0] = Jxx
+    J[..., 0, 1] = Jxy
+    J[..., 1, 0] = Jxy
+    J[..., 1, 1] = Jyy
+    return np.linalg.eigh(J)
+
+def eigen_errors(Jxx, Jxy, Jyy, eigenvalues=None, eigenvectors=None):
+    # How far symmetric_eigen_2x2 is from eigh (eigh_2x2 when eigenvalues and eigenvectors aren't
+    # given): eigenvalue error relative to the largest eigenvalue, and tangent error as 1 - |cos| of
+    # the angle between the tangents (sign is arbitrary), only where the tensor is anisotropic
+    # enough for the tangent to be defined
+    if eigenvalues is None:
+        eigenvalues, eigenvectors = eigh_2x2(Jxx, Jxy, Jyy)
+    closed_eigenvalues, tangents, _ = symmetric_eigen_2x2(Jxx, Jxy, Jyy)
+    scale = np.maximum(eigenvalues[..., 1:], 1e-6)
+    eigenvalue_error = np.max(np.abs(closed_eigenvalues - eigenvalues) / scale)
+    defined = (eigenvalues[..., 1] - eigenvalues[..., 0]) > 1e-3 * scale[..., 0]
+    cosine = np.abs(np.sum(tangents * eigenvectors[..., :, 0], axis=-1))
+    return eigenvalue_error, np.max(1 - cosine[defined])
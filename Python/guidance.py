@@ -0,0 +1,175 @@
+# Structure derived from a primary image (normal map) that is applied to any number of secondary maps
+# Each guidance is computed once from the primary, then `apply` filters a list of secondary images
+# (albedo, roughness, metallic, AO, ...) in one pass by stacking their channels. Guidance can be
+# saved to and loaded from .npz files, so it can be computed once and applied later.
+# `apply` takes Pillow images or arrays of any bit depth (e.g. 16-bit maps from image_io), and gives
+# back the same kind. SLIC and Kuwahara keep the bit depth, StrokeGuidance draws with 8-bit brushes
+# and gives 8-bit outputs, like main.py's layered_paint_filter.
+
+from PIL import Image
+import numpy as np
+from slic import SLICImage
+from kuwahara import Kuwahara
+from layered_paint import LayeredPaintImage, BrushDabs, PaintLayer, TILE_HEIGHT, cell_colors, draw_dabs, draw_dabs_tiled
+from profiling import span
+from image_io import image_like, to_8bit, to_image
+
+def check_sizes(arrays, shape):
+    if any(array.shape[:2] != shape for array in arrays):
+        raise ValueError("secondary images must have the same size as the primary image")
+
+def stack_channels(arrays):
+    # (H, W, total channels) array of all images, and the channel count of each one
+    h, w = arrays[0].shape[:2]
+    check_sizes(arrays, (h, w))
+    arrays = [array.reshape(h, w, -1) for array in arrays]
+    return np.concatenate(arrays, axis=2), [array.shape[2] for array in arrays]
+
+def split_channels(stacked, images, channels):
+    # Splits a stacked result back into images with the modes of `images`, or arrays with their
+    # shapes and dtypes
+    outputs = []
+    start = 0
+    for image, channel_count in zip(images, channels):
+        array = stacked[..., start:start + channel_count]
+        if channel_count == 1 and getattr(image, "ndim", 2) == 2:
+            array = array[..., 0]
+        outputs.append(image_like(np.ascontiguousarray(array).astype(np.asarray(image).dtype), image))
+        start += channel_count
+    return outputs
+
+class SLICGuidance:
+    # Every pixel takes the color of its segment's centroid, like SLICImage.draw_splots
+    kind = "slic"
+
+    def __init__(self, labels):
+        self.labels = labels
+        self.statistics = SLICImage.segment_statistics(labels)
+
+    @classmethod
+    def compute(cls, primary: Image.Image, superpixel_size=32, num_iterations=10, compactness=13, pyramid_levels=0):
+        slic_image = SLICImage(primary, None)
+        labels, _ = slic_image.slic(superpixel_size=superpixel_size, num_iterations=num_iterations,
+                                    compactness=compactness, enforce_connectivity=True, pyramid_levels=pyramid_levels)
+        return cls(labels)
+
+    def apply(self, images):
+        stacked, channels = stack_channels([np.asarray(image) for image in images])
+        with span("slic rasterization"):
+            colors = stacked[self.statistics.ys.astype(np.intp), self.statistics.xs.astype(np.intp)]
+            filtered = colors[self.labels]
+        return split_channels(filtered, images, channels)
+
+    def to_arrays(self):
+        return {"labels": self.labels}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(arrays["labels"])
+
+class KuwaharaGuidance:
+    # Every pixel takes the mean of the quadrant chosen on the primary image. The anisotropic method
+    # has no per pixel quadrant indices, so there the primary is kept and filtered again together
+    # with the secondaries, which still share all of their filtering passes.
+    kind = "kuwahara"
+
+    def __init__(self, method, radius, indices=None, primary=None):
+        self.method = method
+        self.radius = radius
+        self.indices = indices
+        self.primary = primary
+
+    @classmethod
+    def compute(cls, primary: Image.Image, method='gaussian', radius=15):
+        if method == 'anisotropic':
+            return cls(method, radius, primary=np.array(primary))
+        kuwahara = Kuwahara(method, radius)
+        kuwahara.kuwahara(np.array(primary), method=method, radius=radius, primary=True)
+        return cls(method, radius, indices=kuwahara.indices.astype(np.uint8))
+
+    def apply(self, images):
+        arrays = [np.asarray(image) for image in images]
+        if self.method == 'anisotropic':
+            stacked, channels = stack_channels(arrays)
+            kuwahara = Kuwahara(self.method, self.radius, Image.fromarray(self.primary))
+            filtered = kuwahara.anisotropic_kuwahara([self.primary, stacked], radius=self.radius)[1]
+            return split_channels(filtered, images, channels)
+        # Only the chosen quadrant's mean is computed, no variance. The images are passed one by one,
+        # see kuwahara_fused.
+        check_sizes(arrays, self.indices.shape)
+        filtered = Kuwahara(self.method, self.radius).kuwahara_fused(
+            arrays, method=self.method, radius=self.radius, indices=self.indices, winner_only=True)
+        return [image_like(output, image) for output, image in zip(filtered, images)]
+
+    def to_arrays(self):
+        arrays = {"method": np.array(self.method), "radius": np.array(self.radius)}
+        if self.indices is not None:
+            arrays["indices"] = self.indices
+        if self.primary is not None:
+            arrays["primary"] = self.primary
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(str(arrays["method"]), int(arrays["radius"]), arrays.get("indices"), arrays.get("primary"))
+
+class StrokeGuidance:
+    # The layered paint strokes: every dab of every brush size, drawn onto the secondaries as they are
+    kind = "strokes"
+
+    def __init__(self, layers):
+        self.layers = layers
+
+    @classmethod
+    def compute(cls, primary: Image.Image, brush_sizes=(6, 40, 80), brush="rough2", atlas=None, flow_direction=None,
+                placement="grid", stroke_budget=None, error_budget=None):
+        layered_paint = LayeredPaintImage(primary, brush=brush, atlas=atlas)
+        layered_paint.set_flow_map(flow_direction)
+        layered_paint.set_brush_sizes(*brush_sizes)
+        layered_paint.set_placement(placement, stroke_budget, error_budget)
+        return cls(layered_paint.plan())
+
+    def apply(self, images, executor=None, tile_height=TILE_HEIGHT):
+        # With an executor the dabs are drawn in bands of rows in parallel, see draw_dabs_tiled.
+        # 16-bit and float images are painted on 8-bit copies, and give 8-bit arrays or images back.
+        sources = [np.asarray(image) for image in images]
+        arrays = [to_8bit(source) for source in sources]
+        canvases = [array.copy() for array in arrays]
+        for layer in self.layers:
+            # Dab colors come from the unpainted images, like LayeredPaintImage.paint
+            with span("paint rasterization", brush_size=layer.brush_size):
+                colors = [cell_colors(array, layer.brush_size, layer.dabs) for array in arrays]
+                if executor is None:
+                    draw_dabs(canvases, colors, layer.dabs, layer.rotated_brush_masks)
+                else:
+                    draw_dabs_tiled(canvases, colors, layer.dabs, layer.rotated_brush_masks, executor, tile_height)
+        return [to_image(canvas) if isinstance(image, Image.Image) and source.dtype != np.uint8 else
+                image_like(canvas, image) for canvas, image, source in zip(canvases, images, sources)]
+
+    def to_arrays(self):
+        arrays = {}
+        for i, layer in enumerate(self.layers):
+            arrays[f"layer{i}_brush_size"] = np.array(layer.brush_size)
+            arrays[f"layer{i}_rotated_brush_masks"] = layer.rotated_brush_masks
+            for field in BrushDabs._fields:
+                arrays[f"layer{i}_{field}"] = getattr(layer.dabs, field)
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        layers = []
+        while f"layer{len(layers)}_brush_size" in arrays:
+            prefix = f"layer{len(layers)}_"
+            dabs = BrushDabs(*[arrays[prefix + field] for field in BrushDabs._fields])
+            layers.append(PaintLayer(int(arrays[prefix + "brush_size"]), dabs, arrays[prefix + "rotated_brush_masks"]))
+        return cls(layers)
+
+GUIDANCE_KINDS = {guidance.kind: guidance for guidance in (SLICGuidance, KuwaharaGuidance, StrokeGuidance)}
+
+def save_guidance(guidance, path):
+    np.savez(path, kind=np.array(guidance.kind), **guidance.to_arrays())
+
+def load_guidance(path):
+    with np.load(path) as data:
+        arrays = {name: data[name] for name in data.files}
+    return GUIDANCE_KINDS[str(arrays.pop("kind"))].from_arrays(arrays)
@@ -0,0 +1,186 @@
+# Reading and writing images as NumPy arrays
+# Inputs are decoded once into read only arrays: through a ResultCache they become .npy files that
+# are memory mapped, so later runs and other processes reading the same file don't decode it again,
+# and filters get zero-copy views of them. Rows of a mapped array are only read from disk when used,
+# so strips of an input can be streamed with iter_strips.
+# 16-bit PNG and TIFF files keep all of their bits (Pillow reads 16-bit RGB as 8-bit), EXR files are
+# read as float32 when the OpenCV build supports them. PNGs are written one strip of rows at a time
+# through a streaming compressor, with 8 or 16 bits per channel.
+
+from PIL import Image
+import numpy as np
+import os
+import struct
+import zlib
+import cv2
+
+STRIP_HEIGHT = 256
+# zlib level of written PNGs, the same as Pillow's
+PNG_COMPRESS_LEVEL = 6
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# PNG color type for each channel count
+PNG_COLOR_TYPES = {1: 0, 2: 4, 3: 2, 4: 6}
+# Extensions written with OpenCV, anything else goes through Pillow
+OPENCV_EXTENSIONS = (".tif", ".tiff", ".exr")
+
+def read_image(path):
+    # (H, W) or (H, W, C) array in RGB(A) order, uint8, uint16 or float32
+    # OpenCV turns gray + alpha PNGs into BGRA
+    array = None if png_color_type(path) == PNG_COLOR_TYPES[2] else cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    if array is None:
+        # Formats OpenCV doesn't know, or wasn't built with
+        image = Image.open(path)
+        image.load()
+        if image.mode == "P":
+            image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+        return np.asarray(image)
+    if array.ndim == 3 and array.shape[2] >= 3:
+        # OpenCV reads BGR(A)
+        array = cv2.cvtColor(array, cv2.COLOR_BGR2RGB if array.shape[2] == 3 else cv2.COLOR_BGRA2RGBA)
+    return array
+
+def png_color_type(path):
+    # The color type in a PNG's header, None for other files
+    with open(path, "rb") as file:
+        header = file.read(26)
+    if len(header) < 26 or not header.startswith(PNG_SIGNATURE):
+        return None
+    return header[25]
+
+def decoded_image(path, cache=None):
+    # The decoded image, memory mapped from `cache` (a ResultCache) once it has been decoded, read only
+    if cache is None:
+        array = read_image(path)
+    else:
+        stat = os.stat(path)
+        key = cache.key("decoded", os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        array = cache.mapped(key, lambda: read_image(path))
+    array.flags.writeable = False
+    return array
+
+def iter_strips(array, strip_height=STRIP_HEIGHT):
+    # (first row, rows) of consecutive strips, views into `array`
+    for top in range(0, array.shape[0], strip_height):
+        yield top, array[top:top + strip_height]
+
+def to_8bit(array):
+    # uint8 copy of a uint16 or float (0-1) image, rounded, uint8 images as they are
+    if array.dtype == np.uint8:
+        return array
+    if array.dtype == np.uint16:
+        return ((array.astype(np.uint32) * 255 + 32767) // 65535).astype(np.uint8)
+    return (np.clip(array, 0, 1) * 255 + 0.5).astype(np.uint8)
+
+def to_image(array):
+    # 8-bit Pillow image, for the filters that draw with Pillow
+    array = to_8bit(array)
+    if array.ndim == 3 and array.shape[2] == 1:
+        array = array[..., 0]
+    return Image.fromarray(np.ascontiguousarray(array))
+
+def image_like(array, image):
+    # `array` as the same kind of image as `image`: a Pillow image with its mode (and palette) from an
+    # array laid out like np.asarray(image) gives, without the `mode` argument of Image.fromarray that
+    # Pillow deprecates, or the array itself when `image` is an array
+    if not isinstance(image, Image.Image):
+        return array
+    array = np.ascontiguousarray(array)
+    rawmode = "1;8" if image.mode == "1" else image.mode
+    result = Image.frombuffer(image.mode, (array.shape[1], array.shape[0]), array, "raw", rawmode, 0, 1)
+    if image.mode in ("P", "PA"):
+        result.putpalette(image.getpalette())
+    return result
+
+class PNGWriter:
+    # Writes a PNG one strip of rows at a time, e.g.
+    #   with PNGWriter(path, width, height, 3, np.uint16) as writer:
+    #       for top, rows in strips:
+    #           writer.write(rows)
+    # Every row uses the Sub filter (the difference to the pixel on the left), which numpy does a strip
+    # at a time. Choosing a filter per row like Pillow makes files about 10% smaller, but takes longer
+    # in numpy than compressing.
+
+    def __init__(self, path, width, height, channels, dtype=np.uint8, compress_level=PNG_COMPRESS_LEVEL):
+        if channels not in PNG_COLOR_TYPES:
+            raise ValueError(f"PNG images have 1 to 4 channels, not {channels}")
+        if np.dtype(dtype) not in (np.uint8, np.uint16):
+            raise ValueError(f"PNG images are uint8 or uint16, not {np.dtype(dtype)}")
+        self.path = path
+        self.width, self.height, self.channels = width, height, channels
+        # PNG samples are big endian
+        self.dtype = np.dtype(dtype).newbyteorder(">")
+        self.rows_written = 0
+        self.compressor = zlib.compressobj(compress_level)
+        self.file = open(path, "wb")
+        self.file.write(PNG_SIGNATURE)
+        self.chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8 * self.dtype.itemsize,
+                                        PNG_COLOR_TYPES[channels], 0, 0, 0))
+
+    def chunk(self, kind, data):
+        self.file.write(struct.pack(">I", len(data)) + kind + data)
+        self.file.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(kind))))
+
+    def write(self, rows):
+        # (rows, W) or (rows, W, C) array, the next rows of the image
+        rows = np.ascontiguousarray(rows, dtype=self.dtype)
+        if rows.shape[1] != self.width or rows.size != len(rows) * self.width * self.channels:
+            raise ValueError(f"expected rows of {self.width} pixels with {self.channels} channels, got {rows.shape}")
+        if self.rows_written + len(rows) > self.height:
+            raise ValueError("more rows than the image height")
+        data = rows.view(np.uint8).reshape(len(rows), -1)
+        scanlines = np.empty((len(rows), data.shape[1] + 1), dtype=np.uint8)
+        bytes_per_pixel = self.channels * self.dtype.itemsize
+        scanlines[:, 0] = 1 # Sub
+        scanlines[:, 1:bytes_per_pixel + 1] = data[:, :bytes_per_pixel]
+        np.subtract(data[:, bytes_per_pixel:], data[:, :-bytes_per_pixel], out=scanlines[:, bytes_per_pixel + 1:])
+        self.rows_written += len(rows)
+        compressed = self.compressor.compress(scanlines)
+        if compressed:
+            self.chunk(b"IDAT", compressed)
+
+    def close(self):
+        if self.file.closed:
+            return
+        try:
+            if self.rows_written != self.height:
+                raise ValueError(f"{self.rows_written} rows written out of {self.height}")
+            self.chunk(b"IDAT", self.compressor.flush())
+            self.chunk(b"IEND", b"")
+        finally:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+            os.remove(self.path)
+
+def write_png(path, array, strip_height=STRIP_HEIGHT):
+    # Streams an (H, W) or (H, W, C) uint8 or uint16 array, e.g. memory mapped, to a PNG file
+    channels = 1 if array.ndim == 2 else array.shape[2]
+    with PNGWriter(path, array.shape[1], array.shape[0], channels, array.dtype) as writer:
+        for _, rows in iter_strips(array, strip_height):
+            writer.write(rows)
+
+def save_image(path, image):
+    # Saves an array or a Pillow image, PNGs with their bit depth and in strips
+    if isinstance(image, Image.Image) and image.mode not in ("L", "LA", "RGB", "RGBA", "I;16"):
+        # Palette, 1-bit, CMYK, ... images are left to Pillow
+        image.save(path)
+        return
+    array = np.asarray(image)
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".png" and array.dtype in (np.uint8, np.uint16) and \
+            (array.ndim == 2 or array.shape[2] in PNG_COLOR_TYPES):
+        write_png(path, array)
+    elif extension in OPENCV_EXTENSIONS:
+        if array.ndim == 3 and array.shape[2] >= 3:
+            array = cv2.cvtColor(array, cv2.COLOR_RGB2BGR if array.shape[2] == 3 else cv2.COLOR_RGBA2BGRA)
+        if not cv2.imwrite(path, array):
+            raise ValueError(f"OpenCV can't write {path}")
+    else:
+        (image if isinstance(image, Image.Image) else to_image(array)).save(path)
@@ -7,24 +7,105 @@ sys.path.append('venv/Lib/site-packages')
 
 import numpy as np
 import cv2
+import tempfile
 
 from PIL import Image, ImageDraw, ImageFilter
+from flow_direction import FlowDirection
+from profiling import span, count
+
+# Anisotropic method: pixels whose structure tensor anisotropy is below the threshold use the
+# plain gaussian quadrants, the others use quadrants stretched along the flow by this amount
+ANISOTROPY_THRESHOLD = 0.5
+KERNEL_ANISOTROPY = 0.75
+# From this radius on, the mean method uses summed area tables, whose cost doesn't grow with the radius
+SUMMED_AREA_RADIUS = 12
+# Window start of each quadrant in the reflected image relative to the pixel, in radii, see integral_quadrants
+QUADRANT_OFFSETS = np.array([(1, 1), (0, 1), (1, 0), (0, 0)])
+# Rows of 1024 lookups per cv2.remap call in Kuwahara.sample, remap asserts from 32767 rows on
+SAMPLE_ROWS = 32766
+# OpenCV warps and remaps float images of 2 or more than this many channels on a coarse fixed point grid
+# (off by a few levels), so the anisotropic method filters groups of this many channels, see channel_groups
+REMAP_CHANNELS = 4
+# Large radii are filtered on a downsampled copy, scaled so the radius stays around this size
+DOWNSAMPLED_RADIUS = 6
 
 # class is new addition to interface with existing code
 class Kuwahara:
-    def __init__(self, method='mean', radius=3, primary_image: Image.Image = None, secondary_image: Image.Image = None):
+    def __init__(self, method='mean', radius=3, primary_image: Image.Image = None, secondary_image: Image.Image = None, flow: FlowDirection = None, num_orientations=4):
         self.method = method
         self.radius = radius
         self.primary_image = primary_image
         self.secondary_image = secondary_image
+        self.flow = flow # only used by the anisotropic method, computed from the primary image if None
+        self.num_orientations = num_orientations
 
     def apply(self):
         orig_img = np.array(self.primary_image)
-        self.output_primary = self.kuwahara(orig_img, method=self.method, radius=self.radius, primary=True)
-        
-        if self.secondary_image:
-            orig_img_2 = np.array(self.secondary_image)
-            self.output_secondary = self.kuwahara(orig_img_2, method=self.method, radius=self.radius, primary=False)
+        if self.method == 'anisotropic':
+            # primary and secondary share every filtering pass, see anisotropic_kuwahara
+            images = [orig_img]
+            if self.secondary_image:
+                images.append(np.array(self.secondary_image))
+            outputs = self.anisotropic_kuwahara(images, radius=self.radius)
+            self.output_primary = outputs[0]
+            if self.secondary_image:
+                self.output_secondary = outputs[1]
+            return
+
+        if not self.secondary_image:
+            self.output_primary = self.kuwahara(orig_img, method=self.method, radius=self.radius, primary=True)
+            return
+        # MODIFIED, primary and secondary share every mean pass, see kuwahara_fused
+        orig_img_2 = np.array(self.secondary_image)
+        self.output_primary, self.output_secondary = self.kuwahara_fused([orig_img, orig_img_2], method=self.method, radius=self.radius, winner_only=True)
+
+    def apply_tiled(self, primary_path, output_path, secondary_path=None, secondary_output_path=None, strip_height=256):
+        # Same as apply, for .npy images that don't fit in memory. The inputs are memory mapped
+        # and the outputs are written straight to memory mapped .npy files, one strip at a time.
+        orig_img = np.load(primary_path, mmap_mode='r')
+        output = np.lib.format.open_memmap(output_path, mode='w+', dtype=orig_img.dtype, shape=orig_img.shape)
+        with tempfile.TemporaryFile() as indices_file:
+            indices = np.memmap(indices_file, dtype=np.uint8, mode='w+', shape=orig_img.shape[:2])
+            self.kuwahara_tiled(orig_img, output, indices, method=self.method, radius=self.radius, strip_height=strip_height, primary=True)
+            output.flush()
+
+            if secondary_path is not None:
+                orig_img_2 = np.load(secondary_path, mmap_mode='r')
+                output_2 = np.lib.format.open_memmap(secondary_output_path, mode='w+', dtype=orig_img_2.dtype, shape=orig_img_2.shape)
+                self.kuwahara_tiled(orig_img_2, output_2, indices, method=self.method, radius=self.radius, strip_height=strip_height, primary=False)
+                output_2.flush()
+            del indices
+
+    def kuwahara_tiled(self, orig_img, output, indices, method='mean', radius=3, sigma=None, grayconv=cv2.COLOR_BGR2GRAY, strip_height=256, primary=True, strips=None):
+        """
+        Run :meth:`kuwahara` over horizontal strips of `orig_img` and write the result to `output`.
+
+        Every strip is read with `radius` extra rows above and below, which is exactly the reach
+        of the subwindows, so the result is identical to filtering the whole image at once while
+        only one strip's worth of temporaries is alive at a time.
+
+        :param orig_img: original image, typically a memory mapped array
+        :param output: array of the same shape and dtype as `orig_img` to write the result to
+        :param indices: `(H, W)` integer array, filled with the chosen quadrants when `primary`,
+            and read back to filter a secondary image
+        :param strip_height: number of output rows computed per strip
+        :param strips: first rows of the strips to compute, all of them when `None`. The other
+            rows of `output` (and `indices`) are left as they are.
+        """
+        if method == 'anisotropic':
+            raise NotImplementedError('the anisotropic method does not support tiling')
+
+        h = orig_img.shape[0]
+        for y0 in (range(0, h, strip_height) if strips is None else strips):
+            y1 = min(h, y0 + strip_height)
+            top, bottom = max(0, y0 - radius), min(h, y1 + radius)
+            strip = np.ascontiguousarray(orig_img[top:bottom])
+            if not primary:
+                self.indices = np.asarray(indices[top:bottom])
+            filtered = self.kuwahara(strip, method=method, radius=radius, sigma=sigma, grayconv=grayconv, primary=primary)
+            output[y0:y1] = filtered[y0 - top:y1 - top]
+            if primary:
+                indices[y0:y1] = self.indices[y0 - top:y1 - top]
 
     def get_results(self) -> tuple:
         primary_img = Image.fromarray(self.output_primary)
@@ -42,7 +123,7 @@ class Kuwahara:
         :param orig_img: original numpy image (support multichannel)
         :type orig_img: :class:`numpy.ndarray`
         :param method: method used to compute the pixels values
-        :type method: "gaussian" | "mean"
+        :type method: "gaussian" | "mean" | "anisotropic"
         :param radius: the window radius (`winsize = 2 * radius + 1`)
         :type radius: `int`
         :param sigma: the sigma used if metod is "gaussian", automatically computed by OpenCV when `None`
@@ -80,9 +161,17 @@ class Kuwahara:
         if radius < 1:
             raise ValueError('`radius` must be greater or equal 1')
 
-        if method not in ('mean', 'gaussian'):
+        if method not in ('mean', 'gaussian', 'anisotropic'):
             raise NotImplementedError('unsupported method %s' % method)
 
+        if method == 'anisotropic':  # MODIFIED, new method
+            if not primary:
+                raise ValueError('anisotropic secondary images are filtered together with the primary, see apply()')
+            return self.anisotropic_kuwahara([orig_img], radius=radius, sigma=sigma, grayconv=grayconv, image_2d=image_2d)[0]
+
+        if not primary:  # MODIFIED, secondaries only need the means of the quadrants already chosen
+            return self.kuwahara_fused([orig_img], method=method, radius=radius, sigma=sigma, indices=self.indices)[0]
+
         if method == 'gaussian' and sigma is None:
             sigma = -1
             # then computed by OpenCV as : 0.3 * ((ksize - 1) * 0.5 - 1) + 0.8
@@ -107,43 +196,339 @@ class Kuwahara:
             image_2d = image
             avgs_2d = avgs
 
-        # Create a pixel-by-pixel square of the image
-        squared_img = image_2d ** 2
+        with span("kuwahara quadrants", method=method, radius=radius):  # MODIFIED, profiling
+            if method == 'mean' and radius >= SUMMED_AREA_RADIUS:  # MODIFIED, summed area tables for large radii
+                self.integral_quadrants(image, image_2d, radius, avgs, stddevs)
+            else:
+                # Create a pixel-by-pixel square of the image
+                squared_img = image_2d ** 2
+
+                # Calculation of averages and variances on subwindows
+                for k, (kx, ky, shift) in enumerate(self.quadrant_kernels(method, radius, sigma)):  # MODIFIED, kernels shared with kuwahara_fused
+                    cv2.sepFilter2D(image, -1, kx, ky, avgs[k], shift)
+                    if image_2d is not image:  # else, this is already done...
+                        cv2.sepFilter2D(image_2d, -1, kx, ky, avgs_2d[k], shift)
+                    cv2.sepFilter2D(squared_img, -1, kx, ky, stddevs[k], shift)
+                    stddevs[k] = stddevs[k] - avgs_2d[k] ** 2    # compute the final variance on subwindow
+
+        # Choice of index with minimum variance
+        indices = np.argmin(stddevs, axis=0)
+        self.indices = indices  # MODIFIED, store for later use on secondary images
+        count("kuwahara pixels", indices.size)
+
+        # Building the filtered image
+        if image.ndim == 2:
+            filtered = np.take_along_axis(avgs, indices[None,...], 0).reshape(image.shape)
+        else:   # then avgs.ndim == 4
+            filtered = np.take_along_axis(avgs, indices[None,...,None], 0).reshape(image.shape)
+
+        return filtered.astype(orig_img.dtype)
+
+    def kuwahara_fused(self, orig_imgs, method='mean', radius=3, sigma=None, grayconv=cv2.COLOR_BGR2GRAY, image_2d=None, indices=None, winner_only=False):
+        """
+        Filter several images with the quadrants chosen on the first one, in one pass.
 
+        The variance is only computed from the first image (the guide), and every image then goes
+        through the same quadrant kernels. Each image is filtered with its own channels rather than
+        stacked with the others: OpenCV's float results can change in the last bit with the row
+        length, which the truncation to integers turns into a different level. This way every image
+        gets exactly what :meth:`kuwahara` gives it on its own.
+
+        :param orig_imgs: list of numpy images of the same height and width, the first one is the guide
+        :param method: "gaussian" | "mean"
+        :param radius: the window radius (`winsize = 2 * radius + 1`)
+        :param sigma: the sigma used if method is "gaussian", automatically computed by OpenCV when `None`
+        :param grayconv: The OpenCV conversion code to extract grayscale image from the guide
+        :param image_2d: The 1-channel image used to compute the variance, if provided instead of `grayconv`
+        :param indices: `(H, W)` quadrants to use instead of choosing them on the guide (e.g. `self.indices`
+            of an earlier call), no variance is computed then
+        :param winner_only: keep one running mean per pixel instead of the 4 quadrant means, which
+            never allocates the `(4, H, W, C)` array. The mean method with a radius from
+            `SUMMED_AREA_RADIUS` on always does this, its quadrants are views of the same table.
+        :returns: list of filtered images
+        """
+        if not isinstance(radius, int):
+            raise TypeError('`radius` must be int')
+
+        if radius < 1:
+            raise ValueError('`radius` must be greater or equal 1')
+
+        if method not in ('mean', 'gaussian'):
+            raise NotImplementedError('unsupported method %s for the fused pass' % method)
+
+        if method == 'gaussian' and sigma is None:
+            sigma = -1
+
+        h, w = orig_imgs[0].shape[:2]
+        if any(img.shape[:2] != (h, w) for img in orig_imgs):
+            raise ValueError('all images must have the same size')
+        integral = method == 'mean' and radius >= SUMMED_AREA_RADIUS
+        kernels = self.quadrant_kernels(method, radius, sigma)
+
+        if indices is None:
+            guide = orig_imgs[0]
+            if image_2d is None:
+                image_2d = guide if guide.ndim == 2 else cv2.cvtColor(guide, grayconv)
+            image_2d = image_2d.astype(np.float32, copy=False)
+            stddevs = np.empty((4, h, w), dtype=np.float32)
+            with span("kuwahara variances", method=method, radius=radius):
+                if integral:
+                    # the means of image_2d aren't needed
+                    self.integral_quadrants(image_2d, image_2d, radius, np.empty_like(stddevs), stddevs)
+                else:
+                    squared_img = image_2d ** 2
+                    avg_2d = np.empty((h, w), dtype=np.float32)
+                    for k, (kx, ky, shift) in enumerate(kernels):
+                        cv2.sepFilter2D(image_2d, -1, kx, ky, avg_2d, shift)
+                        cv2.sepFilter2D(squared_img, -1, kx, ky, stddevs[k], shift)
+                        stddevs[k] = stddevs[k] - avg_2d ** 2
+            indices = np.argmin(stddevs, axis=0)
+            del stddevs
+        self.indices = indices
+        count("kuwahara pixels", indices.size)
+
+        outputs = []
+        with span("kuwahara quadrants", method=method, radius=radius, images=len(orig_imgs)):
+            for img in orig_imgs:
+                image = np.ascontiguousarray(img, dtype=np.float32)
+                # indices broadcast over the channels, OpenCV doesn't take (H, W, 1) arrays
+                winners = indices.reshape(h, w, *[1] * (image.ndim - 2))
+                if integral:
+                    filtered = self.integral_winner_means(image, indices, radius)
+                elif winner_only:
+                    filtered = np.empty_like(image)
+                    avg = np.empty_like(image)
+                    for k, (kx, ky, shift) in enumerate(kernels):
+                        cv2.sepFilter2D(image, -1, kx, ky, avg, shift)
+                        np.copyto(filtered, avg, where=winners == k)
+                else:
+                    avgs = np.empty((4, *image.shape), dtype=np.float32)
+                    for k, (kx, ky, shift) in enumerate(kernels):
+                        cv2.sepFilter2D(image, -1, kx, ky, avgs[k], shift)
+                    filtered = np.take_along_axis(avgs, winners[None], 0)[0]
+                outputs.append(filtered.astype(img.dtype))
+        return outputs
+
+
+    def anisotropic_kuwahara(self, orig_imgs, radius=3, sigma=None, grayconv=cv2.COLOR_BGR2GRAY, image_2d=None):
+        """
+        Kuwahara filter with quadrants aligned to the local flow direction and stretched along it
+        (after Kyprianidis et al., "Image and Video Abstraction by Anisotropic Kuwahara Filtering").
+
+        The orientation and anisotropy come from the structure tensor of `self.flow`. Orientations
+        are quantized into `self.num_orientations` bins over 180 degrees (the stretched quadrants
+        only repeat every 180 degrees). For every bin the images are rotated so the flow is horizontal, where
+        the stretched quadrants are separable again, filtered, and rotated back.
+
+        The variance is only computed from the first image, every image is filtered in the same
+        passes (stacked along the channel axis) and uses the quadrants chosen for the first one.
+        For radii above `DOWNSAMPLED_RADIUS` the quadrant means are computed on a downsampled
+        copy and interpolated, which is where most of the speed comes from.
+
+        :param orig_imgs: list of images of the same size, the first one is the guide
+        :param radius: the window radius across the flow (stretched along the flow)
+        :param sigma: the gaussian sigma, computed like OpenCV does for a `2 * radius + 1` kernel when `None`
+        :returns: list of filtered images
+        """
+        if self.flow is None:
+            self.flow = FlowDirection(Image.fromarray(orig_imgs[0]))
+            self.flow.compute_flow()
+
+        if sigma is None or sigma <= 0:
+            sigma = 0.3 * (radius - 1) + 0.8
+
+        guide = orig_imgs[0].astype(np.float32, copy=False)
+        if image_2d is None:
+            image_2d = guide if guide.ndim == 2 else cv2.cvtColor(orig_imgs[0], grayconv).astype(np.float32, copy=False)
+        image_2d = image_2d.astype(np.float32, copy=False)
+
+        # Stack the guide and its square, which is all the variance needs, and every image to filter them
+        # together, in groups of REMAP_CHANNELS channels
+        splits = 2 + np.cumsum([img.reshape(*img.shape[:2], -1).shape[2] for img in orig_imgs])
+        groups = self.channel_groups([image_2d, image_2d ** 2] + [img.astype(np.float32, copy=False) for img in orig_imgs])
+        h, w = image_2d.shape
+        scale = max(1, radius // DOWNSAMPLED_RADIUS)
+        if scale > 1:
+            size = (max(1, w // scale), max(1, h // scale))
+            groups = [cv2.resize(group, size, interpolation=cv2.INTER_AREA) for group in groups]
+            radius, sigma = max(1, round(radius / scale)), sigma / scale
+
+        bins, angles = self.orientation_bins()
+        filtered = np.empty((h, w, len(groups) * REMAP_CHANNELS), dtype=np.float32)
+        count("kuwahara pixels", h * w)
+        for b in np.unique(bins):
+            ys, xs = np.nonzero(bins == b)
+            angle, kernel_anisotropy = angles[b], (0.0 if b == 0 else KERNEL_ANISOTROPY)
+            # pixel centers in the (possibly downsampled) stack
+            sx = (xs + 0.5) / scale - 0.5
+            sy = (ys + 0.5) / scale - 0.5
+            with span("kuwahara rotated quadrants", orientation=int(b)):
+                filtered[ys, xs] = self.rotated_quadrant_filter(groups, sx, sy, radius, sigma, angle, kernel_anisotropy)
+
+        return [filtered[..., start:end].reshape(img.shape).astype(img.dtype)
+                for img, start, end in zip(orig_imgs, np.r_[2, splits[:-1]], splits)]
+
+    def orientation_bins(self):
+        # MODIFIED, new method
+        # (H, W) bin of every pixel of self.flow, 0 for pixels whose anisotropy is below
+        # ANISOTROPY_THRESHOLD, else 1 + the tangent's direction quantized over 180 degrees, and the
+        # angle the quadrants of each bin are stretched along (0 for bin 0)
+        l_min = self.flow.eigenvalues[..., 0]
+        l_max = self.flow.eigenvalues[..., 1]
+        anisotropy = (l_max - l_min) / np.maximum(l_max + l_min, 1e-12)
+        step = np.pi / self.num_orientations
+        orientation = np.round((self.flow.angles % np.pi) / step).astype(np.int32) % self.num_orientations
+        bins = np.where(anisotropy < ANISOTROPY_THRESHOLD, 0, 1 + orientation)
+        angles = np.r_[0.0, np.arange(self.num_orientations) * step]
+        return bins, angles
+
+    @staticmethod
+    def integral_quadrants(image, image_2d, radius, avgs, stddevs):
+        # MODIFIED, new method
+        # Means of `image` and variances of `image_2d` over the 4 (radius + 1) x (radius + 1)
+        # quadrants of every pixel, written to `avgs` (4, H, W[, C]) and `stddevs` (4, H, W).
+        # Each quadrant sum is 4 lookups in a float64 summed area table, so the cost doesn't depend
+        # on the radius. Borders are reflected like cv2.sepFilter2D does, and for integer valued
+        # images the sums are exact, so strips filtered on their own match the whole image.
+        h, w = image.shape[:2]
+        means = Kuwahara.box_means(image, radius)
+        means_2d = means if image_2d is image else Kuwahara.box_means(image_2d, radius)
+        mean_squares = Kuwahara.box_means(np.square(image_2d, dtype=np.float64), radius)
+        for k, (oy, ox) in enumerate(QUADRANT_OFFSETS * radius):
+            avgs[k] = means[oy:oy + h, ox:ox + w]
+            mean = means_2d[oy:oy + h, ox:ox + w]
+            stddevs[k] = mean_squares[oy:oy + h, ox:ox + w] - mean * mean
+
+    @staticmethod
+    def integral_winner_means(image, indices, radius):
+        # MODIFIED, new method
+        # Mean of `image` over quadrant `indices` of every pixel, from the same summed area table as
+        # integral_quadrants: a single lookup per pixel in the window means instead of 4 full images.
+        h, w = image.shape[:2]
+        means = Kuwahara.box_means(image, radius)
+        offsets = QUADRANT_OFFSETS[indices] * radius
+        ys = np.arange(h)[:, None] + offsets[..., 0]
+        xs = np.arange(w)[None, :] + offsets[..., 1]
+        return means[ys, xs].astype(np.float32)
+
+    @staticmethod
+    def box_means(array, radius):
+        # MODIFIED, new method
+        # Mean of every (radius + 1) x (radius + 1) window of the reflected image, as float64 indexed
+        # by its top left corner. The 4 quadrants of a pixel are then just 4 shifted views of it.
+        h, w = array.shape[:2]
+        size = radius + 1
+        padded = cv2.copyMakeBorder(array, radius, radius, radius, radius, cv2.BORDER_REFLECT_101)
+        # OpenCV drops the channel axis of single channel images
+        table = cv2.integral(padded, sdepth=cv2.CV_64F).reshape(h + 2 * radius + 1, w + 2 * radius + 1, *array.shape[2:])
+        means = table[size:, size:] - table[:-size, size:]
+        means -= table[size:, :-size]
+        means += table[:-size, :-size]
+        means /= size * size
+        return means
+
+    @staticmethod
+    def quadrant_kernels(method, radius, sigma):
+        # MODIFIED, new method, taken out of kuwahara
+        # (kernel x, kernel y, anchor) of the 4 quadrants, for the "mean" and "gaussian" methods
         if method == 'mean':
-            kxy = np.ones(radius + 1, dtype=image.dtype) / (radius + 1)    # kernelX and kernelY (same)
-        elif method == 'gaussian':
+            kxy = np.ones(radius + 1, dtype=np.float32) / (radius + 1)    # kernelX and kernelY (same)
+            kernels = [(kxy, kxy)] * 4
+        else:
             kxy = cv2.getGaussianKernel(2 * radius + 1, sigma, ktype=cv2.CV_32F)
             kxy /= kxy[radius:].sum()   # normalize the semi-kernels
             klr = np.array([kxy[:radius+1], kxy[radius:]])
             kindexes = [[1, 1], [1, 0], [0, 1], [0, 0]]
-
+            kernels = [klr[kindex] for kindex in kindexes]
         # the pixel position for all kernel quadrants
         shift = [(0, 0), (0,  radius), (radius, 0), (radius, radius)]
+        return [(kx, ky, anchor) for (kx, ky), anchor in zip(kernels, shift)]
 
-        # Calculation of averages and variances on subwindows
-        for k in range(4):
-            if method == 'mean':
-                kx = ky = kxy
-            elif method == 'gaussian':
-                kx, ky = klr[kindexes[k]]
-            cv2.sepFilter2D(image, -1, kx, ky, avgs[k], shift[k])
-            if image_2d is not image:  # else, this is already done...
-                cv2.sepFilter2D(image_2d, -1, kx, ky, avgs_2d[k], shift[k])
-            cv2.sepFilter2D(squared_img, -1, kx, ky, stddevs[k], shift[k])
-            stddevs[k] = stddevs[k] - avgs_2d[k] ** 2    # compute the final variance on subwindow
+    @staticmethod
+    def rotated_quadrant_filter(groups, xs, ys, radius, sigma, angle, anisotropy):
+        # Kuwahara selection with gaussian quadrants stretched by (1 + anisotropy) along `angle`
+        # and squeezed across it, evaluated at the (sub)pixel positions (xs, ys). `groups` are the
+        # channel_groups of the guide, the guide squared and the images, the returned means are of all
+        # of their channels, and the variance comes from the first two.
+        h, w = groups[0].shape[:2]
+        radius_u = int(np.ceil(radius * (1 + anisotropy)))
+        radius_v = max(1, int(round(radius / (1 + anisotropy))))
+        halves_u = Kuwahara.half_gaussian_kernels(radius_u, sigma * (1 + anisotropy))
+        halves_v = Kuwahara.half_gaussian_kernels(radius_v, sigma / (1 + anisotropy))
 
-        # Choice of index with minimum variance
-        if primary:  # MODIFIED, to allow for secondary image use
-            indices = np.argmin(stddevs, axis=0)
-            self.indices = indices  # store for possible later use
+        # Rotate so that the direction `angle` becomes the x axis. Only the part of the rotated
+        # image around the requested pixels is built, with enough margin for the kernels; the
+        # borders are mirrored like the filters do.
+        cos, sin = np.cos(angle), np.sin(angle)
+        M = np.array([[cos, sin, 0], [-sin, cos, 0]])
+        us = M[0, 0] * xs + M[0, 1] * ys
+        vs = M[1, 0] * xs + M[1, 1] * ys
+        margin_u, margin_v = radius_u + 2, radius_v + 2
+        u0, v0 = int(np.floor(us.min())) - margin_u, int(np.floor(vs.min())) - margin_v
+        u1, v1 = int(np.ceil(us.max())) + margin_u + 1, int(np.ceil(vs.max())) + margin_v + 1
+        if angle == 0:
+            # Plain crop, clamped to the image so its own borders still get mirrored
+            u0, v0, u1, v1 = max(u0, 0), max(v0, 0), min(u1, w), min(v1, h)
+            groups = [group[v0:v1, u0:u1] for group in groups]
         else:
-            indices = self.indices
+            M[:, 2] = -u0, -v0
+            groups = [cv2.warpAffine(group, M, (u1 - u0, v1 - v0), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REFLECT_101)
+                      for group in groups]
+        us -= u0
+        vs -= v0
 
-        # Building the filtered image
-        if image.ndim == 2:
-            filtered = np.take_along_axis(avgs, indices[None,...], 0).reshape(image.shape)
-        else:   # then avgs.ndim == 4
-            filtered = np.take_along_axis(avgs, indices[None,...,None], 0).reshape(image.shape)
+        best_var = best = None
+        for ku in (0, 1):
+            for kv in (0, 1):
+                # left (ku == 0) halves are anchored on their last tap, right halves on their first
+                anchor = (radius_u if ku == 0 else 0, radius_v if kv == 0 else 0)
+                means = np.hstack([Kuwahara.sample(cv2.sepFilter2D(group, -1, halves_u[ku], halves_v[kv], anchor=anchor), us, vs)
+                                   for group in groups])
+                var = means[:, 1] - means[:, 0] ** 2
+                if best is None:
+                    best_var, best = var, means
+                else:
+                    better = var < best_var
+                    best_var[better] = var[better]
+                    best[better] = means[better]
+        return best
 
-        return filtered.astype(orig_img.dtype)
+    @staticmethod
+    def sample(image, xs, ys):
+        # Bilinear lookup of image at the points (xs, ys), returned as (n, channels).
+        # The lookups are laid out as rows of 1024 since remap only takes maps below 32767 rows,
+        # and made in several calls when there are more than SAMPLE_ROWS rows of them.
+        n = len(xs)
+        channels = 1 if image.ndim == 2 else image.shape[2]
+        sampled = np.empty((n, channels), dtype=image.dtype)
+        chunk = SAMPLE_ROWS * 1024
+        for start in range(0, n, chunk):
+            end = min(n, start + chunk)
+            map_x = np.zeros(-(-(end - start) // 1024) * 1024, dtype=np.float32)
+            map_y = np.zeros_like(map_x)
+            map_x[:end - start], map_y[:end - start] = xs[start:end], ys[start:end]
+            rows = cv2.remap(image, map_x.reshape(-1, 1024), map_y.reshape(-1, 1024), cv2.INTER_LINEAR, borderMode=cv2.BORDER_REFLECT_101)
+            sampled[start:end] = rows.reshape(map_x.size, -1)[:end - start]
+        return sampled
+
+    @staticmethod
+    def channel_groups(arrays):
+        # MODIFIED, new method
+        # The channels of (H, W[, C]) arrays, in order, as float32 (H, W, REMAP_CHANNELS) arrays with the
+        # last one padded with blank channels, see REMAP_CHANNELS
+        arrays = [array.reshape(*array.shape[:2], -1) for array in arrays]
+        total = sum(array.shape[2] for array in arrays)
+        groups = np.zeros((-(-total // REMAP_CHANNELS), *arrays[0].shape[:2], REMAP_CHANNELS), dtype=np.float32)
+        channel = 0
+        for array in arrays:
+            for c in range(array.shape[2]):
+                groups[channel // REMAP_CHANNELS][..., channel % REMAP_CHANNELS] = array[..., c]
+                channel += 1
+        return list(groups)
+
+    @staticmethod
+    def half_gaussian_kernels(radius, sigma):
+        # Left and right halves of a 2 * radius + 1 gaussian, each normalized on its own
+        kernel = cv2.getGaussianKernel(2 * radius + 1, sigma, ktype=cv2.CV_32F)
+        kernel /= kernel[radius:].sum()
+        return kernel[:radius + 1], kernel[radius:]
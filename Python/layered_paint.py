@@ -2,16 +2,43 @@
 # https://darshita1405.medium.com/superpixels-and-slic-6b2d8a6e4f08
 # https://www.epfl.ch/labs/ivrl/research/slic-superpixels/
 
-from PIL import Image, ImageDraw, ImageFilter
-import math
+from PIL import Image, ImageDraw
+from concurrent.futures import Executor
+import heapq
 import numpy as np
-from typing import List, Tuple, NamedTuple
-from functools import lru_cache
-from flow_direction import FlowDirection
-import os
+from color import rgb2lab
+from profiling import span, count
+from typing import List, NamedTuple
+from flow_direction import FlowDirection, CompactFlow
+from brush_atlas import BrushAtlas, default_atlas
+from blur_pyramid import blur_pyramid
+from image_io import image_like
  
 BLUR_FACTOR = 0.5
 NUM_PASTES_PER_STROKE = 8
+# Rows per tile when painting with an executor
+TILE_HEIGHT = 256
+# Mean Lab difference above which a cell gets a stroke, and the brush directions strokes turn in
+STROKE_THRESHOLD = 5
+NUM_DIRECTIONS = 16
+
+class BrushDabs(NamedTuple):
+    # One entry per brush paste
+    wave: np.ndarray # dabs on the same wave and step never overlap
+    step: np.ndarray # index of the paste within its stroke
+    xs: np.ndarray # top left corner of the brush
+    ys: np.ndarray
+    directions: np.ndarray # index of the rotated brush
+    colors: np.ndarray
+    cell_xs: np.ndarray # grid cell the stroke started from, where secondary images take its color
+    cell_ys: np.ndarray
+
+class PaintLayer(NamedTuple):
+    # Everything needed to draw one brush size, only depends on the primary image
+    brush_size: int
+    dabs: BrushDabs
+    rotated_brush_masks: np.ndarray
+
 
 class LayeredPaintImage:
     image: Image.Image
@@ -19,104 +46,252 @@ class LayeredPaintImage:
     draw: ImageDraw.ImageDraw
     brush_sizes: List[int]
 
-    def __init__(self, image: Image.Image, secondary: Image.Image = None):
+    def __init__(self, image: Image.Image, secondary: Image.Image = None, brush: str = "rough2", atlas: BrushAtlas = None):
         self.image = image
         self.secondary = secondary
         self.pixels = image.load()
         self.num_pixels = image.size[0] * image.size[1]
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-        brush_path = os.path.join(script_dir, "Brushes", "rough2.png")
-        if not os.path.exists(brush_path):
-            raise FileNotFoundError(f"Brush not found: {brush_path}")
-        self.brush = Brush(Image.open(brush_path))
+        # Brushes and their rotated masks come from a shared atlas, so they are only loaded once per run
+        self.atlas = atlas or default_atlas
+        self.brush = self.atlas.get_brush(brush)
         self.flow_angles = None
+        self.set_placement()
 
-    def set_flow_map(self):
-        flow_direction = FlowDirection(self.image)
-        flow_direction.compute_flow()
-        self.flow_vectors = flow_direction.eigenvectors[..., 0, 0:2]
-        self.flow_intensities = flow_direction.eigenvalues[..., 0]
-        self.max_flow_intensity = np.max(self.flow_intensities)
+    def set_flow_map(self, flow_direction: FlowDirection = None):
+        # flow_direction can be given with its flow already computed, e.g. loaded from a cache, or
+        # as a CompactFlow, e.g. memory mapped with flow_direction.load_flow. Only the compact flow
+        # is kept, not the full eigen decomposition.
+        if flow_direction is None:
+            flow_direction = FlowDirection(self.image)
+            flow_direction.compute_flow()
+        self.flow = flow_direction if isinstance(flow_direction, CompactFlow) else flow_direction.compact_flow()
+        self.max_flow_intensity = float(np.exp(np.max(self.flow.log_intensities).astype(np.float64)))
 
-    def paint(self):
-        canvas = Image.new("RGBA", self.image.size, (255, 255, 255, 255))
+    def set_placement(self, placement: str = "grid", stroke_budget: int = None, error_budget: float = None):
+        # "grid": every cell whose difference to the blurred image is above the threshold gets one
+        # stroke, judged against the initial canvas.
+        # "error": the canvas is painted while planning and the strokes of every layer after the first
+        # go, greedily, to the cells with the largest remaining difference, which is updated as strokes
+        # are drawn. A layer stops once no cell is above the threshold, after its share of
+        # stroke_budget (split between the layers in proportion to their number of cells, one stroke
+        # per cell when None), or once the mean difference is below error_budget.
+        if placement not in ("grid", "error"):
+            raise ValueError(f"Unknown placement {placement!r}, expected 'grid' or 'error'")
+        if stroke_budget is not None and stroke_budget < 0:
+            raise ValueError("stroke_budget can't be negative")
+        self.placement = placement
+        self.stroke_budget = stroke_budget
+        self.error_budget = error_budget
+
+    def paint(self, layers: List[PaintLayer] = None, executor: Executor = None, tile_height: int = TILE_HEIGHT):
+        # `layers` from plan() can be passed in to skip planning the strokes again.
+        # With an `executor`, strokes are planned and drawn in horizontal tiles of tile_height rows on
+        # it, see plan and draw_dabs_tiled. The result is the same as without one.
+        if layers is None:
+            layers = self.plan(executor, tile_height)
+        canvas = initial_canvas(blur_pyramid(np.asarray(self.image)), self.brush_sizes[0])
         secondary_canvas = None
         if self.secondary:
-            secondary_canvas = self.secondary.copy()
-        w, h = self.image.size 
-        threshold = 5
-        num_directions = 16
-        
+            secondary_canvas = np.array(self.secondary)
+
+        def draw(canvases, colors, dabs, rotated_brush_masks):
+            if executor is None:
+                draw_dabs(canvases, colors, dabs, rotated_brush_masks)
+            else:
+                draw_dabs_tiled(canvases, colors, dabs, rotated_brush_masks, executor, tile_height)
+
+        for layer in layers:
+            with span("paint rasterization", brush_size=layer.brush_size):
+                if self.secondary:
+                    secondary_colors = cell_colors(np.array(self.secondary), layer.brush_size, layer.dabs)
+                    draw([canvas, secondary_canvas], [layer.dabs.colors, secondary_colors], layer.dabs, layer.rotated_brush_masks)
+                else:
+                    draw([canvas], [layer.dabs.colors], layer.dabs, layer.rotated_brush_masks)
+
+        canvas = Image.fromarray(canvas)
+        if self.secondary:
+            secondary_canvas = image_like(secondary_canvas, self.secondary)
+        return canvas, secondary_canvas
+
+    def plan(self, executor: Executor = None, tile_height: int = TILE_HEIGHT):
+        # The strokes of every brush size. With the grid placement, which cells get a stroke is decided
+        # against the initial canvas, so the whole plan can be made before anything is drawn. The error
+        # placement draws every layer onto a working canvas first, see set_placement.
+        # With an `executor`, the grid placement runs on it in tiles, see plan_tiles.
+        threshold = STROKE_THRESHOLD
+        num_directions = NUM_DIRECTIONS
         refresh = True
+        # The blurs of the primary come from a pyramid shared with other paintings of the same image
+        pyramid = blur_pyramid(np.asarray(self.image))
+        canvas = initial_canvas(pyramid, self.brush_sizes[0])
+        # The initial canvas is the most blurred level, rounded
+        lab = pyramid.lab(self.brush_sizes[0] * BLUR_FACTOR)
+        layer_budgets = self.layer_stroke_budgets()
 
-        initial_brush_size = self.brush_sizes[0]
-        canvas.paste(self.image)
-        canvas = canvas.filter(ImageFilter.GaussianBlur(radius=initial_brush_size * BLUR_FACTOR))
-        lab = rgb2lab(np.array(canvas).astype(np.float32))
-
-        for brush_size in self.brush_sizes:
-
-            blurred = self.image.copy().filter(ImageFilter.GaussianBlur(radius=brush_size * BLUR_FACTOR))
-            blurred_array = np.array(blurred)
-            blurred_lab = rgb2lab(blurred_array.astype(np.float32))
-
-            brush_mask = self.brush.get_bitmap_for_size(brush_size)
-            rotated_brush_masks = self.brush.get_rotated_bitmaps(brush_size, 0, num_directions=num_directions)
-
-            for y in range(0, h, brush_size):
-                for x in range(0, w, brush_size):
-                    M = blurred_array[y:y+brush_size, x:x+brush_size]
-                    M_lab = blurred_lab[y:y+brush_size, x:x+brush_size]
-                    cropped_canvas = np.array(canvas.crop((x, y, x + brush_size, y + brush_size)))
-                    cropped_canvas_lab = lab[y:y+brush_size, x:x+brush_size]
-                    # Ensure both arrays have the same shape
-                    if cropped_canvas.shape != M.shape:
-                        min_shape = tuple(map(min, cropped_canvas.shape, M.shape))
-                        cropped_canvas = cropped_canvas[:min_shape[0], :min_shape[1], :min_shape[2]]
-                        M = M[:min_shape[0], :min_shape[1], :min_shape[2]]
-                        M_lab = M_lab[:cropped_canvas.shape[0], :cropped_canvas.shape[1], :cropped_canvas.shape[2]]
-                        cropped_canvas_lab = cropped_canvas_lab[:min_shape[0], :min_shape[1], :min_shape[2]]
-                    
-                    difference_array = np.linalg.norm(cropped_canvas_lab - M_lab, axis=2)
-                    average = np.average(difference_array, axis=(0, 1))
-
-                    if refresh or (average > threshold):
-                        x1, y1 = np.unravel_index(np.argmax(difference_array), difference_array.shape)
-                        
-
-                        draw_color = tuple(M.mean(axis=(0, 1)).astype(int))
-                        secondary_draw_color = None
-                        if self.secondary:
-                            secondary_M = np.array(self.secondary.crop((x, y, x + brush_size, y + brush_size)))
-                            secondary_draw_color = tuple(secondary_M.mean(axis=(0, 1)).astype(int))
-                        
-                        self.draw_brush_strokes(canvas, secondary_canvas, brush_size, w, h, x, y, x1, y1, draw_color, secondary_draw_color, brush_mask, rotated_brush_masks, num_directions)
-                        
-            
+        layers = []
+        for brush_size, stroke_budget in zip(self.brush_sizes, layer_budgets):
+            with span("paint blur", brush_size=brush_size):
+                blurred_array = pyramid.rgb(brush_size * BLUR_FACTOR)
+                blurred_lab = pyramid.lab(brush_size * BLUR_FACTOR)
 
+            with span("paint brush masks", brush_size=brush_size):
+                rotated_brush_masks = self.atlas.get_rotated_masks(self.brush, brush_size, num_directions)
+            with span("paint stroke planning", brush_size=brush_size):
+                if self.placement == "error" and not refresh:
+                    dabs = self.place_strokes(blurred_array, blurred_lab, canvas, brush_size, threshold,
+                                              num_directions, rotated_brush_masks, stroke_budget)
+                elif executor is not None:
+                    # Only the error placement draws on the canvas, and not before its first layer is planned
+                    dabs = self.plan_tiles(lab, blurred_array, blurred_lab, brush_size, refresh, threshold,
+                                           num_directions, executor, tile_height)
+                else:
+                    dabs = self.plan_strokes(blurred_array, blurred_lab, lab, brush_size, refresh,
+                                             threshold, num_directions)
+                if self.placement == "error" and refresh:
+                    draw_dabs([canvas], [dabs.colors], dabs, rotated_brush_masks)
+            layers.append(PaintLayer(brush_size, dabs, rotated_brush_masks))
             refresh = False
-        return canvas, secondary_canvas
+        return layers
 
-    def draw_brush_strokes(self, canvas, secondary_canvas, brush_size, w, h, x, y, x1, y1, draw_color, secondary_draw_color, brush_mask, rotated_brush_masks, num_directions):
-        for _ in range(NUM_PASTES_PER_STROKE):
-            draw_box = (x + x1 - brush_size // 2, y + y1 - brush_size // 2, x + x1 + brush_size // 2, y + y1 + brush_size // 2)
-            draw_box_middle = (int(max(0, min(w - 1, x + x1))), int(max(0, min(h - 1, y + y1))))
-            dx = self.flow_vectors[draw_box_middle[1], draw_box_middle[0], 0]
-            dy = self.flow_vectors[draw_box_middle[1], draw_box_middle[0], 1]
-            intensity = math.log(max(1e-6, self.flow_intensities[draw_box_middle[1], draw_box_middle[0]]))
-            angle = math.atan2(dy, dx) * (180 / math.pi)
-            direction_index = int((angle % 360) / (360 / num_directions))
-            rotated_brush = rotated_brush_masks[direction_index]
-            canvas.paste(draw_color, box=draw_box, mask=rotated_brush)
-            if self.secondary:
-                secondary_canvas.paste(secondary_draw_color, box=draw_box, mask=rotated_brush)
-            
-            if intensity > 12:
+    def plan_strokes(self, blurred_array, blurred_lab, lab, brush_size, refresh, threshold, num_directions):
+        # Decides which grid cells get a stroke and traces every stroke along the flow,
+        # returning all of the layer's brush dabs as arrays instead of drawing them one by one
+        cells = select_cells(lab, blurred_array, blurred_lab, brush_size, refresh, threshold)
+        return trace_strokes(self.flow, *cells, brush_size, num_directions)
+
+    def plan_tiles(self, lab, blurred_array, blurred_lab, brush_size, refresh, threshold, num_directions, executor,
+                   tile_height):
+        # plan_strokes in bands of whole cell rows, planned on `executor`. Every cell's stroke only
+        # depends on the cell and the flow around it, so with the dabs put back in the order
+        # plan_strokes makes them, the result is the same whatever the tiles or workers.
+        h = lab.shape[0]
+        rows = max(1, tile_height // brush_size) * brush_size
+        # Rows a stroke can reach beyond its cell
+        halo = NUM_PASTES_PER_STROKE * (brush_size // 4) + brush_size
+        futures = []
+        for top in range(0, h, rows):
+            bottom = min(h, top + rows)
+            flow_top, flow_bottom = max(0, top - halo), min(h, bottom + halo)
+            futures.append(executor.submit(
+                plan_tile, lab[top:bottom], blurred_array[top:bottom], blurred_lab[top:bottom],
+                self.flow.rows(flow_top, flow_bottom), top, flow_top, h, brush_size, refresh, threshold, num_directions))
+        tiles = [future.result() for future in futures]
+        dabs = BrushDabs(*[np.concatenate(values) for values in zip(*tiles)])
+        dabs = BrushDabs(*[field[np.lexsort((dabs.cell_xs, dabs.cell_ys, dabs.step))] for field in dabs])
+        return dabs._replace(wave=stroke_waves(dabs.xs, dabs.cell_xs, dabs.cell_ys, brush_size))
+
+    def layer_stroke_budgets(self):
+        # Strokes each layer may place with the error placement, None for no limit
+        if self.stroke_budget is None:
+            return [None] * len(self.brush_sizes)
+        h, w = self.image.size[1], self.image.size[0]
+        num_cells = [-(-h // size) * -(-w // size) for size in self.brush_sizes]
+        # The first layer covers every cell regardless of the budget
+        total = sum(num_cells[1:])
+        return [None] + [self.stroke_budget * cells // max(1, total) for cells in num_cells[1:]]
+
+    def place_strokes(self, blurred_array, blurred_lab, canvas, brush_size, threshold, num_directions,
+                      rotated_brush_masks, stroke_budget=None):
+        # Error placement of one layer, drawing the strokes onto `canvas` as they are placed.
+        # Cells are kept in a priority queue of their mean difference between the canvas and the
+        # blurred image. Every round takes the cells with the largest difference, traces and draws
+        # their strokes together, then recomputes the difference of only the cells the dabs touched.
+        h, w = blurred_array.shape[:2]
+        grid_h, grid_w = -(-h // brush_size), -(-w // brush_size)
+        num_cells = grid_h * grid_w
+        if stroke_budget is None:
+            stroke_budget = num_cells
+        counts = cell_sums(np.ones((h, w)), brush_size).ravel()
+        draw_colors = (cell_sums(blurred_array, brush_size) / counts.reshape(grid_h, grid_w, 1)).astype(int)
+
+        # Everything is padded to whole cells, so a cell is a (brush_size, brush_size) block.
+        # The difference of padding pixels is -inf, so they are never the strongest, and counts as 0.
+        padded_h, padded_w = grid_h * brush_size, grid_w * brush_size
+        padded_canvas = np.zeros((padded_h, padded_w, canvas.shape[2]), dtype=np.uint8)
+        padded_canvas[:h, :w] = canvas
+        padded_lab = np.zeros((padded_h, padded_w, 3), dtype=np.float32)
+        padded_lab[:h, :w] = blurred_lab
+        inside = np.zeros((padded_h, padded_w), dtype=bool)
+        inside[:h, :w] = True
+        def blocks(array):
+            return array.reshape(grid_h, brush_size, grid_w, brush_size, *array.shape[2:]).swapaxes(1, 2)
+        canvas_blocks, lab_blocks, inside_blocks = blocks(padded_canvas), blocks(padded_lab), blocks(inside)
+        difference = np.full((padded_h, padded_w), -np.inf, dtype=np.float32)
+        difference_blocks = blocks(difference)
+
+        def update(cell_ys, cell_xs):
+            # Difference of the given cells, returns their mean
+            lab = rgb2lab(canvas_blocks[cell_ys, cell_xs])
+            cell_difference = np.linalg.norm(lab - lab_blocks[cell_ys, cell_xs], axis=-1)
+            cell_difference[~inside_blocks[cell_ys, cell_xs]] = -np.inf
+            difference_blocks[cell_ys, cell_xs] = cell_difference
+            sums = np.where(np.isinf(cell_difference), 0, cell_difference).sum(axis=(1, 2))
+            return sums / counts[cell_ys * grid_w + cell_xs]
+
+        all_ys, all_xs = np.divmod(np.arange(num_cells), grid_w)
+        average = update(all_ys, all_xs)
+        # (-mean difference, version, cell), entries whose version is out of date are skipped
+        version = np.zeros(num_cells, dtype=np.int64)
+        queue = [(-a, 0, cell) for cell, a in enumerate(average.tolist()) if a > threshold]
+        heapq.heapify(queue)
+
+        round_size = max(64, num_cells // 16)
+        stroke_rank = np.zeros(num_cells, dtype=np.int64)
+        rounds = []
+        num_strokes = 0
+        wave_offset = 0
+        while queue and num_strokes < stroke_budget:
+            if self.error_budget is not None and np.dot(average, counts) / (h * w) <= self.error_budget:
                 break
-            
-            x = int(x + dx * (brush_size // 4))
-            y = int(y + dy * (brush_size // 4))
-        
+            cells = []
+            while queue and len(cells) < min(round_size, stroke_budget - num_strokes):
+                _, entry_version, cell = heapq.heappop(queue)
+                if entry_version == version[cell]:
+                    cells.append(cell)
+            if not cells:
+                break
+            cells = np.array(cells)
+            cell_ys, cell_xs = np.divmod(cells, grid_w)
+            # Strokes start at the largest difference in their cell
+            y1, x1 = np.divmod(difference_blocks[cell_ys, cell_xs].reshape(len(cells), -1).argmax(axis=1), brush_size)
+            dabs = trace_strokes(self.flow, cell_ys, cell_xs, x1, y1,
+                                 draw_colors[cell_ys, cell_xs], brush_size, num_directions)
+            # The row major waves of trace_strokes would be nearly empty for scattered cells. Strokes
+            # more than `reach` columns apart can't overlap, so the i-th stroke of every column
+            # shares waves with the i-th of the others. Later rounds are drawn after earlier ones.
+            offset_x = dabs.xs - dabs.cell_xs * brush_size
+            reach = -(-(offset_x.max() - offset_x.min() + brush_size) // brush_size) - 1
+            by_column = np.lexsort((cell_ys, cell_xs))
+            column_starts = np.r_[0, np.flatnonzero(np.diff(cell_xs[by_column])) + 1]
+            rank = np.arange(len(cells)) - np.repeat(column_starts, np.diff(np.r_[column_starts, len(cells)]))
+            stroke_rank[cells[by_column]] = rank
+            dab_cells = dabs.cell_ys * grid_w + dabs.cell_xs
+            dabs = dabs._replace(wave=wave_offset + (reach + 1) * stroke_rank[dab_cells] + dabs.cell_xs % (reach + 1))
+            wave_offset = dabs.wave.max() + 1
+            draw_dabs([padded_canvas], [dabs.colors], dabs, rotated_brush_masks)
+            rounds.append(dabs)
+            num_strokes += len(cells)
+
+            # A dab covers at most 2x2 cells. Painted cells that didn't get better are not queued
+            # again, which keeps a cell the brush can't fix from taking the whole budget.
+            previous = average[cells]
+            touched_ys = np.clip(np.concatenate([dabs.ys // brush_size, dabs.ys // brush_size + 1] * 2), 0, grid_h - 1)
+            touched_xs = np.clip(np.concatenate([dabs.xs // brush_size] * 2 + [dabs.xs // brush_size + 1] * 2), 0, grid_w - 1)
+            touched = np.unique(touched_ys * grid_w + touched_xs)
+            average[touched] = update(*np.divmod(touched, grid_w))
+            version[touched] += 1
+            queued = average[touched] > threshold
+            queued[np.isin(touched, cells[average[cells] >= previous])] = False
+            for cell in touched[queued].tolist():
+                heapq.heappush(queue, (-average[cell], int(version[cell]), cell))
+
+        canvas[...] = padded_canvas[:h, :w]
+        count("paint placement rounds", len(rounds))
+        if not rounds:
+            return trace_strokes(self.flow, all_ys[:0], all_xs[:0], all_xs[:0], all_ys[:0],
+                                 draw_colors.reshape(num_cells, -1)[:0], brush_size, num_directions)
+        return BrushDabs(*[np.concatenate(values) for values in zip(*rounds)])
+
     def set_brush_sizes(self, *args):
         
         for (arg) in args:
@@ -129,47 +304,190 @@ class LayeredPaintImage:
         self.brush_sizes = list(args)
 
 
-class Brush:
-    
-    def __init__(self, image: Image.Image):
-        self.image = image.convert("L")
-    
-
-    def get_bitmap_for_size(self, size: int):
-        scaled_image = self.image.resize((size, size))
-        return scaled_image
-
-    def get_rotated_bitmaps(self, size: int, angle: float, num_directions: int = 8):
-        scaled_image = self.get_bitmap_for_size(size)
-        bitmaps = []
-        for i in range(num_directions):
-            rotated = scaled_image.rotate(angle + i * (360 / num_directions), resample=Image.BILINEAR)
-            bitmaps.append(rotated)
-        return bitmaps
-
-def rgb2lab(rgb):
-    # Function written by chatGPT
-    # Converts from rgb color space to CIELAB (lightness, color a, color b) color space
-
-    # Very rough conversion, enough for SLIC demo
-    rgb = rgb / 255.0
-    mask = rgb > 0.04045
-    rgb[mask] = np.power((rgb[mask] + 0.055) / 1.055, 2.4)
-    rgb[~mask] /= 12.92
-    rgb *= 100
-
-    # sRGB D65 conversion
-    X = rgb[...,0]*0.4124 + rgb[...,1]*0.3576 + rgb[...,2]*0.1805
-    Y = rgb[...,0]*0.2126 + rgb[...,1]*0.7152 + rgb[...,2]*0.0722
-    Z = rgb[...,0]*0.0193 + rgb[...,1]*0.1192 + rgb[...,2]*0.9505
-
-    X /= 95.047; Y /= 100.0; Z /= 108.883
-    XYZ = np.stack([X,Y,Z], axis=-1)
-    mask = XYZ > 0.008856
-    XYZ[mask] = np.cbrt(XYZ[mask])
-    XYZ[~mask] = (7.787 * XYZ[~mask]) + (16/116)
-
-    L = (116 * XYZ[...,1]) - 16
-    a = 500 * (XYZ[...,0] - XYZ[...,1])
-    b = 200 * (XYZ[...,1] - XYZ[...,2])
-    return np.stack([L,a,b], axis=-1)
\ No newline at end of file
+def trace_strokes(flow: CompactFlow, cell_ys, cell_xs, x1, y1, draw_colors, brush_size, num_directions,
+              top=0, height=None):
+    # Traces the stroke of every given cell along the flow from (x1, y1) within the cell,
+    # returning all of the strokes' brush dabs. The flow can be a band of the image's rows
+    # starting at row `top` of an image `height` rows high, that covers everywhere the strokes go.
+    h, w = height or flow.shape[0], flow.shape[1]
+
+    # Trace all strokes at once, one paste of every still active stroke per step
+    x, y = cell_xs * brush_size, cell_ys * brush_size
+    active = np.arange(len(cell_ys))
+    steps = []
+    for step in range(NUM_PASTES_PER_STROKE):
+        if len(active) == 0:
+            break
+        sx, sy = x[active] + x1[active], y[active] + y1[active]
+        middle_x, middle_y = np.clip(sx, 0, w - 1), np.clip(sy, 0, h - 1)
+        dx, dy = flow.tangents(middle_y - top, middle_x)
+        intensity = flow.log_intensities[middle_y - top, middle_x]
+        direction_index = flow.direction_indices(middle_y - top, middle_x, num_directions).astype(int)
+        steps.append((active, np.full(len(active), step), sx - brush_size // 2, sy - brush_size // 2, direction_index))
+
+        keep = intensity <= 12
+        active, dx, dy = active[keep], dx[keep], dy[keep]
+        x[active] = np.trunc(x[active].astype(np.float32) + dx * np.float32(brush_size // 4))
+        y[active] = np.trunc(y[active].astype(np.float32) + dy * np.float32(brush_size // 4))
+
+    if not steps:
+        empty = np.zeros(0, dtype=int)
+        return BrushDabs(empty, empty, empty, empty, empty, draw_colors[:0], empty, empty)
+    stroke, step, box_x, box_y, direction_index = [np.concatenate(values) for values in zip(*steps)]
+    wave = stroke_waves(box_x, cell_xs[stroke], cell_ys[stroke], brush_size)
+    return BrushDabs(wave, step, box_x, box_y, direction_index, draw_colors[stroke], cell_xs[stroke], cell_ys[stroke])
+
+def stroke_waves(xs, cell_xs, cell_ys, brush_size):
+    # Strokes whose cells are more than `reach` columns apart can't overlap, so with
+    # wave = (reach + 1) * row + column every stroke on a wave can be drawn at the same time,
+    # and a stroke always lands on a later wave than the earlier (row major) strokes it may overlap
+    if len(xs) == 0:
+        return np.zeros(0, dtype=int)
+    offset_x = xs - cell_xs * brush_size
+    reach = -(-(offset_x.max() - offset_x.min() + brush_size) // brush_size) - 1
+    return (reach + 1) * cell_ys + cell_xs
+
+def select_cells(lab, blurred_array, blurred_lab, brush_size, refresh, threshold):
+    # The cells that get a stroke, every one with `refresh`, otherwise those whose mean difference
+    # between `lab` and the blurred image is above the threshold. Returns their rows, columns, the
+    # offsets of their strokes within them and their colors.
+    h, w = blurred_array.shape[:2]
+    grid_h, grid_w = -(-h // brush_size), -(-w // brush_size)
+
+    difference_array = np.linalg.norm(lab - blurred_lab, axis=2)
+    counts = cell_sums(np.ones((h, w)), brush_size)
+    average = cell_sums(difference_array, brush_size) / counts
+
+    # Strongest difference in each cell, padding never wins
+    padded = np.full((grid_h * brush_size, grid_w * brush_size), -np.inf, dtype=difference_array.dtype)
+    padded[:h, :w] = difference_array
+    cells = padded.reshape(grid_h, brush_size, grid_w, brush_size).transpose(0, 2, 1, 3)
+    strongest = cells.reshape(grid_h, grid_w, -1).argmax(axis=2)
+
+    cell_ys, cell_xs = np.nonzero(np.full((grid_h, grid_w), refresh) | (average > threshold))
+    # (row, column) of the strongest difference, applied as (x, y) offsets like before
+    x1, y1 = np.divmod(strongest[cell_ys, cell_xs], brush_size)
+
+    draw_colors = (cell_sums(blurred_array, brush_size) / counts[..., None]).astype(int)
+    return cell_ys, cell_xs, x1, y1, draw_colors[cell_ys, cell_xs]
+
+def plan_tile(lab_rows, blurred_rows, blurred_lab_rows, flow, top, flow_top, height, brush_size, refresh, threshold,
+              num_directions):
+    # The strokes of a band of whole cell rows starting at image row `top`, see plan_tiles
+    cell_ys, cell_xs, x1, y1, colors = select_cells(lab_rows, blurred_rows, blurred_lab_rows, brush_size, refresh,
+                                                    threshold)
+    return trace_strokes(flow, cell_ys + top // brush_size, cell_xs, x1, y1, colors,
+                         brush_size, num_directions, flow_top, height)
+
+def cell_sums(array, cell_size):
+    # Sum of every cell_size x cell_size cell of a (H, W) or (H, W, C) array, partial cells included
+    h, w = array.shape[:2]
+    grid_h, grid_w = -(-h // cell_size), -(-w // cell_size)
+    padded = np.zeros((grid_h * cell_size, grid_w * cell_size) + array.shape[2:], dtype=np.float64)
+    padded[:h, :w] = array
+    return padded.reshape(grid_h, cell_size, grid_w, cell_size, *array.shape[2:]).sum(axis=(1, 3))
+
+def initial_canvas(pyramid, brush_size):
+    # The primary is painted over a blurred copy of itself, as RGBA
+    blurred = pyramid.rgb(brush_size * BLUR_FACTOR)
+    canvas = np.full((*blurred.shape[:2], 4), 255, dtype=np.uint8)
+    canvas[..., :blurred.shape[2]] = np.clip(np.rint(blurred), 0, 255)
+    return canvas
+
+def cell_colors(secondary_array, brush_size, dabs):
+    # Color of each dab in a secondary image, the mean of the cell its stroke started from.
+    # Cells are cropped from the secondary image, which pads with black past its edges.
+    h, w = secondary_array.shape[:2]
+    sums = cell_sums(secondary_array.reshape(h, w, -1), brush_size)
+    return (sums[dabs.cell_ys, dabs.cell_xs] / (brush_size * brush_size)).astype(int)
+
+def draw_dabs(canvases, colors, dabs, rotated_brush_masks):
+    # Pastes every dab onto each (H, W, C) uint8 canvas in place, with its color from `colors`.
+    # The result is the same as pasting them one by one in stroke order with PIL, but the canvases
+    # are drawn together and a whole (wave, step) group of non overlapping dabs is blended at once.
+    size = rotated_brush_masks.shape[1]
+    h, w = canvases[0].shape[:2]
+    count("dabs pasted", len(dabs.xs) * len(canvases))
+    count("pixels touched", len(dabs.xs) * len(canvases) * size * size)
+    channels = [canvas.reshape(h, w, -1).shape[2] for canvas in canvases]
+    ink = []
+    for color, channel_count in zip(colors, channels):
+        if color.shape[1] < channel_count:
+            color = np.pad(color, ((0, 0), (0, channel_count - color.shape[1])), constant_values=255) # opaque
+        ink.append(color[:, :channel_count])
+    ink = np.concatenate(ink, axis=1).astype(np.uint16)
+
+    # All canvases are interleaved into one padded canvas, with the channels padded to a multiple
+    # of 8 so a pixel can be moved around as uint64 words. Strokes wander a few brush sizes at
+    # most, so the padding avoids any clipping.
+    pad = 3 * size
+    total_channels = -(-sum(channels) // 8) * 8
+    padded = np.zeros((h + 2 * pad, w + 2 * pad, total_channels), dtype=np.uint8)
+    padded[pad:-pad, pad:-pad, :sum(channels)] = np.dstack([canvas.reshape(h, w, -1) for canvas in canvases])
+    ink = np.pad(ink, ((0, 0), (0, total_channels - sum(channels))))
+    pixels = padded.view(np.uint64).reshape(-1, total_channels // 8)
+    offsets = (np.arange(size)[:, None] * padded.shape[1] + np.arange(size)[None, :]).ravel()
+    masks = rotated_brush_masks.reshape(len(rotated_brush_masks), -1, 1).astype(np.uint16)
+
+    order = np.lexsort((dabs.step, dabs.wave))
+    group_key = dabs.wave[order] * NUM_PASTES_PER_STROKE + dabs.step[order]
+    bounds = np.r_[0, np.flatnonzero(np.diff(group_key)) + 1, len(order)]
+
+    # Per dab pixel indices and blend terms are prepared for a batch of groups at a time
+    batch_size = max(1, 2 ** 21 // (size * size))
+    first = 0
+    while first < len(bounds) - 1:
+        last = np.searchsorted(bounds, bounds[first] + batch_size, side='right') - 1
+        last = max(last, first + 1)
+        batch = order[bounds[first]:bounds[last]]
+        corners = (dabs.ys[batch] + pad) * padded.shape[1] + dabs.xs[batch] + pad
+        indices = corners[:, None] + offsets[None, :]
+        mask = masks[dabs.directions[batch]]
+        keep = 255 - mask
+        add = ink[batch][:, None, :] * mask + 128
+        for start, end in zip(bounds[first:last] - bounds[first], bounds[first + 1:last + 1] - bounds[first]):
+            index = indices[start:end]
+            blended = pixels[index].view(np.uint8) * keep[start:end] + add[start:end]
+            blended += blended >> 8
+            blended >>= 8
+            pixels[index] = blended.astype(np.uint8).view(np.uint64)
+        first = last
+
+    start = 0
+    for canvas, channel_count in zip(canvases, channels):
+        canvas.reshape(h, w, channel_count)[...] = padded[pad:-pad, pad:-pad, start:start + channel_count]
+        start += channel_count
+
+def draw_dabs_tiled(canvases, colors, dabs, rotated_brush_masks, executor: Executor, tile_height=TILE_HEIGHT):
+    # Same as draw_dabs, with the canvases cut into horizontal tiles of tile_height rows that are drawn
+    # on `executor`. Every tile gets the dabs that overlap it, clipped to it, and draws them in the
+    # same (wave, step) order, so every pixel is blended with the same dabs in the same order and the
+    # result doesn't depend on the tiles or the number of workers.
+    # A ThreadPoolExecutor draws straight into the canvases, a ProcessPoolExecutor gets copies of the
+    # tiles but isn't held back by the GIL in draw_dabs' loop over the dab groups.
+    size = rotated_brush_masks.shape[1]
+    h = canvases[0].shape[0]
+    futures = []
+    for top in range(0, h, tile_height):
+        bottom = min(h, top + tile_height)
+        selected, tile_dabs = band_dabs(dabs, size, top, bottom)
+        if len(selected) == 0:
+            continue
+        futures.append((top, bottom, executor.submit(
+            draw_tile, [canvas[top:bottom] for canvas in canvases], [color[selected] for color in colors],
+            tile_dabs, rotated_brush_masks)))
+    for top, bottom, future in futures:
+        for canvas, tile in zip(canvases, future.result()):
+            canvas[top:bottom] = tile
+
+def band_dabs(dabs, size, top, bottom):
+    # Indices of the dabs of brush `size` that overlap rows top to bottom, and those dabs with their
+    # rows relative to `top`. Drawing them onto those rows of the canvases blends every pixel there
+    # like drawing all of the dabs onto the whole canvases.
+    selected = np.flatnonzero((dabs.ys < bottom) & (dabs.ys + size > top))
+    band = BrushDabs(*[field[selected] for field in dabs])
+    return selected, band._replace(ys=band.ys - top)
+
+def draw_tile(canvases, colors, dabs, rotated_brush_masks):
+    draw_dabs(canvases, colors, dabs, rotated_brush_masks)
+    return canvases
@@ -1,10 +1,20 @@
-from PIL import Image, ImageDraw
-from slic import SLICImage
+from PIL import Image
 from layered_paint import LayeredPaintImage
+from brush_atlas import BrushAtlas
 from kuwahara import Kuwahara
-from flow_direction import FlowDirection
+from flow_direction import FlowDirection, pack_flow, unpack_flow
+from result_cache import ResultCache
+from color import content_key
+from image_io import decoded_image, save_image, to_image
+from guidance import SLICGuidance, KuwaharaGuidance, StrokeGuidance
+import profiling
+from profiling import span
+import inspect
+import numpy as np
 import os
+import sys
 import time
+import cv2
 
 albedo_images = [
     "earth_albedo.png",
@@ -26,6 +36,11 @@ outputs_dir = os.path.join(script_dir, "Outputs")
 
 os.makedirs(outputs_dir, exist_ok=True)
 
+# Rotated brush masks are reused across images, and across runs through the files in the cache folder
+brush_atlas = BrushAtlas(cache_dir=os.path.join(outputs_dir, "BrushCache"))
+# Filter outputs and their intermediate results, so unchanged inputs and parameters aren't recomputed
+result_cache = ResultCache(os.path.join(outputs_dir, "ResultCache"))
+
 def input_path(filename):
     return os.path.join(inputs_dir, filename)
 
@@ -35,62 +50,170 @@ def output_path(filename, suffix=None):
         filename = f"{name}_{suffix}{ext}"
     return os.path.join(outputs_dir, filename)
 
-def quick_slic(image: str, secondary_image: str):
-    image_input = Image.open(input_path(image))
-    slic_image = SLICImage(image_input, ImageDraw.Draw(image_input))
-    start = time.time()
-    labels, centers = slic_image.slic(superpixel_size=32, num_iterations=10, compactness=13)
-    slic_image.draw_splots(labels)
-    
-    if secondary_image is None:
-        return
-
-    secondary_input = Image.open(input_path(secondary_image))
-    slic_secondary = SLICImage(secondary_input, ImageDraw.Draw(secondary_input))
-    slic_secondary.draw_splots(labels)
-    end = time.time()
-    print(f"SLIC filter for {image} took {end - start:.2f} seconds")
-    slic_image.image.save(output_path(image, "SLIC"))
-    slic_secondary.image.save(output_path(secondary_image, "SLIC"))
+def load_input(filename):
+    # Decoded once, with all of its bits, then memory mapped from the cache, see image_io.py
+    return decoded_image(input_path(filename), result_cache)
 
-def quick_layered_paint(image: str, secondary_image: str, *brush_sizes):
-    image_input = Image.open(input_path(image))
-    secondary_input = None
-    if secondary_image is not None:
-        secondary_input = Image.open(input_path(secondary_image))
-    
-    layered_paint = LayeredPaintImage(image_input, secondary_input)
-    layered_paint.set_flow_map()
+def image_key(image):
+    # Identifies the decoded pixels, so the same input hits the cache however it was loaded
+    if isinstance(image, Image.Image):
+        return content_key(np.asarray(image)) + image.mode
+    return content_key(image)
+
+def flow_direction_for(image_input):
+    # FlowDirection of an image with its structure tensor eigen decomposition computed or loaded
+    flow_direction = FlowDirection(image_input)
+    def compute():
+        flow_direction.compute_flow()
+        return {"eigenvalues": flow_direction.eigenvalues, "tangents": flow_direction.tangents,
+                "angles": flow_direction.angles}
+    flow = result_cache.cached(result_cache.key("flow", image_key(image_input)), compute)
+    flow_direction.eigenvalues, flow_direction.tangents, flow_direction.angles = \
+        flow["eigenvalues"], flow["tangents"], flow["angles"]
+    return flow_direction
+
+def compact_flow_for(image_input):
+    # The flow LayeredPaint follows, memory mapped from the cache so runs and batch workers painting
+    # the same image share one copy of it
+    packed = result_cache.mapped(result_cache.key("compact_flow", image_key(image_input)),
+                                 lambda: pack_flow(flow_direction_for(image_input).compact_flow()))
+    return unpack_flow(packed)
+
+def cached_guidance(guidance_class, image_input, *key_parts, compute=None, **params):
+    # Guidance computed from the primary image with `params`, see guidance.py. Anything else the
+    # result depends on goes in `key_parts`, and `compute` can replace guidance_class.compute.
+    compute = compute or (lambda: guidance_class.compute(image_input, **params))
+    key = result_cache.key(guidance_class.kind, image_key(image_input), params, *key_parts)
+    return guidance_class.from_arrays(result_cache.cached(key, lambda: compute().to_arrays()))
+
+# Each filter takes the decoded primary and secondary (or None) images plus its parameters, and returns
+# the images to save as (input filename to name it after, output suffix, image), with "primary" and
+# "secondary" standing in for the input filenames. Intermediate results that only depend on the
+# primary image go through result_cache, so changing a secondary image doesn't recompute them.
+# The inputs are read only arrays of any bit depth. The structure the filters follow is found on an
+# 8-bit copy of the primary (to_image), but SLIC and Kuwahara filter the images themselves, so 16-bit
+# inputs give 16-bit outputs. LayeredPaint draws with 8-bit brushes and gives 8-bit outputs.
+
+def slic_filter(image_input, secondary_input, superpixel_size=32, num_iterations=10, compactness=13, pyramid_levels=0):
+    # pyramid_levels=2 is about 4x faster on large inputs, see `python benchmark.py slic_pyramid`
+    params = {"superpixel_size": superpixel_size, "num_iterations": num_iterations, "compactness": compactness,
+              "pyramid_levels": pyramid_levels}
+    guidance = cached_guidance(SLICGuidance, to_image(image_input), **params)
+    images = [image for image in (image_input, secondary_input) if image is not None]
+    return list(zip(["primary", "secondary"], ["SLIC"] * 2, guidance.apply(images)))
+
+def layered_paint_filter(image_input, secondary_input, brush_sizes=(6, 40, 80), brush="rough2", placement="grid",
+                         stroke_budget=None, error_budget=None):
+    # placement="error" puts the strokes where the painting differs most from the image, up to
+    # stroke_budget strokes, see LayeredPaintImage.set_placement and `python benchmark.py paint_placement`.
+    # The strokes depend on the brush pixels too, a redrawn brush changes the painting
+    image_input = to_image(image_input)
+    secondary_input = to_image(secondary_input) if secondary_input is not None else None
+    guidance = cached_guidance(
+        StrokeGuidance, image_input, brush_atlas.get_brush(brush).key, brush_sizes=list(brush_sizes), brush=brush,
+        placement=placement, stroke_budget=stroke_budget, error_budget=error_budget,
+        compute=lambda: StrokeGuidance.compute(image_input, brush_sizes, brush, brush_atlas, compact_flow_for(image_input),
+                                               placement, stroke_budget, error_budget))
+    layered_paint = LayeredPaintImage(image_input, secondary_input, brush=brush, atlas=brush_atlas)
     layered_paint.set_brush_sizes(*brush_sizes)
-    
+    painted_image, painted_secondary = layered_paint.paint(guidance.layers)
+
+    outputs = [("primary", "LayeredPaint", painted_image)]
+    if secondary_input is not None:
+        outputs.append(("secondary", "LayeredPaint", painted_secondary))
+    return outputs
+
+def kuwahara_filter(image_input, secondary_input, method='gaussian', radius=15):
+    if method == 'anisotropic':
+        # primary and secondary are filtered together, so only the final outputs are cached
+        primary = to_image(image_input)
+        kuwahara = Kuwahara(method=method, radius=radius, flow=flow_direction_for(primary))
+        # The quadrants are chosen on the 8-bit primary like the other methods: the float32 variances
+        # of 16-bit values would be mostly rounding
+        guide = np.asarray(primary)
+        image_2d = guide if guide.ndim == 2 else cv2.cvtColor(guide, cv2.COLOR_BGR2GRAY)
+        images = [image for image in (image_input, secondary_input) if image is not None]
+        return list(zip(["primary", "secondary"], ["Kuwahara"] * 2,
+                        kuwahara.anisotropic_kuwahara(images, radius=radius, image_2d=image_2d)))
+
+    # The quadrants chosen on the primary are all that's needed to filter both images in one pass
+    guidance = cached_guidance(KuwaharaGuidance, to_image(image_input), method=method, radius=radius)
+    images = [image for image in (image_input, secondary_input) if image is not None]
+    return list(zip(["primary", "secondary"], ["Kuwahara"] * 2, guidance.apply(images)))
+
+def flow_normals_filter(image_input, secondary_input):
+    flow_direction = flow_direction_for(to_image(image_input))
+    height_image = flow_direction.blur_along_flow()
+    normal_image = flow_direction.compute_normals()
+    return [("primary", "FlowHeight", height_image), ("primary", "FlowNormals", normal_image)]
+
+FILTERS = {
+    "slic": (slic_filter, "SLIC"),
+    "layered_paint": (layered_paint_filter, "LayeredPaint"),
+    "kuwahara": (kuwahara_filter, "Kuwahara"),
+    "flow_normals": (flow_normals_filter, "FlowNormals"),
+}
+
+def run_filter(name: str, image_input, secondary_input, **params):
+    # Runs a filter from FILTERS, or loads its outputs if it already ran on the same images and parameters
+    filter_function, _ = FILTERS[name]
+    arguments = inspect.signature(filter_function).bind(image_input, secondary_input, **params)
+    arguments.apply_defaults()
+    params = dict(list(arguments.arguments.items())[2:]) # defaults included, so omitting them gives the same key
+    parts = [image_key(image_input), image_key(secondary_input) if secondary_input is not None else None, params]
+    if name == "layered_paint":
+        parts.append(brush_atlas.get_brush(params["brush"]).key) # a redrawn brush changes the painting
+    key = result_cache.key(name, *parts)
+
+    with span("cache lookup", filter=name):
+        cached = result_cache.load(key)
+    if cached is not None:
+        return [(role, suffix, cached[f"image_{i}"]) for i, (role, suffix) in enumerate(cached["outputs"])]
+
+    with span(f"filter {name}", **params):
+        outputs = filter_function(image_input, secondary_input, **params)
+    arrays = {f"image_{i}": np.asarray(output) for i, (_, _, output) in enumerate(outputs)}
+    arrays["outputs"] = np.array([(role, suffix) for role, suffix, _ in outputs])
+    with span("cache store", filter=name):
+        result_cache.store(key, arrays)
+    return outputs
+
+def save_outputs(outputs, image: str, secondary_image: str):
+    filenames = {"primary": image, "secondary": secondary_image}
+    paths = []
+    for role, suffix, output in outputs:
+        paths.append(output_path(filenames[role], suffix))
+        with span("save image", path=paths[-1]):
+            save_image(paths[-1], output)
+    return paths
+
+def quick_filter(name: str, image: str, secondary_image: str, **params):
+    with span("load images"):
+        image_input = load_input(image)
+        secondary_input = load_input(secondary_image) if secondary_image is not None else None
+
+    _, label = FILTERS[name]
     start = time.time()
-    painted_image, painted_secondary = layered_paint.paint()
+    outputs = run_filter(name, image_input, secondary_input, **params)
     end = time.time()
-    print(f"LayeredPaint filter for {image} took {end - start:.2f} seconds")
-    
-    painted_image.save(output_path(image, "LayeredPaint"))
-    if secondary_image is not None:
-        painted_secondary.save(output_path(secondary_image, "LayeredPaint"))
+    print(f"{label} filter for {image} took {end - start:.2f} seconds")
+    save_outputs(outputs, image, secondary_image)
+
+def quick_slic(image: str, secondary_image: str):
+    quick_filter("slic", image, secondary_image)
+
+def quick_layered_paint(image: str, secondary_image: str, *brush_sizes):
+    quick_filter("layered_paint", image, secondary_image, brush_sizes=brush_sizes)
 
 def quick_kuwahara(image: str, secondary_image: str):
-    image_input = Image.open(input_path(image))
-    secondary_input = None
-    if secondary_image is not None:
-        secondary_input = Image.open(input_path(secondary_image))
-    
-    kuwahara_filter = Kuwahara(method='gaussian', radius=15, primary_image=image_input, secondary_image=secondary_input)
-    
-    start = time.time()
-    kuwahara_filter.apply()
-    img, img_2 = kuwahara_filter.get_results()
-    end = time.time()
-    print(f" Kuwahara filter for {image} took {end - start:.2f} seconds")
-    
-    img.save(output_path(image, "Kuwahara"))
-    if secondary_image is not None:
-        img_2.save(output_path(secondary_image, "Kuwahara"))
+    quick_filter("kuwahara", image, secondary_image)
+
+def quick_flow_normals(image: str):
+    quick_filter("flow_normals", image, None)
 
 if __name__ == "__main__":
+    # --profile prints where the time went and writes a Chrome trace, see profiling.py
+    profiler = profiling.enable() if "--profile" in sys.argv else None
     for i in range(len(normal_images)):
         primary = normal_images[i]
         secondary = albedo_images[i]
@@ -100,5 +223,11 @@ if __name__ == "__main__":
         quick_slic(primary, secondary)
         quick_layered_paint(primary, secondary, 6, 40, 80)
         quick_kuwahara(primary, secondary)
+        quick_flow_normals(primary)
         
         print(f"Saved outputs for {primary} + {secondary} to {outputs_dir}")
+
+    if profiler is not None:
+        profiling.disable()
+        print(profiler.summary())
+        profiler.save_chrome_trace(os.path.join(outputs_dir, "profile.json"))
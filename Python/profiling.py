@@ -0,0 +1,178 @@
+# Named spans, counters and memory samples showing where the filters spend their time
+# The filters wrap their stages in `with span("name"):` and call `count("name", n)`. Both do nothing
+# until enable() is called: span() then hands back a shared no-op context manager and count()
+# returns right away, so the instrumentation costs a function call per stage when it is off.
+#
+# Run `python main.py --profile` to print a summary and write Outputs/profile.json, a Chrome trace
+# that chrome://tracing or https://ui.perfetto.dev can open, or use
+#   profiler = enable()
+#   ...
+#   disable(); print(profiler.summary()); profiler.save_chrome_trace("trace.json")
+
+from contextlib import contextmanager, nullcontext
+from typing import NamedTuple
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+class Span(NamedTuple):
+    name: str
+    start: float # seconds since the profiler was created
+    seconds: float
+    depth: int # 0 for outermost spans
+    thread: int
+    peak_bytes: int # see Profiler, None when memory isn't sampled
+    args: dict
+
+class CounterSample(NamedTuple):
+    name: str
+    time: float
+    total: float
+
+class Profiler:
+    # Records spans and counters. With trace_memory, peak_bytes is the highest memory traced by
+    # tracemalloc (which includes numpy arrays) while the span ran, this slows everything down by
+    # 2-3x so only the peaks can be trusted then, not the timings. Otherwise it is the peak resident
+    # size of the process since it started (ru_maxrss), sampled when the span ends: it only ever goes
+    # up, so it isn't the span's own peak, and summary() labels it "max RSS MB".
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.spans = []
+        self.counters = {}
+        self.counter_samples = []
+        self.origin = time.perf_counter()
+        self.local = threading.local()
+        # Counters are updated from worker threads, e.g. draw_dabs_tiled on a ThreadPoolExecutor
+        self.lock = threading.Lock()
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def span(self, name, **args):
+        stack = self.local.__dict__.setdefault("stack", [])
+        if self.trace_memory:
+            # tracemalloc only has one peak, so it is restarted for every span and the peaks of
+            # the spans inside are carried up the stack
+            if stack:
+                stack[-1] = max(stack[-1], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        stack.append(0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            peak = stack.pop()
+            if self.trace_memory:
+                peak = max(peak, tracemalloc.get_traced_memory()[1])
+                if stack:
+                    stack[-1] = max(stack[-1], peak)
+            else:
+                peak = peak_resident_bytes()
+            self.spans.append(Span(name, start - self.origin, seconds, len(stack), threading.get_ident(), peak, args))
+
+    def count(self, name, n=1):
+        with self.lock:
+            total = self.counters.get(name, 0) + n
+            self.counters[name] = total
+            self.counter_samples.append(CounterSample(name, time.perf_counter() - self.origin, total))
+
+    def totals(self):
+        # {name: (calls, total seconds, seconds not spent in spans inside it)} in order of total time
+        totals = {}
+        child_seconds = {}
+        # Spans are recorded when they end, so the spans inside one come before it
+        open_children = {}
+        for span in self.spans:
+            inner = open_children.pop((span.thread, span.depth + 1), 0.0)
+            key = (span.thread, span.depth)
+            open_children[key] = open_children.get(key, 0.0) + span.seconds
+            calls, seconds, self_seconds = totals.get(span.name, (0, 0.0, 0.0))
+            totals[span.name] = (calls + 1, seconds + span.seconds, self_seconds + span.seconds - inner)
+        return dict(sorted(totals.items(), key=lambda item: -item[1][1]))
+
+    def summary(self):
+        memory = "peak MB" if self.trace_memory else "max RSS MB"
+        lines = [f"{'span':<32} {'calls':>6} {'total s':>9} {'self s':>9} {memory:>10}"]
+        peaks = {}
+        for span in self.spans:
+            if span.peak_bytes is not None:
+                peaks[span.name] = max(peaks.get(span.name, 0), span.peak_bytes)
+        for name, (calls, seconds, self_seconds) in self.totals().items():
+            peak = f"{peaks[name] / 2**20:10.1f}" if name in peaks else f"{'':10}"
+            lines.append(f"{name:<32} {calls:>6} {seconds:>9.3f} {self_seconds:>9.3f} {peak}")
+        for name, total in self.counters.items():
+            lines.append(f"{name:<32} {total:>16,}")
+        return "\n".join(lines)
+
+    def to_dict(self):
+        return {
+            "spans": [span._asdict() for span in self.spans],
+            "counters": self.counters,
+            "totals": {name: dict(zip(("calls", "seconds", "self_seconds"), values))
+                       for name, values in self.totals().items()},
+        }
+
+    def save_json(self, path):
+        with open(path, "w") as file:
+            json.dump(self.to_dict(), file, indent=1, default=str)
+
+    def chrome_trace(self):
+        # Trace Event Format: complete events for spans, counter events for counters and memory
+        pid = os.getpid()
+        memory = "peak MB" if self.trace_memory else "max RSS MB"
+        events = []
+        for span in self.spans:
+            events.append({"name": span.name, "ph": "X", "ts": span.start * 1e6, "dur": span.seconds * 1e6,
+                           "pid": pid, "tid": span.thread, "args": {key: str(value) for key, value in span.args.items()}})
+            if span.peak_bytes is not None:
+                events.append({"name": "memory", "ph": "C", "ts": (span.start + span.seconds) * 1e6, "pid": pid,
+                               "args": {memory: span.peak_bytes / 2**20}})
+        for sample in self.counter_samples:
+            events.append({"name": sample.name, "ph": "C", "ts": sample.time * 1e6, "pid": pid,
+                           "args": {sample.name: sample.total}})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def save_chrome_trace(self, path):
+        with open(path, "w") as file:
+            json.dump(self.chrome_trace(), file)
+
+def peak_resident_bytes():
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if os.uname().sysname == "Darwin" else peak * 1024
+
+profiler = None
+no_span = nullcontext()
+
+def enable(trace_memory=False):
+    # Starts recording into a new Profiler and returns it
+    global profiler
+    profiler = Profiler(trace_memory)
+    return profiler
+
+def disable():
+    # Stops recording, the Profiler returned by enable() keeps what it recorded
+    global profiler
+    if profiler is not None and profiler.trace_memory:
+        tracemalloc.stop()
+    profiler = None
+
+def span(name, **args):
+    if profiler is None:
+        return no_span
+    return profiler.span(name, **args)
+
+def count(name, n=1):
+    if profiler is not None:
+        profiler.count(name, n)
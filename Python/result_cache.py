@@ -0,0 +1,129 @@
+# Content addressed on-disk cache for filter results
+# Entries are .npz files of named arrays, keyed by a hash of what produced them: the filter or
+# intermediate step, the content keys of its inputs and its parameters. Unchanged inputs and
+# parameters load their results instead of recomputing them, and the least recently used entries
+# are deleted once the cache grows past `max_bytes`. Single large arrays that many runs and processes
+# read, like the compact flow field, can be stored as .npy files instead and memory mapped.
+
+import hashlib
+import json
+import numpy as np
+import os
+import tempfile
+
+# Bump when a filter changes its output, so older entries stop matching
+CACHE_VERSION = 6
+DEFAULT_MAX_BYTES = 2 * 2**30
+
+class ResultCache:
+
+    def __init__(self, directory: str = None, max_bytes: int = DEFAULT_MAX_BYTES):
+        # Without a directory the cache is disabled, every lookup misses and nothing is stored
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def key(self, name: str, *parts):
+        # `parts` can be anything JSON serializable, e.g. color.content_key() strings and parameter dicts
+        description = json.dumps([CACHE_VERSION, name, *parts], sort_keys=True, default=str)
+        return f"{name}_{hashlib.blake2b(description.encode(), digest_size=16).hexdigest()}"
+
+    def path(self, key, extension=".npz"):
+        return os.path.join(self.directory, f"{key}{extension}")
+
+    def load(self, key):
+        # The stored dict of arrays, or None on a miss
+        if self.directory is None:
+            self.misses += 1
+            return None
+        path = self.path(key)
+        try:
+            with np.load(path) as data:
+                arrays = {name: data[name] for name in data.files}
+            # The modification time doubles as the last use time for eviction
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            # Missing, evicted meanwhile by another process, or truncated
+            self.misses += 1
+            return None
+        self.hits += 1
+        return arrays
+
+    def store(self, key, arrays: dict):
+        if self.directory is None:
+            return
+        self.write(self.path(key), lambda file: np.savez(file, **arrays))
+
+    def write(self, path, save):
+        # Written next to the final file and renamed, so concurrent readers never see half of it
+        handle, temp_path = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        try:
+            with os.fdopen(handle, "wb") as file:
+                save(file)
+            os.replace(temp_path, path)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return
+        self.evict()
+
+    def cached(self, key, compute):
+        # compute() returns a dict of arrays, and is only called on a miss
+        arrays = self.load(key)
+        if arrays is None:
+            arrays = compute()
+            self.store(key, arrays)
+        return arrays
+
+    def mapped(self, key, compute):
+        # Like cached() for a single array that compute() returns, stored as .npy and returned memory
+        # mapped (read only) on a hit, so processes reading the same entry share its pages. Without
+        # a directory compute()'s array is returned as is.
+        if self.directory is not None:
+            path = self.path(key, ".npy")
+            try:
+                array = np.load(path, mmap_mode="r")
+                os.utime(path)
+                self.hits += 1
+                return array
+            except (OSError, ValueError):
+                pass
+        self.misses += 1
+        array = compute()
+        if self.directory is None:
+            return array
+        self.write(path, lambda file: np.save(file, array))
+        try:
+            return np.load(path, mmap_mode="r")
+        except (OSError, ValueError):
+            # Evicted right away, the cache is smaller than the array
+            return array
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith((".npz", ".npy")):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        if self.directory is None:
+            return
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith((".npz", ".npy")):
+                os.remove(entry.path)
@@ -0,0 +1,332 @@
+# Filters for frame sequences (directories of PNG frames, e.g. a rendered turntable)
+# Frames are streamed through generators, one at a time. Each filter keeps what it computed for the
+# previous frame and only redoes the work the changes in the new frame require:
+#   SLIC warm starts from the previous frame's centers, which takes fewer iterations and keeps the
+#   superpixels from jumping around between frames
+#   Kuwahara and the flow field of LayeredPaint are recomputed only in the strips of rows that
+#   changed, which gives exactly the same result as filtering the whole frame
+#   LayeredPaint keeps the previous frame's strokes and only plans and draws again the ones that
+#   changed, with the same result as painting the frame from scratch
+#   identical frames reuse the previous output as is
+#
+# Run `python sequence.py <filter> <frames dir> <output dir> [secondary frames dir]`, with a filter
+# from SEQUENCE_FILTERS.
+
+from PIL import Image
+import numpy as np
+import os
+import sys
+import time
+from slic import SLICImage
+from kuwahara import Kuwahara
+from layered_paint import LayeredPaintImage, BrushDabs, PaintLayer, BLUR_FACTOR, STROKE_THRESHOLD, NUM_DIRECTIONS, \
+    plan_tile, stroke_waves, initial_canvas, cell_colors, band_dabs, draw_dabs
+from flow_direction import FlowDirection, CompactFlow
+from blur_pyramid import blur_pyramid
+from image_io import image_like
+from profiling import span
+from brush_atlas import default_atlas
+
+# Rows around a change whose flow is affected: the 5x5 Sobel and the sigma 2 gaussian reach 10 rows
+FLOW_HALO = 16
+
+def read_frames(directory):
+    # Yields (filename, image) for every PNG in the directory, in name order
+    for filename in sorted(os.listdir(directory)):
+        if filename.lower().endswith(".png"):
+            image = Image.open(os.path.join(directory, filename))
+            image.load()
+            yield filename, image
+
+def changed_rows(previous, current, threshold=0):
+    # Boolean per row, True where any pixel differs by more than `threshold`
+    if previous is None or previous.shape != current.shape:
+        return np.ones(current.shape[0], dtype=bool)
+    if threshold == 0:
+        # Exact, for any dtype
+        return (previous != current).reshape(current.shape[0], -1).any(axis=1)
+    difference = np.abs(previous.astype(np.int16) - current.astype(np.int16))
+    return (difference > threshold).reshape(current.shape[0], -1).any(axis=1)
+
+def dirty_strips(rows, strip_height, halo):
+    # First rows of the strips that have a changed row within `halo` rows of them
+    changed = np.flatnonzero(rows)
+    if len(changed) == 0:
+        return []
+    h = len(rows)
+    strips = np.arange(0, h, strip_height)
+    # A strip [y0, y0 + strip_height) is dirty if a changed row falls in [y0 - halo, y0 + strip_height + halo)
+    first = np.searchsorted(changed, strips - halo)
+    last = np.searchsorted(changed, strips + strip_height + halo)
+    return list(strips[last > first])
+
+class SLICSequence:
+
+    def __init__(self, superpixel_size=32, compactness=13, num_iterations=10, warm_iterations=3, convergence_threshold=0.25):
+        self.superpixel_size = superpixel_size
+        self.compactness = compactness
+        self.num_iterations = num_iterations
+        self.warm_iterations = warm_iterations
+        self.convergence_threshold = convergence_threshold
+        self.previous = None
+        self.centers = None
+        self.outputs = None
+
+    def process(self, image, secondary=None):
+        # Returns the filtered frame and secondary frame (or None)
+        array = np.asarray(image)
+        secondary_array = None if secondary is None else np.asarray(secondary)
+        if self.outputs is not None and np.array_equal(array, self.previous[0]) and \
+                np.array_equal(secondary_array, self.previous[1]):
+            return self.outputs
+
+        slic_image = SLICImage(image.copy(), None)
+        warm = self.centers is not None and self.previous[0].shape == array.shape
+        labels, _ = slic_image.slic(superpixel_size=self.superpixel_size, compactness=self.compactness,
+                                    num_iterations=self.warm_iterations if warm else self.num_iterations,
+                                    convergence_threshold=self.convergence_threshold, enforce_connectivity=True,
+                                    initial_centers=self.centers if warm else None)
+        self.centers = slic_image.grid_centers
+        statistics = slic_image.draw_splots(labels)
+        outputs = [slic_image.image, None]
+        if secondary is not None:
+            slic_secondary = SLICImage(secondary.copy(), None)
+            slic_secondary.draw_splots(labels, statistics)
+            outputs[1] = slic_secondary.image
+
+        self.previous = (array, secondary_array)
+        self.outputs = tuple(outputs)
+        return self.outputs
+
+class KuwaharaSequence:
+
+    def __init__(self, method='gaussian', radius=15, strip_height=64, change_threshold=0):
+        self.kuwahara = Kuwahara(method, radius)
+        self.method = method
+        self.radius = radius
+        self.strip_height = strip_height
+        self.change_threshold = change_threshold
+        self.previous = (None, None)
+        self.outputs = (None, None)
+        self.indices = None
+
+    def process(self, image, secondary=None):
+        array = np.array(image)
+        secondary_array = None if secondary is None else np.array(secondary)
+        if self.method == 'anisotropic':
+            # No strips, but identical frames still reuse the previous output
+            if not changed_rows(self.previous[0], array).any() and \
+                    (secondary is None or not changed_rows(self.previous[1], secondary_array).any()):
+                return self.outputs
+            kuwahara = Kuwahara(self.method, self.radius, image, secondary)
+            kuwahara.apply()
+            self.previous = (array, secondary_array)
+            self.outputs = kuwahara.get_results()
+            return self.outputs
+
+        primary_rows = changed_rows(self.previous[0], array, self.change_threshold)
+        primary_strips = dirty_strips(primary_rows, self.strip_height, self.radius)
+        if primary_rows.all():
+            self.outputs = (None, None)
+            self.indices = np.zeros(array.shape[:2], dtype=np.uint8)
+        output = array.copy() if self.outputs[0] is None else np.array(self.outputs[0])
+        self.kuwahara.kuwahara_tiled(array, output, self.indices, method=self.method, radius=self.radius,
+                                     strip_height=self.strip_height, primary=True, strips=primary_strips)
+
+        secondary_output = None
+        if secondary is not None:
+            # A secondary strip changes with its own pixels, or with the quadrants chosen on the primary
+            secondary_rows = changed_rows(self.previous[1], secondary_array, self.change_threshold) | primary_rows
+            secondary_output = secondary_array.copy() if self.outputs[1] is None else np.array(self.outputs[1])
+            self.kuwahara.kuwahara_tiled(secondary_array, secondary_output, self.indices, method=self.method,
+                                         radius=self.radius, strip_height=self.strip_height, primary=False,
+                                         strips=dirty_strips(secondary_rows, self.strip_height, self.radius))
+            secondary_output = Image.fromarray(secondary_output)
+
+        self.previous = (array, secondary_array)
+        self.outputs = (Image.fromarray(output), secondary_output)
+        return self.outputs
+
+class LayeredPaintSequence:
+    # The previous frame's strokes are kept. Only the cell rows whose blurred colors changed, or with
+    # a stroke that follows flow that changed, are planned again, and only the rows covered by the
+    # dabs that changed (or where the blurred canvas or the secondary changed) are drawn again, over
+    # the previous painting. The result is the same as painting the frame from scratch.
+
+    def __init__(self, brush_sizes=(6, 40, 80), brush="rough2", atlas=None, strip_height=64):
+        self.brush_sizes = brush_sizes
+        self.brush = brush
+        self.atlas = atlas or default_atlas
+        self.strip_height = strip_height
+        self.previous = (None, None)
+        self.outputs = None
+        self.flow = None # CompactFlow of the previous frame
+        self.layers = None # its PaintLayers, largest brush first
+        self.blurs = None # its (blurred RGB, blurred Lab) per layer
+        self.canvases = None # its initial canvas, painting and secondary painting (or None) as arrays
+
+    def process(self, image, secondary=None):
+        array = np.asarray(image)
+        secondary_array = None if secondary is None else np.asarray(secondary)
+        rows = changed_rows(self.previous[0], array)
+        if self.outputs is not None and not rows.any() and np.array_equal(secondary_array, self.previous[1]):
+            return self.outputs
+
+        layered_paint = LayeredPaintImage(image, secondary, brush=self.brush, atlas=self.atlas)
+        layered_paint.set_brush_sizes(*self.brush_sizes)
+        previous_secondary = self.previous[1]
+        if self.layers is None or rows.all() or (secondary_array is None) != (previous_secondary is None):
+            flow_direction = FlowDirection(image)
+            flow_direction.compute_flow()
+            self.flow = flow_direction.compact_flow()
+            layered_paint.set_flow_map(self.flow)
+            self.layers = layered_paint.plan()
+            outputs = layered_paint.paint(self.layers)
+            pyramid = blur_pyramid(array)
+            self.blurs = [(pyramid.rgb(layer.brush_size * BLUR_FACTOR), pyramid.lab(layer.brush_size * BLUR_FACTOR))
+                          for layer in self.layers]
+            self.canvases = (initial_canvas(pyramid, self.layers[0].brush_size), np.asarray(outputs[0]),
+                             None if secondary is None else np.asarray(outputs[1]))
+        else:
+            flow_rows = self.update_flow(array, dirty_strips(rows, self.strip_height, FLOW_HALO))
+            layered_paint.set_flow_map(self.flow)
+            secondary_rows = None if secondary is None else changed_rows(previous_secondary, secondary_array)
+            outputs = self.repaint(array, secondary, secondary_rows, flow_rows)
+
+        self.previous = (array, secondary_array)
+        self.outputs = outputs
+        return self.outputs
+
+    def update_flow(self, array, strips):
+        # The previous frame's compact flow, recomputed in the given strips (with enough rows around
+        # them), returns the rows where it changed
+        angles, log_intensities = np.array(self.flow.angles), np.array(self.flow.log_intensities)
+        h = array.shape[0]
+        for y0 in strips:
+            y1 = min(h, y0 + self.strip_height)
+            top, bottom = max(0, y0 - FLOW_HALO), min(h, y1 + FLOW_HALO)
+            # Strips are converted to Lab once, they'd only push whole frames out of the Lab cache
+            strip = FlowDirection(np.ascontiguousarray(array[top:bottom]), cache_lab=False)
+            strip.compute_flow()
+            compact = strip.compact_flow()
+            angles[y0:y1] = compact.angles[y0 - top:y1 - top]
+            log_intensities[y0:y1] = compact.log_intensities[y0 - top:y1 - top]
+        flow_rows = changed_rows(self.flow.angles, angles) | changed_rows(self.flow.log_intensities, log_intensities)
+        self.flow = CompactFlow(angles, log_intensities)
+        return flow_rows
+
+    def repaint(self, array, secondary, secondary_rows, flow_rows):
+        # Plans the affected cell rows of every layer again and draws the rows whose dabs changed
+        h = array.shape[0]
+        pyramid = blur_pyramid(array)
+        layers, blurs = [], []
+        redraw = np.zeros(h, dtype=bool)
+        lab = pyramid.lab(self.layers[0].brush_size * BLUR_FACTOR)
+        lab_rows = changed_rows(self.blurs[0][1], lab)
+        for i, (layer, previous_blurs) in enumerate(zip(self.layers, self.blurs)):
+            size = layer.brush_size
+            mask_size = layer.rotated_brush_masks.shape[1]
+            blurred = (pyramid.rgb(size * BLUR_FACTOR), pyramid.lab(size * BLUR_FACTOR))
+            # Cells are selected on their own blurred pixels, and on the Lab of the initial canvas
+            input_rows = lab_rows | changed_rows(previous_blurs[0], blurred[0]) | \
+                changed_rows(previous_blurs[1], blurred[1])
+            dirty = np.zeros(-(-h // size), dtype=bool)
+            dirty[np.flatnonzero(input_rows) // size] = True
+            # Strokes read the flow at the middle of every dab
+            dabs = layer.dabs
+            dirty[dabs.cell_ys[flow_rows[np.clip(dabs.ys + size // 2, 0, h - 1)]]] = True
+
+            dropped = dirty[dabs.cell_ys]
+            planned = [plan_tile(lab[top:bottom], blurred[0][top:bottom], blurred[1][top:bottom], self.flow, top, 0, h,
+                                 size, i == 0, STROKE_THRESHOLD, NUM_DIRECTIONS)
+                       for top, bottom in cell_row_bands(dirty, size, h)]
+            for changed in [dabs.ys[dropped]] + [dabs.ys for dabs in planned]:
+                covered(redraw, changed, mask_size)
+            if secondary_rows is not None:
+                # Dabs take their secondary color from the cell their stroke started in
+                secondary_cells = np.zeros_like(dirty)
+                secondary_cells[np.flatnonzero(secondary_rows) // size] = True
+                covered(redraw, dabs.ys[secondary_cells[dabs.cell_ys]], mask_size)
+
+            merged = BrushDabs(*[np.concatenate(values) for values in zip(BrushDabs(*[field[~dropped] for field in dabs]), *planned)])
+            # Back in the order plan() makes them, see LayeredPaintImage.plan_tiles
+            order = np.lexsort((merged.cell_xs, merged.cell_ys, merged.step))
+            merged = BrushDabs(*[field[order] for field in merged])
+            merged = merged._replace(wave=stroke_waves(merged.xs, merged.cell_xs, merged.cell_ys, size))
+            layers.append(PaintLayer(size, merged, layer.rotated_brush_masks))
+            blurs.append(blurred)
+
+        base = initial_canvas(pyramid, layers[0].brush_size)
+        redraw |= changed_rows(self.canvases[0], base)
+        secondary_array = None
+        if secondary is not None:
+            secondary_array = np.asarray(secondary)
+            redraw |= secondary_rows
+        canvas = np.array(self.canvases[1])
+        secondary_canvas = None if secondary is None else np.array(self.canvases[2])
+        with span("sequence repaint", rows=int(redraw.sum())):
+            for top, bottom in row_bands(redraw):
+                canvas[top:bottom] = base[top:bottom]
+                canvases = [canvas[top:bottom]]
+                if secondary is not None:
+                    secondary_canvas[top:bottom] = secondary_array[top:bottom]
+                    canvases.append(secondary_canvas[top:bottom])
+                for layer in layers:
+                    selected, dabs = band_dabs(layer.dabs, layer.rotated_brush_masks.shape[1], top, bottom)
+                    colors = [layer.dabs.colors[selected]]
+                    if secondary is not None and len(selected):
+                        # Only the cell rows the band's strokes started from are summed
+                        size = layer.brush_size
+                        first, last = dabs.cell_ys.min(), dabs.cell_ys.max() + 1
+                        colors.append(cell_colors(secondary_array[first * size:last * size], size,
+                                                  dabs._replace(cell_ys=dabs.cell_ys - first)))
+                    elif secondary is not None:
+                        colors.append(layer.dabs.colors[:0])
+                    draw_dabs(canvases, colors, dabs, layer.rotated_brush_masks)
+
+        self.layers, self.blurs = layers, blurs
+        self.canvases = (base, canvas, secondary_canvas)
+        return Image.fromarray(canvas), None if secondary is None else image_like(secondary_canvas, secondary)
+
+def covered(rows, ys, size):
+    # Marks the rows that dabs of brush `size` at rows `ys` cover
+    h = len(rows)
+    starts = np.zeros(h + 1, dtype=np.int64)
+    np.add.at(starts, np.clip(ys, 0, h), 1)
+    np.add.at(starts, np.clip(ys + size, 0, h), -1)
+    rows |= np.cumsum(starts[:h]) > 0
+
+def row_bands(rows):
+    # (top, bottom) of every run of True rows
+    edges = np.flatnonzero(np.diff(np.r_[0, rows.astype(np.int8), 0]))
+    return list(zip(edges[::2], edges[1::2]))
+
+def cell_row_bands(dirty, cell_size, h):
+    # (top, bottom) image rows of every run of dirty cell rows
+    return [(top * cell_size, min(h, bottom * cell_size)) for top, bottom in row_bands(dirty)]
+
+SEQUENCE_FILTERS = {
+    "slic": SLICSequence,
+    "kuwahara": KuwaharaSequence,
+    "layered_paint": LayeredPaintSequence,
+}
+
+def filter_sequence(sequence_filter, frames, secondary_frames=None):
+    # Yields (filename, filtered frame, filtered secondary frame or None, seconds) as frames come in
+    secondary_frames = iter(secondary_frames) if secondary_frames is not None else None
+    for filename, image in frames:
+        secondary = next(secondary_frames)[1] if secondary_frames is not None else None
+        start = time.perf_counter()
+        output, secondary_output = sequence_filter.process(image, secondary)
+        yield filename, output, secondary_output, time.perf_counter() - start
+
+if __name__ == "__main__":
+    name, frames_dir, output_dir = sys.argv[1:4]
+    secondary_dir = sys.argv[4] if len(sys.argv) > 4 else None
+    os.makedirs(output_dir, exist_ok=True)
+    secondary_frames = read_frames(secondary_dir) if secondary_dir else None
+    for filename, output, secondary_output, seconds in filter_sequence(SEQUENCE_FILTERS[name](), read_frames(frames_dir), secondary_frames):
+        output.save(os.path.join(output_dir, filename))
+        if secondary_output is not None:
+            secondary_output.save(os.path.join(output_dir, f"secondary_{filename}"))
+        print(f"{filename}: {seconds:.2f} seconds")
@@ -3,9 +3,15 @@
 # https://www.epfl.ch/labs/ivrl/research/slic-superpixels/
 
 from PIL import Image, ImageDraw
-import math
 import numpy as np
-from typing import List, Tuple, NamedTuple
+from color import rgb2lab
+from image_io import image_like
+from profiling import span, count
+from typing import Tuple, NamedTuple
+import cv2
+
+# Smallest superpixel size the coarse level of the pyramid mode is solved at
+MIN_PYRAMID_SUPERPIXEL_SIZE = 4
 
 class SuperpixelClusterCenter(NamedTuple):
     lab: Tuple[float, float, float]
@@ -13,6 +19,12 @@ class SuperpixelClusterCenter(NamedTuple):
     y: float
 
 
+class SegmentStatistics(NamedTuple):
+    counts: np.ndarray
+    xs: np.ndarray
+    ys: np.ndarray
+
+
 class SLICImage:
     image: Image.Image
     draw: ImageDraw.ImageDraw
@@ -23,50 +35,79 @@ class SLICImage:
         self.draw = draw
         self.num_pixels = image.size[0] * image.size[1]
 
-    def slic(self, superpixel_size=100, num_iterations=10, compactness=10):
+    def slic(self, superpixel_size=100, num_iterations=10, compactness=10, enforce_connectivity=False, min_segment_size=None,
+             pyramid_levels=0, refine_iterations=2, convergence_threshold=None, perturb_seeds=True, initial_centers=None):
+        # superpixel_size is the grid interval S, the side of the square cell every center is seeded in.
+        # With perturb_seeds, each seed moves to the lowest gradient pixel of its 3x3 neighbourhood,
+        # so that it doesn't start on an edge of the normal map.
+        # With pyramid_levels > 0, SLIC is first solved with num_iterations on the image downsampled
+        # by 2**pyramid_levels, and the centers are then refined with refine_iterations at full
+        # resolution. The levels are reduced as needed so the downsampled superpixels stay at least
+        # MIN_PYRAMID_SUPERPIXEL_SIZE pixels wide and line up with the full resolution grid.
+        # With convergence_threshold, iterating stops early once the centers move less than that
+        # many pixels on average in an iteration.
+        # initial_centers warm starts the iterations from the grid_centers of an earlier call with the
+        # same image size and superpixel_size, e.g. the previous frame of a sequence, instead of seeding.
         w, h = self.image.size
-        lab = rgb2lab(np.array(self.image).astype(np.float32))
+        lab = rgb2lab(np.array(self.image), cache=True)
 
         S = int(superpixel_size)
-        grid_interval = int(math.sqrt(superpixel_size))
-
-        centers: List[SuperpixelClusterCenter] = []
-        for y in range(S//2, h, S):
-            for x in range(S//2, w, S):
-                centers.append(SuperpixelClusterCenter(lab[y,x], x, y))
-        
-        labels = -np.ones((h, w), dtype=np.int32)
-        distances = np.full((h, w), np.inf, dtype=np.float32)
-
-        for iteration in range(num_iterations):
-            for k, ((l, a, b), cx, cy) in enumerate(centers):
-                y0, y1 = max(0, int(cy - S)), min(h, int(cy + S))
-                x0, x1 = max(0, int(cx - S)), min(w, int(cx + S))
-                # ChatGPT wrote this part, I don't understand numpy
-                # It's calculating the distances from every pixel to the cluster
-                region = lab[y0:y1, x0:x1]
-                yy, xx = np.mgrid[y0:y1, x0:x1]
-                color_dist = np.sqrt((region[...,0]-l)**2 + (region[...,1]-a)**2 + (region[...,2]-b)**2)
-                spatial_dist = np.sqrt((yy-cy)**2 + (xx-cx)**2)
-                D = np.sqrt((color_dist/compactness)**2 + (spatial_dist/S)**2)
-                mask = D < distances[y0:y1, x0:x1] # Set of pixels where Ck is new closest
-                distances[y0:y1, x0:x1][mask] = D[mask]
-                labels[y0:y1, x0:x1][mask] = k
-                #endgpt
-            # Move each cluster center to the average of the pixels in that cluster
-            for cluster_index in range(len(centers)):
-                ys, xs = np.where(labels == k)
-                if len(ys)==0: 
-                    continue # cluster is empty, avoid divide by 0
-                color_mean = lab[ys, xs].mean(axis=0)
-                centers[cluster_index] = SuperpixelClusterCenter(
-                    color_mean,
-                    xs.mean(),
-                    ys.mean()
-                )
-
-        # Draw random colors for segments
-        return labels, centers
+
+        # Seed in the middle of each cell (cells on the right/bottom edge may be partial)
+        grid_h, grid_w = -(-h // S), -(-w // S)
+        seed_ys = np.minimum(np.arange(grid_h) * S + S // 2, h - 1)
+        seed_xs = np.minimum(np.arange(grid_w) * S + S // 2, w - 1)
+        seed_ys, seed_xs = np.meshgrid(seed_ys, seed_xs, indexing='ij')
+        if perturb_seeds:
+            seed_ys, seed_xs = lowest_gradient_seeds(lab, seed_ys, seed_xs)
+        centers = np.empty((grid_h * grid_w, 5), dtype=np.float32) # l, a, b, x, y
+        centers[:, 0:3] = lab[seed_ys, seed_xs].reshape(-1, 3)
+        centers[:, 3] = seed_xs.ravel()
+        centers[:, 4] = seed_ys.ravel()
+        if initial_centers is not None:
+            if initial_centers.shape != centers.shape:
+                raise ValueError("initial_centers don't match the superpixel grid of this image")
+            centers = np.array(initial_centers, dtype=np.float32)
+            pyramid_levels = 0
+
+        # Iterations actually run, which can be fewer than asked for with a convergence_threshold
+        self.coarse_iterations = 0
+        levels = pyramid_levels
+        while levels > 0 and (S % 2**levels or S // 2**levels < MIN_PYRAMID_SUPERPIXEL_SIZE):
+            levels -= 1
+        if levels > 0:
+            # With S divisible by the factor, the coarse grid has exactly the same cells, so center k
+            # keeps owning cell k at both resolutions
+            factor = 2**levels
+            coarse_lab = cv2.resize(lab, (-(-w // factor), -(-h // factor)), interpolation=cv2.INTER_AREA)
+            coarse_centers = centers.copy()
+            coarse_centers[:, 3:5] = (centers[:, 3:5] + 0.5) / factor - 0.5
+            # The threshold stays in full resolution pixels
+            coarse_threshold = None if convergence_threshold is None else convergence_threshold / factor
+            _, coarse_centers, self.coarse_iterations = iterate_slic(
+                coarse_lab, coarse_centers, S // factor, compactness, num_iterations, coarse_threshold)
+            centers = coarse_centers
+            centers[:, 3:5] = (coarse_centers[:, 3:5] + 0.5) * factor - 0.5
+            num_iterations = refine_iterations
+
+        labels, centers, self.iterations = iterate_slic(lab, centers, S, compactness, num_iterations, convergence_threshold)
+        # One center per grid cell, before connectivity changes the labels
+        self.grid_centers = centers
+
+        if enforce_connectivity:
+            # Fragments smaller than a quarter of a superpixel are merged into their neighbours
+            if min_segment_size is None:
+                min_segment_size = S * S // 4
+            with span("slic connectivity"):
+                labels = connected_segments(labels, min_segment_size)
+                centers = np.zeros((labels.max() + 1, 5), dtype=np.float32)
+                pixel_xs = np.tile(np.arange(w, dtype=np.float32), h)
+                pixel_ys = np.repeat(np.arange(h, dtype=np.float32), w)
+                centers = update_centers(lab, labels, centers, pixel_xs, pixel_ys)
+        count("slic clusters", len(centers))
+
+        centers = [SuperpixelClusterCenter(tuple(c[0:3]), c[3], c[4]) for c in centers]
+        return np.ascontiguousarray(labels), centers
 
     @staticmethod
     def show_as_random_colors(labels):
@@ -78,44 +119,206 @@ class SLICImage:
         return Image.fromarray(vis)
         #endgpt
 
-    def draw_splots(self, labels):
-        overlay = Image.new('RGBA', self.image.size, (0,0,0,0))
-        for k in range(labels.max()+1):
-            ys, xs = np.where(labels == k)
-            cx, cy = int(xs.mean()), int(ys.mean())
-            center_color = self.pixels[cx,cy]
-            #print(k, cx, cy)
-            #print(center_color) 
-            mask = (labels == k).astype(np.uint8) * 255
-            mask_image = Image.fromarray(mask, mode='L')
-            colored_overlay = Image.new('RGBA', self.image.size, center_color)
-            overlay.paste(colored_overlay, (0, 0), mask_image)
-
-        self.image.paste(overlay, (0, 0), overlay)
-
-def rgb2lab(rgb):
-    # Function written by chatGPT
-    # Converts from rgb color space to CIELAB (lightness, color a, color b) color space
-
-    # Very rough conversion, enough for SLIC demo
-    rgb = rgb / 255.0
-    mask = rgb > 0.04045
-    rgb[mask] = np.power((rgb[mask] + 0.055) / 1.055, 2.4)
-    rgb[~mask] /= 12.92
-    rgb *= 100
-
-    # sRGB D65 conversion
-    X = rgb[...,0]*0.4124 + rgb[...,1]*0.3576 + rgb[...,2]*0.1805
-    Y = rgb[...,0]*0.2126 + rgb[...,1]*0.7152 + rgb[...,2]*0.0722
-    Z = rgb[...,0]*0.0193 + rgb[...,1]*0.1192 + rgb[...,2]*0.9505
-
-    X /= 95.047; Y /= 100.0; Z /= 108.883
-    XYZ = np.stack([X,Y,Z], axis=-1)
-    mask = XYZ > 0.008856
-    XYZ[mask] = np.cbrt(XYZ[mask])
-    XYZ[~mask] = (7.787 * XYZ[~mask]) + (16/116)
-
-    L = (116 * XYZ[...,1]) - 16
-    a = 500 * (XYZ[...,0] - XYZ[...,1])
-    b = 200 * (XYZ[...,1] - XYZ[...,2])
-    return np.stack([L,a,b], axis=-1)
\ No newline at end of file
+    @staticmethod
+    def segment_statistics(labels):
+        # Pixel count and centroid of every label, in one pass over the label map
+        h, w = labels.shape
+        flat = labels.ravel()
+        counts = np.bincount(flat)
+        pixel_xs = np.tile(np.arange(w, dtype=np.float32), h)
+        pixel_ys = np.repeat(np.arange(h, dtype=np.float32), w)
+        divisor = np.maximum(counts, 1)
+        xs = np.bincount(flat, weights=pixel_xs, minlength=len(counts)) / divisor
+        ys = np.bincount(flat, weights=pixel_ys, minlength=len(counts)) / divisor
+        return SegmentStatistics(counts, xs, ys)
+
+    def draw_splots(self, labels, statistics=None, mean_color=False):
+        # Fills every segment with the color at its centroid (or its mean color) using a single
+        # palette lookup. Returns the label statistics so they can be reused for a secondary image.
+        if statistics is None:
+            statistics = self.segment_statistics(labels)
+        pixels = np.array(self.image)
+        if mean_color:
+            divisor = np.maximum(statistics.counts, 1)
+            channels = pixels.reshape(-1, 1 if pixels.ndim == 2 else pixels.shape[2])
+            colors = np.stack([
+                np.bincount(labels.ravel(), weights=channels[:, c], minlength=len(divisor)) / divisor
+                for c in range(channels.shape[1])
+            ], axis=-1).reshape(len(divisor), *pixels.shape[2:])
+            colors = np.round(colors).astype(pixels.dtype)
+        else:
+            colors = pixels[statistics.ys.astype(np.intp), statistics.xs.astype(np.intp)]
+
+        with span("slic rasterization"):
+            self.image.paste(image_like(colors[labels], self.image))
+        return statistics
+
+def iterate_slic(lab, centers, S, compactness, num_iterations, convergence_threshold=None):
+    # Alternates assigning pixels and moving centers, returns the (H, W) labels, the centers and the
+    # number of iterations run.
+    # Every center owns one SxS grid cell. Since a center never drifts far from the cell it
+    # was seeded in, a pixel only has to be compared against the centers of its own cell
+    # and the 8 surrounding ones, which lets every center be processed at once.
+    h, w = lab.shape[:2]
+    grid_h, grid_w = -(-h // S), -(-w // S)
+    lab_blocks = pad_to_blocks(lab, S, grid_h, grid_w)
+    block_ys = np.arange(grid_h * S, dtype=np.float32).reshape(grid_h, S, 1, 1)
+    block_xs = np.arange(grid_w * S, dtype=np.float32).reshape(1, 1, grid_w, S)
+    pixel_xs = np.tile(np.arange(w, dtype=np.float32), h)
+    pixel_ys = np.repeat(np.arange(h, dtype=np.float32), w)
+
+    labels = None
+    iterations = 0
+    while iterations < num_iterations:
+        with span("slic assignment"):
+            labels = assign_labels(lab_blocks, block_ys, block_xs, centers, S, compactness, grid_h, grid_w)[:h, :w]
+        with span("slic center update"):
+            new_centers = update_centers(lab, labels, centers, pixel_xs, pixel_ys)
+        # Residual error: mean distance the centers moved, a few centers keep oscillating so the maximum wouldn't settle
+        movement = np.mean(np.hypot(*(new_centers[:, 3:5] - centers[:, 3:5]).T))
+        centers = new_centers
+        iterations += 1
+        count("slic iterations")
+        count("slic pixels assigned", h * w)
+        if convergence_threshold is not None and movement <= convergence_threshold:
+            break
+    if labels is None:
+        labels = assign_labels(lab_blocks, block_ys, block_xs, centers, S, compactness, grid_h, grid_w)[:h, :w]
+    return labels, centers, iterations
+
+def lowest_gradient_seeds(lab, seed_ys, seed_xs):
+    # Moves every seed to the pixel of its 3x3 neighbourhood with the smallest Lab gradient
+    # |I(x+1, y) - I(x-1, y)|^2 + |I(x, y+1) - I(x, y-1)|^2, evaluated only around the seeds
+    h, w = lab.shape[:2]
+    offsets = np.arange(-1, 2)
+    ys = np.clip(seed_ys[..., None, None] + offsets[:, None], 0, h - 1)
+    xs = np.clip(seed_xs[..., None, None] + offsets[None, :], 0, w - 1)
+    gradient = np.sum(np.square(lab[ys, np.minimum(xs + 1, w - 1)] - lab[ys, np.maximum(xs - 1, 0)]), axis=-1)
+    gradient += np.sum(np.square(lab[np.minimum(ys + 1, h - 1), xs] - lab[np.maximum(ys - 1, 0), xs]), axis=-1)
+    best = gradient.reshape(*seed_ys.shape, 9).argmin(axis=-1)[..., None]
+    ys, xs = [np.broadcast_to(a, gradient.shape).reshape(*seed_ys.shape, 9) for a in (ys, xs)]
+    return np.take_along_axis(ys, best, -1)[..., 0], np.take_along_axis(xs, best, -1)[..., 0]
+
+def pad_to_blocks(lab, S, grid_h, grid_w):
+    # Reshapes (H, W, 3) into (grid_h, S, grid_w, S, 3) so that [i, :, j, :] is grid cell (i, j)
+    h, w = lab.shape[:2]
+    padded = np.zeros((grid_h * S, grid_w * S, 3), dtype=np.float32)
+    padded[:h, :w] = lab
+    return padded.reshape(grid_h, S, grid_w, S, 3)
+
+def assign_labels(lab_blocks, block_ys, block_xs, centers, S, compactness, grid_h, grid_w):
+    # Labels every pixel with the closest of the 9 centers around its grid cell.
+    # D^2 * compactness^2 is compared instead of D, which keeps the ordering and skips the sqrt.
+    spatial_weight = np.float32((compactness / S) ** 2)
+
+    # Pad the center grid with one ring of centers at infinity so edge cells can look outside
+    grid = np.full((grid_h + 2, grid_w + 2, 5), np.inf, dtype=np.float32)
+    grid[1:-1, 1:-1] = centers.reshape(grid_h, grid_w, 5)
+    cell_index = np.arange(grid_h * grid_w, dtype=np.int32).reshape(grid_h, grid_w)
+    cell_index = np.pad(cell_index, 1)
+
+    best_dist = np.full(lab_blocks.shape[:4], np.inf, dtype=np.float32)
+    best_label = np.zeros(lab_blocks.shape[:4], dtype=np.int32)
+    dist = np.empty_like(best_dist)
+    tmp = np.empty_like(best_dist)
+    closer = np.empty(best_dist.shape, dtype=bool)
+
+    for di in (-1, 0, 1):
+        for dj in (-1, 0, 1):
+            neighbour = grid[1 + di:1 + di + grid_h, 1 + dj:1 + dj + grid_w][:, None, :, None, :]
+            index = cell_index[1 + di:1 + di + grid_h, 1 + dj:1 + dj + grid_w][:, None, :, None]
+
+            np.square(block_ys - neighbour[..., 4], out=dist)
+            np.square(block_xs - neighbour[..., 3], out=tmp)
+            dist += tmp
+            dist *= spatial_weight
+            for c in range(3):
+                np.subtract(lab_blocks[..., c], neighbour[..., c], out=tmp)
+                np.square(tmp, out=tmp)
+                dist += tmp
+
+            np.less(dist, best_dist, out=closer)
+            np.copyto(best_dist, dist, where=closer)
+            np.copyto(best_label, index, where=closer)
+
+    return best_label.reshape(grid_h * S, grid_w * S)
+
+def update_centers(lab, labels, centers, pixel_xs, pixel_ys):
+    # Moves every center to the mean of its pixels in one pass, empty clusters stay where they are
+    K = len(centers)
+    flat = labels.ravel()
+    counts = np.bincount(flat, minlength=K)
+    sums = np.empty((K, 5), dtype=np.float64)
+    for c in range(3):
+        sums[:, c] = np.bincount(flat, weights=lab[..., c].ravel(), minlength=K)
+    sums[:, 3] = np.bincount(flat, weights=pixel_xs, minlength=K)
+    sums[:, 4] = np.bincount(flat, weights=pixel_ys, minlength=K)
+
+    non_empty = counts > 0
+    new_centers = centers.copy()
+    new_centers[non_empty] = sums[non_empty] / counts[non_empty, None]
+    return new_centers
+
+def connected_segments(labels, min_size=0):
+    # Splits every label into its 4-connected components, merges components smaller than min_size
+    # into their largest neighbour, and renumbers the result to 0..K-1 with no empty labels
+    h, w = labels.shape
+    flat = labels.ravel()
+    index = np.arange(h * w, dtype=np.int64).reshape(h, w)
+    a = np.concatenate([index[:, :-1].ravel(), index[:-1, :].ravel()])
+    b = np.concatenate([index[:, 1:].ravel(), index[1:, :].ravel()])
+    same = flat[a] == flat[b]
+
+    # Union-find over all pixels at once: hook every root onto the smallest root it touches, then
+    # flatten the trees by pointer jumping, until every edge joins two pixels with the same root
+    components = union_find(h * w, a[same], b[same])
+
+    # Pixel pairs across segment boundaries, used to find the neighbours of small segments
+    a, b = a[~same], b[~same]
+    while True:
+        components = compact_labels(components)
+        sizes = np.bincount(components)
+        ca, cb = components[a], components[b]
+        ca, cb = np.concatenate([ca, cb]), np.concatenate([cb, ca])
+        small = (sizes[ca] < min_size) & (ca != cb)
+        if not small.any():
+            break
+        ca, cb = ca[small], cb[small]
+
+        # Pick the largest neighbour of each small segment. Only merging into a segment that is
+        # larger (ties broken by id) keeps the merges free of cycles.
+        order = np.lexsort((cb, sizes[cb], ca))
+        ca, cb = ca[order], cb[order]
+        last = np.r_[ca[1:] != ca[:-1], True]
+        ca, cb = ca[last], cb[last]
+        grows = (sizes[cb] > sizes[ca]) | ((sizes[cb] == sizes[ca]) & (cb < ca))
+        merge_into = np.arange(len(sizes))
+        merge_into[ca[grows]] = cb[grows]
+        while True:
+            jumped = merge_into[merge_into]
+            if np.array_equal(jumped, merge_into):
+                break
+            merge_into = jumped
+        components = merge_into[components]
+
+    return components.reshape(h, w).astype(np.int32)
+
+def compact_labels(labels):
+    # Renumbers labels to 0..K-1 keeping their order, without sorting
+    present = np.bincount(labels.ravel()) > 0
+    return (np.cumsum(present) - 1)[labels]
+
+def union_find(n, a, b):
+    parent = np.arange(n, dtype=np.int64)
+    while True:
+        ra, rb = parent[a], parent[b]
+        differ = ra != rb
+        if not differ.any():
+            return parent
+        ra, rb = ra[differ], rb[differ]
+        np.minimum.at(parent, np.maximum(ra, rb), np.minimum(ra, rb))
+        while True:
+            jumped = parent[parent]
+            if np.array_equal(jumped, parent):
+                break
+            parent = jumped
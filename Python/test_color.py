@@ -0,0 +1,43 @@
+# Run with `python -m pytest` from this directory
+
+import numpy as np
+import pytest
+from color import rgb2lab, clear_lab_cache
+
+def reference_rgb2lab(rgb):
+    # The conversion the filters had before color.py, in float64
+    rgb = np.asarray(rgb, dtype=np.float64)[..., 0:3] / 255.0
+    rgb = np.where(rgb > 0.04045, ((rgb + 0.055) / 1.055) ** 2.4, rgb / 12.92) * 100
+    xyz = rgb @ np.array([
+        [0.4124, 0.3576, 0.1805],
+        [0.2126, 0.7152, 0.0722],
+        [0.0193, 0.1192, 0.9505],
+    ]).T / np.array([95.047, 100.0, 108.883])
+    f = np.where(xyz > 0.008856, np.cbrt(xyz), 7.787 * xyz + 16 / 116)
+    return np.stack([116 * f[..., 1] - 16, 500 * (f[..., 0] - f[..., 1]), 200 * (f[..., 1] - f[..., 2])], axis=-1)
+
+def rgb_samples():
+    # Every gray level, the corners of the cube and random colors
+    rng = np.random.default_rng(0)
+    levels = np.arange(256, dtype=np.uint8)
+    corners = np.array(np.meshgrid([0, 255], [0, 255], [0, 255])).reshape(3, -1).T.astype(np.uint8)
+    return np.concatenate([np.repeat(levels[:, None], 3, 1), corners, rng.integers(0, 256, (100000, 3))]).astype(np.uint8).reshape(-1, 8, 3)
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.float32])
+def test_rgb2lab_matches_reference(dtype):
+    rgb = rgb_samples()
+    lab = rgb2lab(rgb.astype(dtype))
+    assert lab.dtype == np.float32 and lab.shape == rgb.shape
+    np.testing.assert_allclose(lab, reference_rgb2lab(rgb), rtol=0, atol=1.2e-4)
+
+def test_cached_rgb2lab_is_shared_and_read_only():
+    clear_lab_cache()
+    rgb = rgb_samples()
+    lab = rgb2lab(rgb, cache=True)
+    assert rgb2lab(rgb.copy(), cache=True) is lab
+    assert not lab.flags.writeable
+    np.testing.assert_array_equal(lab, rgb2lab(rgb))
+    out = np.empty(lab.shape, dtype=np.float32)
+    assert rgb2lab(rgb, out=out, cache=True) is out
+    np.testing.assert_array_equal(out, lab)
+    clear_lab_cache()
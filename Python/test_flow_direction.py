@@ -0,0 +1,37 @@
+# Run with `python -m pytest` from this directory
+
+import numpy as np
+from PIL import Image
+from flow_direction import FlowDirection, structure_tensor, symmetric_eigen_2x2, eigen_errors
+from conftest import normal_map
+
+# The closed form is float32 and eigh float64, see benchmark_structure_tensor for typical errors
+EIGENVALUE_TOLERANCE = 1e-5
+TANGENT_TOLERANCE = 1e-5
+
+def normal_map_tensor(height, width):
+    return structure_tensor(FlowDirection(Image.fromarray(normal_map(height, width))).lab_image[..., 0])
+
+def test_closed_form_matches_eigh_on_synthetic_map():
+    eigenvalue_error, tangent_error = eigen_errors(*normal_map_tensor(256, 203))
+    assert eigenvalue_error < EIGENVALUE_TOLERANCE
+    assert tangent_error < TANGENT_TOLERANCE
+
+def test_closed_form_matches_eigh_on_random_tensors():
+    # Structure tensors are positive semidefinite, including diagonal and isotropic ones
+    rng = np.random.default_rng(0)
+    gradients = rng.normal(size=(64, 64, 2, 3)).astype(np.float32)
+    gradients[:8, :, 1] = 0 # b == 0
+    gradients[8:16] = gradients[8:16, :, ::-1] # swapped axes
+    Jxx, Jxy, Jyy = [np.einsum("...i,...i->...", gradients[..., i, :], gradients[..., j, :]) for i, j in ((0, 0), (0, 1), (1, 1))]
+    Jxx[16:24] = Jyy[16:24]
+    Jxy[16:24] = 0 # isotropic, the tangent is undefined
+    eigenvalue_error, tangent_error = eigen_errors(Jxx, Jxy, Jyy)
+    assert eigenvalue_error < EIGENVALUE_TOLERANCE
+    assert tangent_error < TANGENT_TOLERANCE
+
+def test_tangents_are_unit_vectors_along_angles():
+    eigenvalues, tangents, angles = symmetric_eigen_2x2(*normal_map_tensor(64, 71))
+    np.testing.assert_allclose(np.linalg.norm(tangents, axis=-1), 1, atol=1e-6)
+    np.testing.assert_allclose(tangents[..., 0], np.cos(angles), atol=1e-6)
+    assert np.all(eigenvalues[..., 0] <= eigenvalues[..., 1])
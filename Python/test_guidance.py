@@ -0,0 +1,88 @@
+# Run with `python -m pytest` from this directory
+
+from PIL import Image
+import numpy as np
+import pytest
+from kuwahara import Kuwahara
+from layered_paint import LayeredPaintImage
+from guidance import SLICGuidance, KuwaharaGuidance, StrokeGuidance, save_guidance, load_guidance
+
+def stroke_guidance(primary, atlas):
+    return StrokeGuidance.compute(primary, brush_sizes=(6, 16), atlas=atlas)
+
+def test_stroke_guidance_paints_arrays(primary, secondary, atlas):
+    guidance = stroke_guidance(primary, atlas)
+    image, = guidance.apply([secondary])
+    array, = guidance.apply([np.asarray(secondary)])
+    assert isinstance(image, Image.Image) and image.mode == secondary.mode
+    assert isinstance(array, np.ndarray)
+    np.testing.assert_array_equal(array, np.asarray(image))
+
+def test_stroke_guidance_paints_16bit_maps_in_8bit(primary, secondary, atlas):
+    guidance = stroke_guidance(primary, atlas)
+    expected, = guidance.apply([np.asarray(secondary)])
+    wide = np.asarray(secondary).astype(np.uint16) * 257
+    painted, = guidance.apply([wide])
+    assert painted.dtype == np.uint8
+    np.testing.assert_array_equal(painted, expected)
+    image, = guidance.apply([Image.fromarray(wide[..., 0])])
+    assert image.mode == "L"
+    np.testing.assert_array_equal(np.asarray(image), expected[..., 0])
+
+def secondaries(secondary):
+    # Maps of the kinds a material has: RGB, single channel and 16-bit
+    rgb = np.asarray(secondary)
+    return [secondary, Image.fromarray(rgb[..., 1]), rgb[..., ::-1].astype(np.uint16) * 257 + 7]
+
+GUIDANCES = [
+    ("slic", lambda primary, atlas: SLICGuidance.compute(primary, superpixel_size=16)),
+    ("kuwahara gaussian", lambda primary, atlas: KuwaharaGuidance.compute(primary, method='gaussian', radius=5)),
+    ("kuwahara mean", lambda primary, atlas: KuwaharaGuidance.compute(primary, method='mean', radius=7)),
+    ("kuwahara anisotropic", lambda primary, atlas: KuwaharaGuidance.compute(primary, method='anisotropic', radius=5)),
+    ("strokes", stroke_guidance),
+]
+
+@pytest.mark.parametrize("compute", [compute for _, compute in GUIDANCES], ids=[name for name, _ in GUIDANCES])
+def test_one_pass_matches_each_map_alone(compute, primary, secondary, atlas):
+    guidance = compute(primary, atlas)
+    maps = secondaries(secondary)
+    together = guidance.apply(maps)
+    assert len(together) == len(maps)
+    for image, output in zip(maps, together):
+        alone, = guidance.apply([image])
+        assert type(output) is type(alone)
+        assert np.asarray(output).dtype == np.asarray(alone).dtype
+        np.testing.assert_array_equal(np.asarray(output), np.asarray(alone))
+
+@pytest.mark.parametrize("compute", [compute for _, compute in GUIDANCES], ids=[name for name, _ in GUIDANCES])
+def test_saved_guidance_applies_the_same(compute, primary, secondary, atlas, tmp_path):
+    guidance = compute(primary, atlas)
+    path = tmp_path / "guidance.npz"
+    save_guidance(guidance, path)
+    loaded = load_guidance(path)
+    assert type(loaded) is type(guidance)
+    maps = secondaries(secondary)
+    for expected, output in zip(guidance.apply(maps), loaded.apply(maps)):
+        np.testing.assert_array_equal(np.asarray(output), np.asarray(expected))
+
+def test_slic_guidance_keeps_bit_depth(primary, secondary):
+    guidance = SLICGuidance.compute(primary, superpixel_size=16)
+    wide = np.asarray(secondary).astype(np.uint16) * 257
+    painted, = guidance.apply([wide])
+    assert painted.dtype == np.uint16
+    np.testing.assert_array_equal(painted, np.asarray(guidance.apply([secondary])[0]).astype(np.uint16) * 257)
+
+@pytest.mark.parametrize("method, radius", [('gaussian', 5), ('mean', 7), ('mean', 15)])
+def test_kuwahara_guidance_matches_the_filter(method, radius, primary, secondary):
+    kuwahara_filter = Kuwahara(method, radius, primary, secondary)
+    kuwahara_filter.apply()
+    filtered, = KuwaharaGuidance.compute(primary, method=method, radius=radius).apply([np.asarray(secondary)])
+    np.testing.assert_array_equal(filtered, kuwahara_filter.output_secondary)
+
+def test_stroke_guidance_matches_the_painting(primary, secondary, atlas):
+    layered_paint = LayeredPaintImage(primary, secondary, atlas=atlas)
+    layered_paint.set_flow_map()
+    layered_paint.set_brush_sizes(6, 16)
+    _, painted_secondary = layered_paint.paint()
+    painted, = stroke_guidance(primary, atlas).apply([secondary])
+    np.testing.assert_array_equal(np.asarray(painted), np.asarray(painted_secondary))
@@ -0,0 +1,110 @@
+# Run with `python -m pytest` from this directory
+
+from PIL import Image
+import numpy as np
+import pytest
+import tracemalloc
+import kuwahara
+from kuwahara import Kuwahara
+from flow_direction import FlowDirection
+from conftest import normal_map, albedo_map
+
+def stripes(size=64, vertical=True, period=8):
+    # RGB image of stripes, whose flow runs along them
+    x = np.arange(size)
+    wave = (127.5 + 127.5 * np.sin(2 * np.pi * x / period)).astype(np.uint8)
+    gray = np.tile(wave, (size, 1)) if vertical else np.tile(wave[:, None], (1, size))
+    return Image.fromarray(np.dstack([gray] * 3))
+
+def orientation_bins(image, num_orientations=4):
+    flow = FlowDirection(image)
+    flow.compute_flow()
+    return Kuwahara('anisotropic', 5, flow=flow, num_orientations=num_orientations).orientation_bins()
+
+def test_vertical_flow_stretches_quadrants_vertically():
+    bins, angles = orientation_bins(stripes(vertical=True))
+    anisotropic = bins > 0
+    assert anisotropic.mean() > 0.9
+    np.testing.assert_allclose(angles[bins[anisotropic]], np.pi / 2)
+
+def test_horizontal_flow_stretches_quadrants_horizontally():
+    bins, angles = orientation_bins(stripes(vertical=False))
+    anisotropic = bins > 0
+    assert anisotropic.mean() > 0.9
+    np.testing.assert_allclose(angles[bins[anisotropic]], 0.0)
+
+def test_sample_splits_remap_calls(monkeypatch):
+    rng = np.random.default_rng(0)
+    image = rng.random((40, 50, 3), dtype=np.float32)
+    xs = rng.uniform(0, 49, 5000).astype(np.float32)
+    ys = rng.uniform(0, 39, 5000).astype(np.float32)
+    whole = Kuwahara.sample(image, xs, ys)
+    monkeypatch.setattr(kuwahara, "SAMPLE_ROWS", 2)
+    np.testing.assert_array_equal(Kuwahara.sample(image, xs, ys), whole)
+    assert whole.shape == (5000, 3)
+
+def test_sample_is_bilinear():
+    rng = np.random.default_rng(1)
+    for channels in (1, 3, 4):
+        image = rng.random((30, 40, channels), dtype=np.float32) * 255
+        xs = rng.uniform(0, 38.99, 2000).astype(np.float32)
+        ys = rng.uniform(0, 28.99, 2000).astype(np.float32)
+        x0, y0 = xs.astype(int), ys.astype(int)
+        fx, fy = (xs - x0)[:, None], (ys - y0)[:, None]
+        expected = (image[y0, x0] * (1 - fx) * (1 - fy) + image[y0, x0 + 1] * fx * (1 - fy) +
+                    image[y0 + 1, x0] * (1 - fx) * fy + image[y0 + 1, x0 + 1] * fx * fy)
+        np.testing.assert_allclose(Kuwahara.sample(image, xs, ys), expected, atol=1e-3)
+
+def test_anisotropic_images_dont_depend_on_each_other():
+    # Every image is filtered in the same passes, which must not change any of them
+    primary = normal_map(61, 47)
+    secondary, gray = albedo_map(61, 47, seed=1), albedo_map(61, 47, seed=2)[..., 0]
+    kuwahara_filter = Kuwahara('anisotropic', 5, Image.fromarray(primary))
+    together = kuwahara_filter.anisotropic_kuwahara([primary, secondary, gray], radius=5)
+    np.testing.assert_array_equal(together[0], kuwahara_filter.anisotropic_kuwahara([primary], radius=5)[0])
+    np.testing.assert_array_equal(together[1], kuwahara_filter.anisotropic_kuwahara([primary, secondary], radius=5)[1])
+    np.testing.assert_array_equal(together[2], kuwahara_filter.anisotropic_kuwahara([primary, gray], radius=5)[1])
+
+
+@pytest.mark.parametrize("method, radius", [('mean', 4), ('mean', 13), ('gaussian', 6)])
+def test_tiled_matches_whole_image(method, radius, tmp_path):
+    # Odd sizes, and strips that don't divide the image or fit the radius
+    primary, secondary = normal_map(203, 157), albedo_map(203, 157, seed=1)
+    np.save(tmp_path / "primary.npy", primary)
+    np.save(tmp_path / "secondary.npy", secondary)
+    whole = Kuwahara(method, radius, Image.fromarray(primary), Image.fromarray(secondary))
+    whole.apply()
+    for strip_height in (37, 11, 256):
+        Kuwahara(method, radius).apply_tiled(tmp_path / "primary.npy", tmp_path / "output.npy", tmp_path / "secondary.npy",
+                                             tmp_path / "secondary_output.npy", strip_height=strip_height)
+        np.testing.assert_array_equal(np.load(tmp_path / "output.npy"), whole.output_primary)
+        np.testing.assert_array_equal(np.load(tmp_path / "secondary_output.npy"), whole.output_secondary)
+
+def test_tiled_memory_is_bounded(tmp_path):
+    # Only a strip's worth of temporaries is alive at a time, the image itself stays memory mapped
+    image = normal_map(1000, 301)
+    np.save(tmp_path / "input.npy", image)
+    def peak(run):
+        tracemalloc.start()
+        try:
+            run()
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    kuwahara_filter = Kuwahara('gaussian', 8)
+    whole = peak(lambda: kuwahara_filter.kuwahara(np.load(tmp_path / "input.npy"), method='gaussian', radius=8))
+    tiled = peak(lambda: kuwahara_filter.apply_tiled(tmp_path / "input.npy", tmp_path / "output.npy", strip_height=50))
+    assert tiled < whole / 4
+
+@pytest.mark.parametrize("method, radius", [('mean', 4), ('mean', 13), ('gaussian', 6)])
+@pytest.mark.parametrize("winner_only", [False, True])
+def test_fused_matches_each_image_alone(method, radius, winner_only):
+    primary = normal_map(131, 117)
+    secondaries = [albedo_map(131, 117, seed=1), albedo_map(131, 117, seed=2)[..., 0],
+                   albedo_map(131, 117, seed=3).astype(np.uint16) * 257]
+    kuwahara_filter = Kuwahara(method, radius)
+    fused = kuwahara_filter.kuwahara_fused([primary] + secondaries, method=method, radius=radius, winner_only=winner_only)
+    np.testing.assert_array_equal(fused[0], kuwahara_filter.kuwahara(primary, method=method, radius=radius))
+    for secondary, output in zip(secondaries, fused[1:]):
+        assert output.dtype == secondary.dtype
+        np.testing.assert_array_equal(output, kuwahara_filter.kuwahara(secondary, method=method, radius=radius, primary=False))
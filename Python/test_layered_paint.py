@@ -0,0 +1,73 @@
+# Run with `python -m pytest` from this directory
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from PIL import Image
+import numpy as np
+import pytest
+from flow_direction import CompactFlow, ANGLE_STEPS
+from layered_paint import LayeredPaintImage, trace_strokes, draw_dabs, draw_dabs_tiled
+
+def random_dabs(height, width, brush_size, num_directions, seed=0):
+    # The strokes of a random half of the cells along a random flow, which stops some of them early
+    rng = np.random.default_rng(seed)
+    flow = CompactFlow(rng.integers(0, ANGLE_STEPS, (height, width)).astype(np.uint16),
+                       rng.uniform(0, 13, (height, width)).astype(np.float16))
+    grid_h, grid_w = -(-height // brush_size), -(-width // brush_size)
+    cell_ys, cell_xs = np.nonzero(rng.random((grid_h, grid_w)) < 0.5)
+    x1, y1 = rng.integers(0, brush_size, (2, len(cell_ys)))
+    colors = rng.integers(0, 256, (len(cell_ys), 3))
+    return trace_strokes(flow, cell_ys, cell_xs, x1, y1, colors, brush_size, num_directions)
+
+def pasted(canvases, colors, dabs, masks):
+    # Every dab pasted with PIL one at a time, stroke after stroke, like LayeredPaint used to
+    images = [Image.fromarray(canvas) for canvas in canvases]
+    size = masks.shape[1]
+    for i in np.lexsort((dabs.step, dabs.cell_xs, dabs.cell_ys)):
+        box = (int(dabs.xs[i]), int(dabs.ys[i]), int(dabs.xs[i]) + size, int(dabs.ys[i]) + size)
+        mask = Image.fromarray(masks[dabs.directions[i]])
+        for image, color in zip(images, colors):
+            image.paste(tuple(int(c) for c in color[i]) if image.mode != "L" else int(color[i][0]), box=box, mask=mask)
+    return [np.asarray(image) for image in images]
+
+@pytest.mark.parametrize("brush_size", [6, 16])
+def test_batched_and_tiled_dabs_match_pil_pastes(brush_size):
+    rng = np.random.default_rng(brush_size)
+    height, width, num_directions = 97, 75, 16
+    dabs = random_dabs(height, width, brush_size, num_directions, seed=brush_size)
+    masks = rng.integers(0, 256, (num_directions, brush_size, brush_size)).astype(np.uint8)
+    canvases = [rng.integers(0, 256, (height, width, 4)).astype(np.uint8), rng.integers(0, 256, (height, width)).astype(np.uint8)]
+    canvases[0][..., 3] = 255
+    colors = [dabs.colors, rng.integers(0, 256, (len(dabs.xs), 1))]
+    assert len(np.unique(dabs.wave)) > 1 and np.any(dabs.step > 0)
+
+    expected = pasted(canvases, colors, dabs, masks)
+    drawn = [canvas.copy() for canvas in canvases]
+    draw_dabs(drawn, colors, dabs, masks)
+    for canvas, reference in zip(drawn, expected):
+        np.testing.assert_array_equal(canvas, reference)
+
+    with ThreadPoolExecutor(3) as executor:
+        for tile_height in (5, 23):
+            tiled = [canvas.copy() for canvas in canvases]
+            draw_dabs_tiled(tiled, colors, dabs, masks, executor, tile_height)
+            for canvas, reference in zip(tiled, expected):
+                np.testing.assert_array_equal(canvas, reference)
+
+@pytest.mark.parametrize("executor_type", [ThreadPoolExecutor, ProcessPoolExecutor])
+def test_tiled_painting_matches_serial(executor_type, primary, secondary, atlas):
+    layered_paint = LayeredPaintImage(primary, secondary, atlas=atlas)
+    layered_paint.set_flow_map()
+    layered_paint.set_brush_sizes(6, 16, 40)
+    expected_layers = layered_paint.plan()
+    expected = [np.asarray(image) for image in layered_paint.paint(expected_layers)]
+    with executor_type(3) as executor:
+        # Tiles smaller than the largest brush and tiles that don't divide the image
+        for tile_height in (16, 37):
+            layers = layered_paint.plan(executor, tile_height)
+            for layer, expected_layer in zip(layers, expected_layers):
+                assert layer.brush_size == expected_layer.brush_size
+                for field, expected_field in zip(layer.dabs, expected_layer.dabs):
+                    np.testing.assert_array_equal(field, expected_field)
+            painted = layered_paint.paint(executor=executor, tile_height=tile_height)
+            for image, reference in zip(painted, expected):
+                np.testing.assert_array_equal(np.asarray(image), reference)
@@ -0,0 +1,46 @@
+# Run with `python -m pytest` from this directory
+
+from PIL import Image
+import numpy as np
+import pytest
+from kuwahara import Kuwahara
+from layered_paint import LayeredPaintImage
+from sequence import KuwaharaSequence, LayeredPaintSequence
+from conftest import normal_map, albedo_map
+
+def moving_frames(height=131, width=117):
+    # (primary, secondary) frames of a ball moving over still maps, the last frame repeated, and the
+    # secondary also changing on its own in the third frame
+    primary, secondary = normal_map(height, width), albedo_map(height, width, seed=1)
+    ys, xs = np.mgrid[0:height, 0:width]
+    frames = []
+    for i, (cx, cy) in enumerate([(30, 40), (36, 43), (45, 47), (45, 47)]):
+        ball = (xs - cx) ** 2 + (ys - cy) ** 2 < 15 ** 2
+        frame, secondary_frame = primary.copy(), secondary.copy()
+        frame[ball] = (200, 90, 230)
+        secondary_frame[ball] = (40, 160, 20)
+        if i >= 2:
+            secondary_frame[100:110, 60:90] = 255
+        frames.append((Image.fromarray(frame), Image.fromarray(secondary_frame)))
+    return frames
+
+def test_layered_paint_sequence_matches_painting_each_frame(atlas):
+    sequence = LayeredPaintSequence(brush_sizes=(6, 16, 40), atlas=atlas, strip_height=16)
+    for frame, secondary in moving_frames():
+        painted, painted_secondary = sequence.process(frame, secondary)
+        layered_paint = LayeredPaintImage(frame, secondary, atlas=atlas)
+        layered_paint.set_flow_map()
+        layered_paint.set_brush_sizes(6, 16, 40)
+        expected, expected_secondary = layered_paint.paint()
+        np.testing.assert_array_equal(np.asarray(painted), np.asarray(expected))
+        np.testing.assert_array_equal(np.asarray(painted_secondary), np.asarray(expected_secondary))
+
+@pytest.mark.parametrize("method, radius", [('gaussian', 5), ('mean', 4), ('mean', 13)])
+def test_kuwahara_sequence_matches_filtering_each_frame(method, radius):
+    sequence = KuwaharaSequence(method, radius, strip_height=16)
+    for frame, secondary in moving_frames():
+        filtered, filtered_secondary = sequence.process(frame, secondary)
+        kuwahara_filter = Kuwahara(method, radius, frame, secondary)
+        kuwahara_filter.apply()
+        np.testing.assert_array_equal(np.asarray(filtered), kuwahara_filter.output_primary)
+        np.testing.assert_array_equal(np.asarray(filtered_secondary), kuwahara_filter.output_secondary)
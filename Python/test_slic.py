@@ -0,0 +1,37 @@
+# Run with `python -m pytest` from this directory
+
+from PIL import ImageDraw
+import cv2
+import numpy as np
+from slic import SLICImage, connected_segments
+
+def assert_connected_and_dense(labels, min_size):
+    sizes = np.bincount(labels.ravel())
+    assert np.all(sizes >= min_size)
+    for label in range(len(sizes)):
+        num_components, _ = cv2.connectedComponents((labels == label).astype(np.uint8), connectivity=4)
+        assert num_components == 2 # the background and the segment
+
+def test_connected_segments_splits_and_merges():
+    labels = np.zeros((8, 10), dtype=np.int32)
+    labels[:, 5:] = 7 # far from the other ids
+    labels[1, 1] = 7 # one pixel island, merged into the 0 around it
+    labels[4:8, 0:2] = 3
+    labels[0:3, 8:10] = 3 # the same id, not connected to the other 3
+    segments = connected_segments(labels, min_size=2)
+    assert segments.max() == 3
+    assert_connected_and_dense(segments, 2)
+    assert segments[1, 1] == segments[0, 0]
+    assert segments[5, 0] != segments[0, 9]
+
+def test_slic_enforces_connectivity(primary):
+    slic_image = SLICImage(primary, ImageDraw.Draw(primary))
+    labels, centers = slic_image.slic(superpixel_size=16, enforce_connectivity=True)
+    assert labels.shape == (primary.height, primary.width)
+    assert len(centers) == labels.max() + 1
+    assert_connected_and_dense(labels, 16 * 16 // 4)
+    # Every center is the centroid of its segment
+    ys, xs = np.mgrid[0:primary.height, 0:primary.width]
+    counts = np.bincount(labels.ravel())
+    np.testing.assert_allclose([center.x for center in centers], np.bincount(labels.ravel(), xs.ravel()) / counts, atol=1e-3)
+    np.testing.assert_allclose([center.y for center in centers], np.bincount(labels.ravel(), ys.ravel()) / counts, atol=1e-3)